@@ -0,0 +1,68 @@
+"""Output size and write time over the sample corpus, with and without
+compress=True, for full rewrites and incremental updates.
+
+Run from the repository root:
+
+    $ python benchmarks/bench_compress.py
+"""
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from invoicex.facturx.facturx import FacturX  # noqa: E402
+from invoicex.facturx.flavors import xml_flavor  # noqa: E402
+
+SAMPLES_DIR = os.path.join(
+    os.path.dirname(__file__), '..', 'invoicex', 'facturx', 'tests',
+    'sample_invoices')
+ROUNDS = 5
+MODES = (
+    ('full', False, False),
+    ('full+compress', False, True),
+    ('incremental', True, False),
+    ('incremental+compress', True, True),
+    )
+
+
+def load_samples():
+    invoices = []
+    for file_name in sorted(os.listdir(SAMPLES_DIR)):
+        if not file_name.endswith('.pdf'):
+            continue
+        factx = FacturX(os.path.join(SAMPLES_DIR, file_name), validation='none')
+        try:
+            factx.write_pdf(BytesIO())
+        except (TypeError, KeyError):
+            # Missing date or seller: can't build the PDF metadata.
+            continue
+        invoices.append(factx)
+    return invoices
+
+
+def main():
+    xml_flavor.logger.disabled = True
+    invoices = load_samples()
+    input_size = sum(len(factx.pdf.getbuffer()) for factx in invoices)
+    print('%d invoices, %d bytes of input' % (len(invoices), input_size))
+    print('%-21s %11s %9s %11s' % ('mode', 'bytes', 'ratio', 'ms/invoice'))
+    baseline = None
+    for name, incremental, compress in MODES:
+        size, start = 0, time.time()
+        for i in range(ROUNDS):
+            for factx in invoices:
+                output = BytesIO()
+                factx.write_pdf(output, incremental=incremental, compress=compress)
+                size += len(output.getvalue())
+        elapsed = time.time() - start
+        size //= ROUNDS
+        baseline = baseline or size
+        print('%-21s %11d %8.1f%% %11.2f' % (
+            name, size, 100.0 * size / baseline,
+            elapsed / ROUNDS / len(invoices) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Per-field access cost: raw XPath strings vs. precompiled evaluators.
+
+Run from the repository root:
+
+    $ python benchmarks/bench_field_access.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from invoicex.facturx.facturx import FacturX  # noqa: E402
+from invoicex.facturx.flavors import xml_flavor  # noqa: E402
+
+SAMPLES_DIR = os.path.join(
+    os.path.dirname(__file__), '..', 'invoicex', 'facturx', 'tests',
+    'sample_invoices')
+ROUNDS = 200
+
+
+def load_samples():
+    invoices = []
+    for file_name in sorted(os.listdir(SAMPLES_DIR)):
+        if file_name.endswith('.pdf'):
+            invoices.append(FacturX(os.path.join(SAMPLES_DIR, file_name)))
+    return invoices
+
+
+def raw_lookup(invoices):
+    for factx in invoices:
+        for field in xml_flavor.FIELDS:
+            path = factx.flavor._get_xml_path(field)
+            factx.xml.xpath(path, namespaces=factx.xml.nsmap)
+
+
+def compiled_lookup(invoices):
+    for factx in invoices:
+        for field in xml_flavor.FIELDS:
+            factx.flavor.get_xpath(field)(factx.xml)
+
+
+def main():
+    xml_flavor.logger.disabled = True
+    invoices = load_samples()
+    lookups = len(invoices) * len(xml_flavor.FIELDS) * ROUNDS
+    for name, func in (('raw xpath', raw_lookup),
+                       ('compiled', compiled_lookup)):
+        elapsed = timeit.timeit(lambda: func(invoices), number=ROUNDS)
+        print('%-10s %8.2f us/field' % (name, elapsed / lookups * 1e6))
+
+
+if __name__ == '__main__':
+    main()
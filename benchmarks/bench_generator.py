@@ -0,0 +1,73 @@
+"""XML generation throughput from rows: FacturX per row vs. XMLGenerator.
+
+The baseline fills a template-backed FacturX through __setitem__ and
+serializes it, one row at a time. Run from the repository root:
+
+    $ python benchmarks/bench_generator.py [ROWS]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from invoicex.facturx import generator  # noqa: E402
+from invoicex.facturx.facturx import FacturX  # noqa: E402
+from invoicex.facturx.flavors import xml_flavor  # noqa: E402
+
+SAMPLE = os.path.join(
+    os.path.dirname(__file__), '..', 'invoicex', 'facturx', 'tests',
+    'sample_invoices', 'no_embedded_data.pdf')
+LEVEL = 'basic'
+
+
+def make_rows(count):
+    for i in range(count):
+        yield {
+            'invoice_number': 'INV-%06d' % i,
+            'date': '2024-01-%02d' % (i % 28 + 1),
+            'amount_untaxed': '%d.00' % (100 + i % 900),
+            'amount_tax': '%d.00' % (20 + i % 180),
+            'amount_total': '%d.00' % (120 + i % 1080),
+            'seller': 'Seller %d' % (i % 50),
+            'buyer': 'Buyer %d' % i,
+        }
+
+
+def with_facturx(rows):
+    for row in rows:
+        with FacturX(SAMPLE, level=LEVEL, validation='deferred') as factx:
+            for field_name, value in row.items():
+                if field_name == 'date':
+                    value = datetime.strptime(value, '%Y-%m-%d')
+                factx[field_name] = value
+            factx.is_valid()
+            factx.xml_str
+
+
+def with_generator(rows):
+    for result in generator.XMLGenerator('factur-x', LEVEL).generate(rows):
+        pass
+
+
+def with_pool(rows):
+    for result in generator.generate_parallel(rows, 'factur-x', LEVEL):
+        pass
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    xml_flavor.logger.disabled = True
+    print('%d rows, factur-x %s, %d cores' % (count, LEVEL, os.cpu_count()))
+    for name, func, rows in (('FacturX', with_facturx, count // 10),
+                             ('XMLGenerator', with_generator, count),
+                             ('process pool', with_pool, count)):
+        start = time.perf_counter()
+        func(make_rows(rows))
+        elapsed = time.perf_counter() - start
+        print('%-14s %10.0f invoices/s' % (name, rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Embedded XML lookup on large PDFs: full PdfFileReader vs. targeted locator.
+
+A sample invoice is padded to PAGES pages and the Factur-X XML is embedded
+with FacturX.write_pdf. Run from the repository root:
+
+    $ python benchmarks/bench_locator.py [PAGES]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from invoicex.facturx import locator  # noqa: E402
+from invoicex.facturx.facturx import FacturX  # noqa: E402
+from invoicex.facturx.flavors import xml_flavor  # noqa: E402
+
+SAMPLE = os.path.join(
+    os.path.dirname(__file__), '..', 'invoicex', 'facturx', 'tests',
+    'sample_invoices', 'embedded_data.pdf')
+ROUNDS = 20
+
+
+def build_pdf(pages, temp_dir):
+    padded = os.path.join(temp_dir, 'padded.pdf')
+    reader = PdfFileReader(SAMPLE)
+    writer = PdfFileWriter()
+    page = reader.getPage(0)
+    for i in range(pages):
+        writer.addPage(page)
+    with open(padded, 'wb') as f:
+        writer.write(f)
+
+    path = os.path.join(temp_dir, 'large.pdf')
+    with FacturX(SAMPLE) as factx, open(padded, 'rb') as pdf:
+        factx.pdf = pdf
+        factx.write_pdf(path)
+    return path
+
+
+def with_pypdf2(path):
+    with open(path, 'rb') as f:
+        return locator._find_with_pypdf2(f)
+
+
+def with_locator(path):
+    with open(path, 'rb') as f:
+        return locator.find_embedded_xml(f)
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    xml_flavor.logger.disabled = True
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = build_pdf(pages, temp_dir)
+        print('%d pages, %d bytes' % (pages, os.path.getsize(path)))
+        assert with_pypdf2(path) == with_locator(path)
+        for name, func in (('PdfFileReader', with_pypdf2),
+                           ('locator', with_locator)):
+            elapsed = timeit.timeit(lambda: func(path), number=ROUNDS)
+            print('%-14s %8.2f ms/file' % (name, elapsed / ROUNDS * 1e3))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
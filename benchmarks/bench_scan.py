@@ -0,0 +1,63 @@
+"""Classifying PDFs by flavor and level: FacturX per file vs. scan_pdf.
+
+Runs over the sample invoices, with the XMP metadata and with the embedded
+XML fallback. Run from the repository root:
+
+    $ python benchmarks/bench_scan.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from invoicex.facturx import scan  # noqa: E402
+from invoicex.facturx.facturx import FacturX  # noqa: E402
+from invoicex.facturx.flavors import xml_flavor  # noqa: E402
+from invoicex.facturx.locator import read_embedded_file  # noqa: E402
+
+SAMPLES_DIR = os.path.join(
+    os.path.dirname(__file__), '..', 'invoicex', 'facturx', 'tests',
+    'sample_invoices')
+ROUNDS = 10
+
+
+def sample_paths():
+    paths = []
+    for file_name in sorted(os.listdir(SAMPLES_DIR)):
+        path = os.path.join(SAMPLES_DIR, file_name)
+        if file_name.endswith('.pdf') and read_embedded_file(path) is not None:
+            paths.append(path)
+    return paths
+
+
+def with_facturx(paths):
+    for path in paths:
+        with FacturX(path) as factx:
+            factx.flavor.name, factx.flavor.level
+
+
+def with_scan(paths):
+    for path in paths:
+        scan.scan_pdf(path)
+
+
+def with_scan_xml(paths):
+    for path in paths:
+        embedded = read_embedded_file(path)
+        scan.scan_xml(embedded.data, embedded.filename)
+
+
+def main():
+    xml_flavor.logger.disabled = True
+    paths = sample_paths()
+    print('%d PDFs' % len(paths))
+    for name, func in (('FacturX', with_facturx),
+                       ('scan (XMP)', with_scan),
+                       ('locate + XML', with_scan_xml)):
+        elapsed = timeit.timeit(lambda: func(paths), number=ROUNDS)
+        print('%-12s %8.2f ms/file' % (name, elapsed / ROUNDS / len(paths) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
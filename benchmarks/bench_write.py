@@ -0,0 +1,44 @@
+"""Embedding the XML into large PDFs: full rewrite vs. incremental update.
+
+A sample invoice is padded to PAGES pages (see bench_locator.py). Run from
+the repository root:
+
+    $ python benchmarks/bench_write.py [PAGES]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_locator import build_pdf  # noqa: E402
+from invoicex.facturx.facturx import FacturX  # noqa: E402
+from invoicex.facturx.flavors import xml_flavor  # noqa: E402
+
+ROUNDS = 10
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    xml_flavor.logger.disabled = True
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = build_pdf(pages, temp_dir)
+        output = os.path.join(temp_dir, 'output.pdf')
+        print('%d pages, %d bytes' % (pages, os.path.getsize(path)))
+        with FacturX(path) as factx:
+            for name, incremental in (('full rewrite', False),
+                                      ('incremental', True)):
+                elapsed = timeit.timeit(
+                    lambda: factx.write_pdf(output, incremental=incremental),
+                    number=ROUNDS)
+                print('%-13s %8.2f ms/write, %d bytes' % (
+                    name, elapsed / ROUNDS * 1e3, os.path.getsize(output)))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""XMP metadata per write: building the packet from the extension schema vs.
+rendering the cached XMPTemplate, and the resulting batch write time.
+
+Run from the repository root:
+
+    $ python benchmarks/bench_xmp.py
+"""
+import os
+import sys
+import timeit
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from invoicex.facturx import pdfwriter  # noqa: E402
+from invoicex.facturx.facturx import FacturX  # noqa: E402
+from invoicex.facturx.flavors import xml_flavor  # noqa: E402
+
+SAMPLE = os.path.join(
+    os.path.dirname(__file__), '..', 'invoicex', 'facturx', 'tests',
+    'sample_invoices', 'embedded_data.pdf')
+ROUNDS = 500
+WRITES = 100
+
+
+def build_xmp(factx, level, pdf_metadata):
+    # What every write did before: parse the schema file, build the tree.
+    xmp_file = os.path.join(
+        os.path.dirname(xml_flavor.__file__), factx.flavor.name, 'xmp',
+        factx.flavor.details['xmp_schema'])
+    xmp_tree = xml_flavor.etree.parse(xmp_file)
+    return pdfwriter._prepare_pdf_metadata_xml(
+        level, factx.flavor.details['xmp_filename'], xmp_tree, pdf_metadata)
+
+
+def render_xmp(factx, level, pdf_metadata):
+    return pdfwriter.XMPTemplate.for_flavor(factx.flavor).render(level, pdf_metadata)
+
+
+def main():
+    xml_flavor.logger.disabled = True
+    factx = FacturX(SAMPLE)
+    level = factx.flavor.details['levels'][factx.flavor.level]['xmp_str']
+    pdf_metadata = pdfwriter._default_pdf_metadata(factx)
+
+    for name, func in (('build', build_xmp), ('template', render_xmp)):
+        elapsed = timeit.timeit(
+            lambda: func(factx, level, pdf_metadata), number=ROUNDS)
+        print('%-9s %8.1f us/packet' % (name, elapsed / ROUNDS * 1e6))
+
+    # Batch embedding, with the XMP step swapped between both variants.
+    original = pdfwriter.XMPTemplate.render
+    for name, render in (
+            ('build', lambda self, level, pdf_metadata: build_xmp(factx, level, pdf_metadata)),
+            ('template', original)):
+        pdfwriter.XMPTemplate.render = render
+        elapsed = timeit.timeit(
+            lambda: factx.write_pdf(BytesIO(), incremental=True), number=WRITES)
+        print('%-9s %8.2f ms/incremental write' % (name, elapsed / WRITES * 1e3))
+    pdfwriter.XMPTemplate.render = original
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,574 @@
+"""
+Headless command line interface, without the PyQt GUI.
+
+Runs over PDF files, directories (searched recursively) and glob patterns,
+on a pool of worker processes. One JSON line is written per file as soon
+as it is done, so the output can be piped while the run goes on:
+
+    $ invoicex validate invoices/ 'archive/**/*.pdf'
+    $ invoicex extract -j 8 invoices/ > fields.jsonl
+    $ invoicex embed invoices/ --xml-dir xml/ --output-dir out/
+    $ invoicex scan incoming/
+
+With --journal, an interrupted or repeated run skips the files which are
+done and unchanged. Each file gets --timeout seconds (600 by default) and
+optionally each worker --memory-limit MB; files exceeding them, or
+crashing their worker, are listed with the reason in the --quarantine file
+while the others go on. The journal skips them too, until the limits change.
+
+With --shard K/N, nodes share an archive without coordination, each running
+the same command line with its own K. --shard-by content, for nodes which
+see the files under different paths, reads every file of the archive in
+full on every node before the workers start. The reports are then combined:
+
+    $ invoicex validate archive/ --shard 2/3 -o report-2.jsonl
+    $ invoicex merge report-1.jsonl report-2.jsonl report-3.jsonl
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+
+from .facturx.batch import BatchEmbedder
+from .facturx.cache import FacturXCache
+from .facturx.facturx import FacturX
+from .facturx.flavors import xml_flavor
+from .facturx.journal import BatchJournal, file_digest, is_done, \
+    is_quarantined, settings_key
+from .facturx.locator import read_embedded_file
+from .facturx.pdfsource import open_pdf
+from .facturx.scan import scan_pdf
+from .facturx.workers import SupervisedPool, limits_memory
+
+__all__ = ['iter_paths', 'merge_reports', 'run', 'main', 'select_shard',
+           'shard_of']
+
+
+# Same test as glob's, which doesn't expose it publicly.
+_GLOB_MAGIC = re.compile('[*?[]')
+
+
+def _is_pdf(path):
+    return path.lower().endswith('.pdf')
+
+
+def _iter_directory(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if _is_pdf(name):
+                yield os.path.join(root, name)
+
+
+def iter_paths(patterns):
+    """Yield the PDF files named by paths, directories or glob patterns.
+
+    Directories are walked recursively for *.pdf files, globs support `**`.
+    Paths are yielded lazily and at most once.
+    """
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = _iter_directory(pattern)
+        elif _GLOB_MAGIC.search(pattern):
+            paths = (path for path in sorted(glob.iglob(pattern, recursive=True))
+                     if os.path.isfile(path))
+        else:
+            paths = [pattern]
+        for path in paths:
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+
+def _embedded_facturx(path, cache):
+    """Return the embedded file of `path` and a FacturX built from its XML
+    alone, without parsing the whole PDF."""
+    pdf, owns_pdf = open_pdf(path)
+    try:
+        embedded = read_embedded_file(pdf)
+    finally:
+        if owns_pdf:
+            pdf.close()
+    if embedded is None:
+        raise ValueError('No embedded Factur-X or ZUGFeRD XML found.')
+    return embedded, FacturX.from_xml(
+        embedded.data, validation='deferred', cache=cache)
+
+
+def validate(path, options, state):
+    embedded, factx = _embedded_facturx(path, state.get('cache'))
+    valid = factx.is_valid()
+    return {'flavor': factx.flavor.name, 'level': factx.flavor.level,
+            'valid': valid, 'checksum_verified': embedded.checksum_matches,
+            'errors': factx.errors}
+
+
+def extract(path, options, state):
+    embedded, factx = _embedded_facturx(path, state.get('cache'))
+    return {'flavor': factx.flavor.name, 'level': factx.flavor.level,
+            'fields': factx.to_dict()}
+
+
+def _xml_path(path, options):
+    xml_dir = options.get('xml_dir') or os.path.dirname(path)
+    return os.path.join(
+        xml_dir, os.path.splitext(os.path.basename(path))[0] + '.xml')
+
+
+def embed(path, options, state):
+    output = state['embedder'].embed(
+        {'pdf': path, 'xml': _xml_path(path, options)})
+    return {'output': output}
+
+
+def scan(path, options, state):
+    return scan_pdf(path)._asdict()
+
+
+COMMANDS = {'validate': validate, 'extract': extract, 'embed': embed,
+            'scan': scan}
+
+
+def _sidecars(command, path, options):
+    """Return the paths of the files `command` reads along with `path`."""
+    if command == 'embed':
+        return [_xml_path(path, options)]
+    return []
+
+
+def _warm(command, options):
+    """Build what `command` needs once, before the first file."""
+    xml_flavor.logger.disabled = True
+    state = {}
+    if command == 'embed':
+        state['embedder'] = BatchEmbedder(
+            options['output_dir'], options.get('compress', False))
+    elif command != 'scan':
+        xml_flavor.warm_schema_cache()
+    if options.get('cache_dir'):
+        state['cache'] = FacturXCache(options['cache_dir'])
+    return state
+
+
+def _process(command, path, options, state):
+    try:
+        result = COMMANDS[command](path, options, state)
+        result['ok'] = True
+    except MemoryError:
+        # Left to the worker pool, which replaces the worker.
+        raise
+    except Exception as e:
+        result = {'ok': False, 'error': str(e)}
+    result['file'] = path
+    return result
+
+
+def _skipped(entry):
+    result = dict(entry['result'])
+    result.pop('limits', None)
+    result['skipped'] = True
+    return result
+
+
+def _stats(paths):
+    """Return [(path, size, mtime_ns)] of `paths`. Raises OSError."""
+    stats = []
+    for path in paths:
+        stat = os.stat(path)
+        stats.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return stats
+
+
+def _fingerprint(command, path, options):
+    """Return (size, mtime_ns, digest, sidecars) of an input, where the
+    digest covers the sidecars too. Raises OSError."""
+    sidecars = _stats(_sidecars(command, path, options))
+    stat = os.stat(path)
+    digest = file_digest(path)
+    if sidecars:
+        combined = hashlib.sha256(digest.encode('ascii'))
+        for sidecar in sidecars:
+            combined.update(file_digest(sidecar[0]).encode('ascii'))
+        digest = combined.hexdigest()
+    return stat.st_size, stat.st_mtime_ns, digest, sidecars
+
+
+def _process_job(command, job, options, state):
+    """Process a (path, journaled, entry, unchanged) job, where `entry` is
+    the journal entry which can be reused if the input is unchanged.
+
+    Returns (result, fingerprint), where fingerprint is (size, mtime_ns,
+    digest, sidecars) of a journaled input, to record it.
+    """
+    path, journaled, entry, unchanged = job
+    if unchanged:
+        return _skipped(entry), None
+    if not journaled:
+        return _process(command, path, options, state), None
+    try:
+        fingerprint = _fingerprint(command, path, options)
+    except OSError:
+        return _process(command, path, options, state), None
+    if entry is not None and entry['digest'] == fingerprint[2]:
+        return _skipped(entry), fingerprint
+    return _process(command, path, options, state), fingerprint
+
+
+def _jobs(command, paths, options, entries, limits):
+    for path in paths:
+        if entries is None:
+            yield path, False, None, False
+            continue
+        entry = entries.get(os.path.abspath(path))
+        if not (is_done(entry) or is_quarantined(entry, limits)):
+            entry = None
+        unchanged = False
+        if entry is not None:
+            try:
+                stat = os.stat(path)
+                sidecars = _stats(_sidecars(command, path, options))
+            except OSError:
+                pass
+            else:
+                unchanged = (stat.st_size, stat.st_mtime_ns, sidecars) == \
+                    (entry['size'], entry['mtime_ns'], entry['sidecars'])
+        yield path, True, entry, unchanged
+
+
+# State of the current worker process, built by _init_worker.
+_worker = None
+
+
+def _init_worker(command, options):
+    global _worker
+    _worker = (command, options, _warm(command, options))
+
+
+def _process_in_worker(job):
+    command, options, state = _worker
+    return _process_job(command, job, options, state)
+
+
+def _results(command, jobs, options, processes, limits):
+    if processes == 1 and not (limits.get('timeout') or
+                               limits.get('memory_limit')):
+        state = _warm(command, options)
+        for job in jobs:
+            yield _process_job(command, job, options, state)
+        return
+
+    def quarantined(job, reason):
+        path, journaled = job[:2]
+        fingerprint = None
+        if journaled:
+            # Hashed here, as the worker was killed.
+            try:
+                fingerprint = _fingerprint(command, path, options)
+            except OSError:
+                pass
+        return {'ok': False, 'error': reason, 'quarantined': True,
+                'file': path}, fingerprint
+
+    pool = SupervisedPool(processes, _init_worker, (command, options),
+                          **limits)
+    for item in pool.imap_unordered(_process_in_worker, jobs, quarantined):
+        yield item
+
+
+def run(command, paths, options=None, processes=None, journal=None,
+        timeout=None, memory_limit=None, max_tasks=None):
+    """Yield a result dict per path, in completion order.
+
+    With `processes` set to 1 the files are processed in this process,
+    otherwise on a pool of `processes` workers (default: one per core).
+
+    Each file gets `timeout` seconds and each worker `memory_limit` bytes
+    of address space, and workers are replaced after `max_tasks` files.
+    A file which exceeds a limit or crashes its worker gets a failed
+    result with 'quarantined' set, and the other files go on.
+
+    With a BatchJournal, inputs done by an earlier run with the same
+    command and options are skipped, their recorded result is yielded with
+    'skipped' set. So are quarantined inputs, unless `timeout` or
+    `memory_limit` changed. Unchanged inputs cost a stat, touched ones a
+    hash. The XML files embedded by 'embed' count as part of their PDF.
+    """
+    options = options or {}
+    entries = settings = None
+    if journal is not None:
+        settings = settings_key(command, dict(
+            (key, value) for key, value in options.items()
+            if key != 'cache_dir'))
+        entries = journal.entries(settings)
+
+    limits = {'timeout': timeout, 'memory_limit': memory_limit,
+              'max_tasks': max_tasks}
+    # The limits a file was quarantined with, to retry it with others.
+    quarantine_limits = {'timeout': timeout, 'memory_limit': memory_limit}
+    for result, fingerprint in _results(
+            command,
+            _jobs(command, paths, options, entries, quarantine_limits),
+            options, processes, limits):
+        if fingerprint is not None:
+            size, mtime_ns, digest, sidecars = fingerprint
+            recorded = dict(result)
+            recorded.pop('skipped', None)
+            if result.get('quarantined'):
+                recorded['limits'] = quarantine_limits
+            journal.record(result['file'], settings, size, mtime_ns, digest,
+                           recorded, sidecars)
+        yield result
+
+
+def shard_of(path, count, by='path'):
+    """Return the 0-based shard of `path` among `count` shards.
+
+    Shards are based on SHA-256, of the path as given or of the file
+    content, so every node computes the same partition. By content, each
+    node reads all files, not only those of its shard, in the calling
+    process: it costs a full serial read of the input.
+    """
+    if by == 'content':
+        key = bytes.fromhex(file_digest(path))
+    else:
+        key = hashlib.sha256(
+            os.path.normpath(path).replace(os.sep, '/').encode(
+                'utf-8', 'surrogateescape')).digest()
+    return int.from_bytes(key[:8], 'big') % count
+
+
+def select_shard(paths, index, count, by='path', stats=None):
+    """Yield the paths of the 0-based shard `index`, counting all paths seen
+    in stats['total'] and the selected ones in stats['inputs']."""
+    stats = stats if stats is not None else {}
+    stats.setdefault('total', 0)
+    stats.setdefault('inputs', 0)
+    for path in paths:
+        stats['total'] += 1
+        if shard_of(path, count, by) == index:
+            stats['inputs'] += 1
+            yield path
+
+
+STAT_KEYS = ('ok', 'failed', 'invalid', 'skipped')
+
+
+def _count(stats, result):
+    stats['ok' if result['ok'] else 'failed'] += 1
+    if result.get('valid') is False:
+        stats['invalid'] += 1
+    if result.get('skipped'):
+        stats['skipped'] += 1
+
+
+def merge_reports(reports, output):
+    """Combine the JSON Lines reports of all shards of a run into `output`.
+
+    Results are written sorted by file, followed by a summary line with the
+    statistics summed over the shards. Returns the list of problems found:
+    missing or repeated shards, reports of different runs, files reported
+    more than once or not as many as the shards selected.
+    """
+    problems = []
+    summaries = []
+    results = {}
+    for report in reports:
+        summary = None
+        count = 0
+        with open(report) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if 'summary' in record:
+                    summary = record['summary']
+                    continue
+                count += 1
+                if record['file'] in results:
+                    problems.append('%s: %s was already reported' % (
+                        report, record['file']))
+                results[record['file']] = record
+        if summary is None or 'shard' not in summary:
+            problems.append('%s: no shard summary, the run may be unfinished' % report)
+            continue
+        if count != summary['inputs']:
+            problems.append('%s: %d results for %d inputs' % (
+                report, count, summary['inputs']))
+        summaries.append(summary)
+
+    merged = {'inputs': len(results)}
+    merged.update((key, 0) for key in STAT_KEYS)
+    if summaries:
+        first = summaries[0]
+        for key in ('count', 'by', 'command', 'total'):
+            if any(summary[key] != first[key] for summary in summaries):
+                problems.append('reports disagree on %s' % key)
+        shards = sorted(summary['shard'] for summary in summaries)
+        if shards != list(range(1, first['count'] + 1)):
+            problems.append('shards %s of %d' % (
+                ', '.join(map(str, shards)), first['count']))
+        if len(results) != first['total']:
+            problems.append('%d of %d inputs reported' % (
+                len(results), first['total']))
+        merged.update(command=first['command'], total=first['total'],
+                      shards=first['count'])
+        for summary in summaries:
+            for key in STAT_KEYS:
+                merged[key] += summary[key]
+    merged['complete'] = not problems
+
+    for path in sorted(results):
+        output.write(json.dumps(results[path], sort_keys=True) + '\n')
+    output.write(json.dumps({'summary': merged}, sort_keys=True) + '\n')
+    return problems
+
+
+def _shard_arg(value):
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected K/N, got '%s'" % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('K must be between 1 and N')
+    return index, count
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='invoicex',
+        description='Validate, extract or embed Factur-X and ZUGFeRD XML '
+                    'in PDF invoices.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('paths', nargs='+',
+                        help='PDF files, directories or glob patterns')
+    common.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    common.add_argument('-o', '--output', default='-',
+                        help='JSON Lines output file (default: stdout)')
+    common.add_argument('--cache-dir',
+                        help='reuse validation results stored in this directory')
+    common.add_argument('--journal',
+                        help='record processed files in this file, and skip '
+                             'the unchanged ones done by earlier runs')
+    common.add_argument('--timeout', type=float, default=600,
+                        metavar='SECONDS',
+                        help='time allowed per file, 0 for none (default: 600)')
+    common.add_argument('--memory-limit', type=int, metavar='MB',
+                        help='address space allowed per worker process')
+    common.add_argument('--max-tasks-per-child', type=int, metavar='N',
+                        help='replace each worker process after N files')
+    common.add_argument('--quarantine', metavar='FILE',
+                        help='append the files which exceeded a limit or '
+                             'crashed a worker, with the reason, to this '
+                             'JSON Lines file')
+    common.add_argument('--shard', type=_shard_arg, metavar='K/N',
+                        help='only process the K-th of N shards of the files')
+    common.add_argument('--shard-by', choices=['path', 'content'],
+                        default='path',
+                        help='hash the paths as given (default) or the file '
+                             'contents to assign shards; contents are read '
+                             'in full for every file, serially, on each node')
+
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser(
+        'validate', parents=[common],
+        help='validate the embedded XML against its XSD and required fields')
+    commands.add_parser(
+        'extract', parents=[common], help='extract the fields of the embedded XML')
+    embed_parser = commands.add_parser(
+        'embed', parents=[common],
+        help='embed <name>.xml into each <name>.pdf')
+    embed_parser.add_argument(
+        '--xml-dir', help='directory of the XML files (default: next to each PDF)')
+    embed_parser.add_argument('--output-dir', required=True)
+    embed_parser.add_argument('--compress', action='store_true')
+    commands.add_parser(
+        'scan', parents=[common],
+        help='tell the flavor and level of the embedded XML, without '
+             'validating it')
+    merge_parser = commands.add_parser(
+        'merge', help='combine the reports of all shards of a run and check '
+                      'that every file was covered once')
+    merge_parser.add_argument('reports', nargs='+')
+    merge_parser.add_argument('-o', '--output', default='-',
+                              help='merged report (default: stdout)')
+    return parser
+
+
+def _open_output(path):
+    return sys.stdout if path == '-' else open(path, 'w')
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.command == 'merge':
+        output = _open_output(args.output)
+        try:
+            problems = merge_reports(args.reports, output)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        for problem in problems:
+            sys.stderr.write('invoicex merge: %s\n' % problem)
+        return 1 if problems else 0
+
+    if args.memory_limit and not limits_memory():
+        parser.error('--memory-limit is not supported on this platform')
+    limits = {
+        'timeout': args.timeout or None,
+        'memory_limit': args.memory_limit and args.memory_limit * 1024 ** 2,
+        'max_tasks': args.max_tasks_per_child}
+    options = {'cache_dir': args.cache_dir}
+    if args.command == 'embed':
+        options.update(xml_dir=args.xml_dir, output_dir=args.output_dir,
+                       compress=args.compress)
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+
+    paths = iter_paths(args.paths)
+    shard_stats = {}
+    if args.shard:
+        index, count = args.shard
+        paths = select_shard(paths, index - 1, count, args.shard_by, shard_stats)
+
+    journal = BatchJournal(args.journal) if args.journal else None
+    output = _open_output(args.output)
+    quarantine = None
+    stats = dict((key, 0) for key in STAT_KEYS)
+    try:
+        for result in run(args.command, paths, options, args.processes,
+                          journal, **limits):
+            _count(stats, result)
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+            if result.get('quarantined') and args.quarantine and \
+                    not result.get('skipped'):
+                if quarantine is None:
+                    quarantine = open(args.quarantine, 'a')
+                quarantine.write(json.dumps(
+                    {'file': result['file'], 'reason': result['error'],
+                     'command': args.command}, sort_keys=True) + '\n')
+                quarantine.flush()
+        if args.shard:
+            stats.update(shard_stats, shard=index, count=count,
+                         by=args.shard_by, command=args.command)
+            output.write(json.dumps({'summary': stats}, sort_keys=True) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if quarantine is not None:
+            quarantine.close()
+        if journal is not None:
+            journal.close()
+    return 1 if stats['failed'] or stats['invalid'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Embed XML into many PDFs on a process pool.
+
+A manifest lists one job per line, as JSON Lines. Each job names the
+source PDF and either an XML file or a dict of field values, which fills
+the template of the given flavor and level (see generator.XMLGenerator):
+
+    {"pdf": "in/1.pdf", "xml": "in/1.xml", "output": "out/1.pdf"}
+    {"pdf": "in/2.pdf", "fields": {"invoice_number": "INV-2"}, "level": "basic"}
+
+Without "output", the PDF is written to the output directory under its
+own name. Every XML is validated against its XSD before the PDF is
+written, and jobs failing validation produce no output.
+
+    $ python -m invoicex.facturx.batch manifest.jsonl --output-dir out/
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+from collections import namedtuple
+
+from .facturx import FacturX
+from .flavors import xml_flavor
+from .generator import XMLGenerator, read_rows
+from .logger import logger
+from .pdfwriter import XMPTemplate
+
+__all__ = ['BatchResult', 'BatchEmbedder', 'embed_parallel']
+
+# One result per job. output is None if nothing was written.
+BatchResult = namedtuple('BatchResult', 'index pdf output errors')
+
+
+def _levels():
+    for flavor, details in xml_flavor.FLAVORS.items():
+        if flavor in xml_flavor.FIELD_XPATHS:
+            for level in details.get('levels', {}):
+                yield flavor, level
+
+
+class BatchEmbedder(object):
+    """Run manifest jobs, writing the PDFs with FacturXPDFWriter.
+
+    `warm` builds the XMP templates, compiled schemas and field setters of
+    every flavor and level up front, so the cost isn't paid by the first
+    jobs of each kind.
+    """
+
+    def __init__(self, output_dir=None, compress=False, warm=True):
+        self.output_dir = output_dir
+        self.compress = compress
+        self._generators = {}
+        if warm:
+            for flavor, level in _levels():
+                self.generator(flavor, level)
+                XMPTemplate.for_flavor(
+                    xml_flavor.XMLFlavor(xml_flavor.get_template(flavor, level)))
+            xml_flavor.warm_schema_cache()
+
+    def generator(self, flavor, level):
+        """Return the XMLGenerator of flavor and level, built once."""
+        generator = self._generators.get((flavor, level))
+        if generator is None:
+            generator = XMLGenerator(flavor, level, validate=False)
+            self._generators[(flavor, level)] = generator
+        return generator
+
+    def output_path(self, job):
+        if job.get('output'):
+            return job['output']
+        if self.output_dir is None:
+            raise ValueError('The job has no "output" and there is no output directory.')
+        return os.path.join(self.output_dir, os.path.basename(job['pdf']))
+
+    def embed(self, job):
+        """Validate the XML of `job` and write its PDF.
+
+        Returns the output path. Raises like FacturX if the XML is invalid.
+        """
+        if ('xml' in job) == ('fields' in job):
+            raise ValueError('The job needs either "xml" or "fields".')
+        output = self.output_path(job)
+        # The XML already in the PDF is replaced, don't validate it.
+        with FacturX(job['pdf'], validation='none') as factx:
+            if 'xml' in job:
+                factx.read_xml(job['xml'])
+            else:
+                generator = self.generator(
+                    job.get('flavor', 'factur-x'), job.get('level', 'minimum'))
+                factx.read_xml(generator.build(job['fields']))
+            factx.flavor.check_xsd(factx.xml)
+            factx.write_pdf(output, compress=self.compress)
+        return output
+
+    def run(self, index, job):
+        """Run one job, catching its errors into the BatchResult."""
+        try:
+            return BatchResult(index, job.get('pdf'), self.embed(job), [])
+        except Exception as e:
+            return BatchResult(index, job.get('pdf'), None, [str(e)])
+
+
+# Embedder of the current worker process, built by _init_worker.
+_worker_embedder = None
+
+
+def _init_worker(output_dir, compress):
+    global _worker_embedder
+    xml_flavor.logger.disabled = True
+    _worker_embedder = BatchEmbedder(output_dir, compress)
+
+
+def _run_in_worker(item):
+    return _worker_embedder.run(*item)
+
+
+def embed_parallel(jobs, output_dir=None, compress=False, processes=None,
+                   chunksize=4):
+    """Yield a BatchResult per job, in order, running them on a pool of
+    `processes` workers (default: one per core)."""
+    pool = multiprocessing.Pool(
+        processes, _init_worker, (output_dir, compress))
+    try:
+        for result in pool.imap(_run_in_worker, enumerate(jobs), chunksize):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m invoicex.facturx.batch',
+        description='Embed XML files or field values into PDFs.')
+    parser.add_argument('manifest', help='JSON Lines file of jobs')
+    parser.add_argument('--output-dir',
+                        help='directory for jobs without "output"')
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    failed = 0
+    results = embed_parallel(
+        read_rows(args.manifest, 'jsonl'), args.output_dir, args.compress,
+        args.processes)
+    for result in results:
+        if result.errors:
+            failed += 1
+            logger.error('%s: %s', result.pdf, result.errors[0])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
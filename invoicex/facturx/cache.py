@@ -0,0 +1,168 @@
+"""
+On-disk cache of validation results and extracted fields.
+
+Entries are keyed by the SHA-256 digest of the embedded XML bytes and of
+the rules it is checked against (library version, field paths and XSD
+files), together with the flavor and level it is validated against. Opening
+the same invoice again can then skip XSD validation and field extraction.
+
+Inspect or clear the cache from the command line:
+
+    $ python -m invoicex.facturx.cache info
+    $ python -m invoicex.facturx.cache clear
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from .logger import logger
+
+__all__ = ['FacturXCache']
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'invoicex')
+
+
+class FacturXCache(object):
+    """SQLite store of validation verdicts, errors and field dicts.
+
+    When the payload stored exceeds `max_size` bytes, least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_size = max_size
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.path = os.path.join(self.cache_dir, 'facturx.sqlite3')
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Connect lazily, so instances can be handed to worker processes.
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                ' digest TEXT NOT NULL,'
+                ' flavor TEXT NOT NULL,'
+                ' level TEXT NOT NULL,'
+                ' schema_valid INTEGER NOT NULL,'
+                ' valid INTEGER NOT NULL,'
+                ' errors TEXT NOT NULL,'
+                ' fields TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' accessed REAL NOT NULL,'
+                ' PRIMARY KEY (digest, flavor, level))')
+            self._conn.commit()
+        return self._conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    def get(self, digest, flavor, level):
+        """Return the cached entry as a dict, or None."""
+        row = self.conn.execute(
+            'SELECT schema_valid, valid, errors, fields FROM entries'
+            ' WHERE digest = ? AND flavor = ? AND level = ?',
+            (digest, flavor, level)).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute(
+                'UPDATE entries SET accessed = ?'
+                ' WHERE digest = ? AND flavor = ? AND level = ?',
+                (time.time(), digest, flavor, level))
+        logger.debug('Cache hit for %s', digest)
+        return {
+            'schema_valid': bool(row[0]),
+            'valid': bool(row[1]),
+            'errors': json.loads(row[2]),
+            'fields': json.loads(row[3]),
+            }
+
+    def put(self, digest, flavor, level, schema_valid, valid, errors, fields):
+        errors_json = json.dumps(errors)
+        fields_json = json.dumps(fields, sort_keys=True)
+        size = len(digest) + len(errors_json) + len(fields_json)
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (digest, flavor, level, int(schema_valid), int(valid),
+                 errors_json, fields_json, size, time.time()))
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_size."""
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_size:
+            return 0
+        evicted = 0
+        with self.conn:
+            rows = self.conn.execute(
+                'SELECT digest, flavor, level, size FROM entries'
+                ' ORDER BY accessed').fetchall()
+            for digest, flavor, level, size in rows:
+                if total <= self.max_size:
+                    break
+                self.conn.execute(
+                    'DELETE FROM entries'
+                    ' WHERE digest = ? AND flavor = ? AND level = ?',
+                    (digest, flavor, level))
+                total -= size
+                evicted += 1
+        logger.debug('Evicted %d cache entries', evicted)
+        return evicted
+
+    def info(self):
+        entries, size = self.conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'path': self.path,
+            'entries': entries,
+            'size': size,
+            'max_size': self.max_size,
+            }
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM entries')
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Inspect or clear the Factur-X validation cache.')
+    parser.add_argument('command', choices=['info', 'clear'])
+    parser.add_argument('--cache-dir', help='defaults to %s' % default_cache_dir())
+    args = parser.parse_args(argv)
+
+    cache = FacturXCache(args.cache_dir)
+    if args.command == 'clear':
+        cache.clear()
+    info = cache.info()
+    for key in ('path', 'entries', 'size', 'max_size'):
+        print('%-9s %s' % (key + ':', info[key]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
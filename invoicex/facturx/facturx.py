@@ -2,20 +2,22 @@ import io
 import os
 import yaml
 import codecs
-from io import BytesIO
 from lxml import etree
 from tempfile import NamedTemporaryFile
 from datetime import datetime
 import os.path
 import mimetypes
 import hashlib
-from PyPDF2 import PdfFileReader
-from PyPDF2.generic import IndirectObject
 import json
+from PyPDF2 import PdfFileReader
 
 from .flavors import xml_flavor
+from .locator import (
+    embedded_file_from_reader, read_embedded_file, read_embedded_xml)
 from .logger import logger
-from .pdfwriter import FacturXPDFWriter
+from .pdfsink import open_output
+from .pdfsource import buffer_types, is_mapped_from, open_pdf, path_types
+from .pdfwriter import FacturXIncrementalWriter, FacturXPDFWriter
 
 # Python 2 and 3 compat
 try:
@@ -26,6 +28,39 @@ unicode = str
 
 __all__ = ['FacturX']
 
+# When to run the XSD validation of a FacturX instance:
+# - eager: on construction, raising if the XML is invalid.
+# - deferred: on the first is_valid() call, caching the result until a
+#   field is changed.
+# - none: only when is_valid() is called.
+VALIDATION_MODES = ('eager', 'deferred', 'none')
+
+
+def _read_xml_input(xml):
+    """Return the bytes of XML given as bytes, a path or a binary file object."""
+    if isinstance(xml, path_types):
+        with open(os.fspath(xml), 'rb') as f:
+            return f.read()
+    elif isinstance(xml, buffer_types):
+        return bytes(xml)
+    elif hasattr(xml, 'read'):
+        return xml.read()
+    raise TypeError(
+        "The XML must be bytes, a path or a binary file (it is a %s)." % type(xml))
+
+
+# Invoices come from third parties: don't expand entities or fetch DTDs.
+_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
+
+def _parse_xml(xml_bytes):
+    return etree.fromstring(xml_bytes, parser=_XML_PARSER)
+
+
+# Attributes set by FacturX._load_xml.
+_XML_STATE = ('xml', 'flavor', '_namespaces', 'errors', '_valid',
+              '_schema_valid', '_fields', '_cache_key', '_updated_xml')
+
 
 class FacturX(object):
     """Represents an electronic PDF invoice with embedded XML metadata following the
@@ -38,66 +73,158 @@ class FacturX(object):
 
     Attributes:
     - xml: xml tree of machine-readable representation.
-    - pdf: underlying graphical PDF representation.
+    - pdf: underlying graphical PDF representation, as a seekable file object.
+      Accepted inputs are paths (str or pathlib), bytes-like objects, binary
+      file objects and PdfFileReader instances. None for instances built
+      with from_xml().
+    - reader: the PdfFileReader passed in, or the one built on the first
+      write_pdf(). Shared with FacturXPDFWriter so the PDF is parsed once.
     - flavor: which flavor (Factur-x or Zugferd) to use.
+    - validation: one of VALIDATION_MODES.
+    - cache: optional cache.FacturXCache, used to skip validation and field
+      extraction of embedded XML seen before.
+    - errors: validation errors found by the last validation.
+    - checksum_verified: whether the embedded XML as read matches the MD5
+      /CheckSum stored with it, i.e. is unchanged since it was written.
+      None if there is no embedded XML or no checksum, or after read_xml().
     """
 
-    def __init__(self, pdf_invoice, flavor='factur-x', level='minimum'):
-        # Read PDF from path, pointer or string
-        if isinstance(pdf_invoice, str) and pdf_invoice.endswith('.pdf') and os.path.isfile(pdf_invoice):
-            with open(pdf_invoice, 'rb') as f:
-                pdf_file = BytesIO(f.read())
-        elif isinstance(pdf_invoice, str):
-            pdf_file = BytesIO(pdf_invoice)
-        elif isinstance(pdf_invoice, file_types):
-            pdf_file = pdf_invoice
-        else:
-            raise TypeError(
-                "The first argument of the method get_facturx_xml_from_pdf must "
-                "be either a string or a file (it is a %s)." % type(pdf_invoice))
+    def __init__(self, pdf_invoice, flavor='factur-x', level='minimum', validation='eager', cache=None):
+        self._init_state(validation, cache)
 
-        xml = self._xml_from_file(pdf_file)
+        # Read PDF from an already parsed reader, or from path, buffer or
+        # file object. Paths are memory-mapped.
+        if isinstance(pdf_invoice, PdfFileReader):
+            self.reader = pdf_invoice
+            pdf_file, self._owns_pdf = pdf_invoice.stream, False
+            embedded = embedded_file_from_reader(pdf_invoice)
+        else:
+            pdf_file, self._owns_pdf = open_pdf(pdf_invoice)
+            embedded = read_embedded_file(pdf_file)
         self.pdf = pdf_file
+        xml_bytes = embedded.data if embedded is not None else None
+        self.checksum_verified = \
+            embedded.checksum_matches if embedded is not None else None
 
         # PDF has metadata embedded
-        if xml is not None:
-            self.xml = xml
-            self.flavor = xml_flavor.XMLFlavor(xml)
+        if xml_bytes is not None:
+            self._load_xml(xml_bytes)
             logger.info('Read existing XML from PDF. Flavor: %s', self.flavor.name)
         # No metadata embedded. Create from template.
         else:
             self.flavor, self.xml = xml_flavor.XMLFlavor.from_template(flavor, level)
+            self._namespaces = self.xml.nsmap
             logger.info('PDF does not have XML embedded. Adding from template.')
+            if validation == 'eager':
+                # Templates are validated once per process, not per copy.
+                xml_flavor.check_template(flavor, level)
 
-        self.flavor.check_xsd(self.xml)
+    @classmethod
+    def from_xml(cls, xml, validation='eager', cache=None):
+        """Build a FacturX instance from a Factur-X or ZUGFeRD XML alone.
+
+        `xml` is the XML as bytes, a path or a binary file object. No PDF is
+        read, so write_pdf() is unavailable until a PDF is attached by
+        constructing from one instead.
+        """
+        self = cls.__new__(cls)
+        self._init_state(validation, cache)
+        self.pdf = None
+        self._owns_pdf = False
+        self.checksum_verified = None
+        self._load_xml(_read_xml_input(xml))
+        logger.info('Read XML. Flavor: %s', self.flavor.name)
+        return self
+
+    def _init_state(self, validation, cache):
+        if validation not in VALIDATION_MODES:
+            raise ValueError(
+                "validation must be one of %s (it is %r)." % (
+                    ', '.join(VALIDATION_MODES), validation))
+        self.validation = validation
+        self.cache = cache
+        self.reader = None
+        self.errors = []
+        self._valid = None
+        self._schema_valid = None
+        self._fields = None
+        self._cache_key = None
+        # (tree, serialization) validated by update(), see is_valid().
+        self._updated_xml = None
+
+    def _load_xml(self, xml_bytes, xml=None):
+        """Parse xml_bytes as the XML of this invoice, then look it up in the
+        cache or validate it according to the validation mode.
+
+        An already parsed `xml` tree is used as is, without the cache.
+        """
+        self.xml = _parse_xml(xml_bytes) if xml is None else xml
+        self.flavor = xml_flavor.XMLFlavor(self.xml)
         self._namespaces = self.xml.nsmap
 
-    def read_xml(self):
-        """Use XML data from external file. Replaces existing XML or template."""
-        pass
+        if self.cache is not None and xml_bytes is not None:
+            # Verdicts and fields depend on the schemas and field paths too.
+            digest = hashlib.sha256(
+                xml_flavor.rules_fingerprint(self.flavor.name).encode('ascii'))
+            digest.update(xml_bytes)
+            self._cache_key = (
+                digest.hexdigest(), self.flavor.name, self.flavor.level)
+            entry = self.cache.get(*self._cache_key)
+            if entry is not None:
+                self._schema_valid = entry['schema_valid']
+                self._valid = entry['valid']
+                self.errors = entry['errors']
+                self._fields = entry['fields']
+            elif self.validation == 'eager':
+                self._validate()
+                self._store_in_cache()
+            if self.validation == 'eager' and not self._schema_valid:
+                raise xml_flavor.XSDValidationError(self.errors[0])
+        elif self.validation == 'eager':
+            self.flavor.check_xsd(self.xml)
+
+    def close(self):
+        """Release the PDF input, if it was opened by this instance."""
+        if self._owns_pdf:
+            self.pdf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_xml(self, xml):
+        """Use XML data from external file. Replaces existing XML or template.
+
+        `xml` is the XML as bytes, a path, a binary file object or an lxml
+        element, which is used without copying it. It is validated according
+        to the validation mode, like embedded XML.
+        """
+        # Parsed and validated aside, so rejected XML leaves this one intact.
+        loaded = self.__class__.__new__(self.__class__)
+        loaded._init_state(self.validation, self.cache)
+        if isinstance(xml, etree._Element):
+            loaded._load_xml(None, xml)
+        else:
+            loaded._load_xml(_read_xml_input(xml))
+        for name in _XML_STATE:
+            setattr(self, name, getattr(loaded, name))
+        # The checksum was of the embedded XML, which is gone.
+        self.checksum_verified = None
+        logger.info('Replaced XML. Flavor: %s', self.flavor.name)
 
     def _xml_from_file(self, pdf_file):
-        pdf = PdfFileReader(pdf_file)
-        pdf_root = pdf.trailer['/Root']
-        if '/Names' not in pdf_root or '/EmbeddedFiles' not in pdf_root['/Names']:
-            logger.info('No existing XML file found.')
+        xml_bytes = self._xml_bytes_from_file(pdf_file)
+        if xml_bytes is None:
             return None
+        return _parse_xml(xml_bytes)
 
-        for file in pdf_root['/Names']['/EmbeddedFiles']['/Names']:
-            if isinstance(file, IndirectObject):
-                obj = file.getObject()
-                if obj['/F'] in xml_flavor.valid_xmp_filenames():
-                    xml_root = etree.fromstring(obj['/EF']['/F'].getData())
-                    xml_content = xml_root
-                    xml_filename = obj['/F']
-                    logger.info(
-                        'A valid XML file %s has been found in the PDF file',
-                        xml_filename)
-                    return xml_content
+    def _xml_bytes_from_file(self, pdf_file):
+        return read_embedded_xml(pdf_file)
 
     def __getitem__(self, field_name):
-        path = self.flavor._get_xml_path(field_name)
-        value = self.xml.xpath(path, namespaces=self._namespaces)
+        value = self.flavor.get_xpath(field_name)(self.xml)
         if value is not None:
             value = value[0].text
         if 'date' in field_name:
@@ -105,8 +232,8 @@ class FacturX(object):
         return value
 
     def __setitem__(self, field_name, value):
-        path = self.flavor._get_xml_path(field_name)
-        res = self.xml.xpath(path, namespaces=self._namespaces)
+        self.invalidate()
+        res = self.flavor.get_xpath(field_name)(self.xml)
         if len(res) > 1:
             raise LookupError('Multiple nodes found for this path. Refusing to edit.')
 
@@ -118,6 +245,63 @@ class FacturX(object):
         else:
             res[0].text = value
 
+    def update(self, mapping, ignore_missing=False):
+        """Set several fields at once, all or nothing.
+
+        Every target node is looked up before anything is changed, then the
+        values are set and the XML is validated once. If it isn't valid
+        against the XSD, the previous values are restored and ValueError is
+        raised with the validation error. Otherwise `is_valid()` reuses the
+        result, as long as `xml` isn't changed in between.
+
+        Empty values for required fields raise ValueError, and fields
+        without a node in the XML raise KeyError, or are skipped with
+        `ignore_missing`, all before anything is changed.
+        """
+        changes = []
+        for field_name, value in mapping.items():
+            if value is None or value == '':
+                if xml_flavor.FIELDS.get(field_name, {}).get('_required'):
+                    raise ValueError(
+                        "Required field %s doesn't contain any value" % field_name)
+            res = self.flavor.get_xpath(field_name)(self.xml)
+            if len(res) > 1:
+                raise LookupError(
+                    "Multiple nodes found for field '%s'. Refusing to edit." % field_name)
+            if not len(res):
+                if ignore_missing:
+                    continue
+                raise KeyError("Field '%s' has no node in the XML." % field_name)
+            if 'date' in field_name:
+                assert isinstance(value, datetime), 'Please pass date values as DateTime() object.'
+                value = value.strftime('%Y%m%d')
+            changes.append((field_name, res[0], value))
+
+        previous = [(node, node.text, node.get('format'))
+                    for field_name, node, value in changes]
+        state = (self._valid, self._schema_valid, self._fields,
+                 self._cache_key, self.errors, self._updated_xml)
+        self.invalidate()
+        for field_name, node, value in changes:
+            if 'date' in field_name:
+                node.attrib['format'] = '102'
+            node.text = value
+        self._validate()
+        if self._schema_valid:
+            self._updated_xml = (self.xml, etree.tostring(self.xml))
+            return
+
+        error = self.errors[0]
+        for node, text, date_format in previous:
+            node.text = text
+            if date_format is None:
+                node.attrib.pop('format', None)
+            else:
+                node.attrib['format'] = date_format
+        (self._valid, self._schema_valid, self._fields,
+         self._cache_key, self.errors, self._updated_xml) = state
+        raise ValueError(error)
+
     def is_valid(self):
         """Make every effort to validate the current XML.
 
@@ -126,35 +310,109 @@ class FacturX(object):
         - XML is valid
         - ...
 
+        In deferred validation mode, or with a cache, the result is kept
+        until a field is set through dict access. Call `invalidate()` after
+        editing `xml` directly.
+
+        Otherwise the XML is validated on each call, unless it is unchanged
+        since `update()` validated it.
+
         Returns: true/false (validation passed/failed)
         """
+        if self.validation == 'deferred' or self._cache_key is not None:
+            if self._valid is None:
+                self._validate()
+                self._store_in_cache()
+            return self._valid
+        if self._updated_xml is not None:
+            tree, serialized = self._updated_xml
+            if tree is self.xml and etree.tostring(tree) == serialized:
+                return self._valid
+            self._updated_xml = None
+        return self._validate()
+
+    def invalidate(self):
+        """Drop the cached validation result and extracted fields."""
+        self._valid = None
+        self._schema_valid = None
+        self._fields = None
+        self._cache_key = None
+        self._updated_xml = None
+
+    def _store_in_cache(self):
+        if self._cache_key is not None:
+            self.cache.put(
+                *self._cache_key, schema_valid=self._schema_valid,
+                valid=self._valid, errors=self.errors,
+                fields=self._extract_fields())
+
+    def _validate(self):
+        self._valid = self._check()
+        return self._valid
+
+    def _check(self):
+        self.errors = []
+        self._schema_valid = False
         # validate against XSD
         try:
             self.flavor.check_xsd(self.xml)
-        except Exception:
+        except Exception as e:
+            self.errors.append(unicode(e))
             return False
+        self._schema_valid = True
 
         # Check for required fields
         fields_data = xml_flavor.FIELDS
         for field in fields_data.keys():
             if fields_data[field]['_required']:
-                r = self.xml.xpath(fields_data[field]['_path'][self.flavor.name], namespaces=self._namespaces)
+                r = self.flavor.get_xpath(field)(self.xml)
                 if not len(r):
                     logger.error("Required field '%s' is not present", field)
+                    self.errors.append("Required field '%s' is not present" % field)
                     return False
                 elif r[0].text is None:
                     logger.error("Required field %s doesn't contain any value", field)
+                    self.errors.append("Required field %s doesn't contain any value" % field)
                     return False
 
         return True
     
-    def write_pdf(self, path):
-        pdfwriter = FacturXPDFWriter(self)
-        with open(path, 'wb') as output_f:
-            pdfwriter.write(output_f)
+    def write_pdf(self, output, incremental=False, sha256=False, compress=False):
+        """Write the PDF with the XML embedded.
+
+        `output` is a path or any writable binary stream (stdout, sockets,
+        ...). Paths are replaced atomically through a temporary sibling
+        file, so it's safe to write over the input PDF. A memory-mapped
+        input is then copied into memory first, as mapped files can't be
+        replaced on Windows.
+
+        With `incremental`, the original PDF bytes are kept as they are and
+        the XML, metadata and updated catalog are appended as an
+        incremental update (see FacturXIncrementalWriter). Encrypted PDFs
+        can't be updated this way and raise ValueError.
+
+        With `compress`, the XML is serialized compactly and Flate-encoded.
+        Full rewrites additionally pack objects into object streams with a
+        cross-reference stream, which noticeably reduces the file size.
+
+        Returns the SHA-256 hex digest of the output, computed while writing,
+        if `sha256` is set, else True.
+        """
+        if self.pdf is None:
+            raise ValueError('No PDF to embed the XML in. Use write_xml() instead.')
+        if is_mapped_from(self.pdf, output):
+            self.pdf.copy_to_memory()
+        if incremental:
+            pdfwriter = FacturXIncrementalWriter(self, compress=compress)
+        else:
+            pdfwriter = FacturXPDFWriter(
+                self, reader=self.reader, compress=compress)
+            self.reader = pdfwriter.reader
+        with open_output(output, sha256) as output_stream:
+            pdfwriter.write(output_stream)
 
         logger.info('XML file added to PDF invoice')
-        return True
+        return output_stream.hexdigest() if sha256 else True
 
     @property
     def xml_str(self):
@@ -165,22 +423,59 @@ class FacturX(object):
         with open(path, 'wb') as f:
             f.write(self.xml_str)
 
-    def __make_dict(self):
-        fields_data = xml_flavor.FIELDS
-        flavor = self.flavor.name
+    def to_dict(self, missing=None):
+        """Return the value of every known field, resolved in one pass over the XML.
+
+        Fields without a matching node are set to `missing`, nodes without
+        text to None.
+        """
+        found = self._extract_fields()
+        return dict((field, found.get(field, missing)) for field in xml_flavor.FIELDS)
+
+    def _extract_fields(self):
+        """Return {field: text} for all fields with a matching node."""
+        if self._fields is not None:
+            return self._fields
+
+        lookup = xml_flavor.FIELD_TAG_PATHS[self.flavor.name]
+        absolute = lookup['absolute']
+        descendant = lookup['descendant']
+        suffix_lengths = lookup['suffix_lengths']
+        prefixes = lookup['prefixes']
+        remaining = sum(len(f) for f in absolute.values()) + \
+            sum(len(f) for f in descendant.values())
 
         output_dict = {}
-        for field in fields_data.keys():
-            try:
-                r = self.xml.xpath(fields_data[field]['_path'][flavor], namespaces=self._namespaces)
+        # Depth-first in document order, so the first match of each path
+        # wins, same as taking [0] of an XPath result.
+        stack = [(self.xml, (self.xml.tag,))]
+        while stack and remaining:
+            element, tags = stack.pop()
+            matches = absolute.get(tags, [])
+            for length in suffix_lengths:
+                matches = matches + descendant.get(tags[-length:], [])
+            for field in matches:
+                if field not in output_dict:
+                    output_dict[field] = element.text
+                    remaining -= 1
+            for child in reversed(element):
+                if not isinstance(child.tag, str):
+                    continue
+                child_tags = tags + (child.tag,)
+                # Without descendant paths, only subtrees on the way to an
+                # absolute path need to be visited.
+                if descendant or child_tags in prefixes:
+                    stack.append((child, child_tags))
+
+        for field in lookup['fallback']:
+            r = self.flavor.get_xpath(field)(self.xml)
+            if len(r):
                 output_dict[field] = r[0].text
-            except IndexError:
-                output_dict[field] = None
 
         return output_dict
 
     def write_json(self, json_file_path='output.json'):
-        json_output = self.__make_dict()
+        json_output = self.to_dict()
         # if self.is_valid():
         #     with open(json_file_path, 'w') as json_file:
         #         logger.info("Exporting JSON to %s", json_file_path)
@@ -191,7 +486,7 @@ class FacturX(object):
                 json.dump(json_output, json_file, indent=4, sort_keys=True)
 
     def write_yml(self, yml_file_path='output.yml'):
-        yml_output = self.__make_dict()
+        yml_output = self.to_dict()
         # if self.is_valid():
         #     with open(yml_file_path, 'w') as yml_file:
         #         logger.info("Exporting YAML to %s", yml_file_path)
@@ -0,0 +1,283 @@
+"""
+Build step rewriting the descendant-axis paths in fields.yml (`//rsm:...`)
+into absolute paths starting at the root element of each flavor.
+
+The element hierarchy is read from the bundled XSD files. A path is only
+rewritten if the XSDs of all levels of a flavor agree on a single absolute
+location, and if both paths select the same nodes in every sample invoice.
+
+Usage (from the `invoicex` directory):
+
+    $ python -m facturx.flavors.anchor_paths            # rewrite fields.yml
+    $ python -m facturx.flavors.anchor_paths --dry-run  # only report
+    $ python -m facturx.flavors.anchor_paths --check old_fields.yml
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import yaml
+from lxml import etree
+
+from . import xml_flavor
+
+XS = '{http://www.w3.org/2001/XMLSchema}'
+FLAVORS_DIR = os.path.dirname(__file__)
+FIELDS_FILE = os.path.join(FLAVORS_DIR, 'fields.yml')
+SAMPLES_DIR = os.path.join(FLAVORS_DIR, '..', 'tests', 'sample_invoices')
+
+
+def _qname(schema_root, value):
+    """Resolve a prefixed QName attribute value to Clark notation."""
+    prefix, sep, local_name = value.rpartition(':')
+    return '{%s}%s' % (schema_root.nsmap[prefix or None], local_name)
+
+
+def _collect_elements(node, schema_root, target_ns, children):
+    """Append (tag, type) of all element declarations below node."""
+    for child in node:
+        if child.tag == XS + 'element':
+            children.append((
+                '{%s}%s' % (target_ns, child.get('name')),
+                _qname(schema_root, child.get('type'))
+                if child.get('type') else None))
+        elif child.tag in (XS + 'sequence', XS + 'choice', XS + 'all'):
+            _collect_elements(child, schema_root, target_ns, children)
+
+
+def load_schema_tree(xsd_file):
+    """Read an XSD and its imports.
+
+    Returns the (tag, type) of the root elements, a mapping of complex
+    type names to the (tag, type) of their children, and a mapping of type
+    names to their base type for complexContent extensions.
+    """
+    roots, children, bases = [], {}, {}
+    main_file = os.path.abspath(xsd_file)
+    pending, seen = [main_file], set()
+    while pending:
+        filename = pending.pop()
+        if filename in seen:
+            continue
+        seen.add(filename)
+        schema_root = etree.parse(filename).getroot()
+        target_ns = schema_root.get('targetNamespace')
+        for node in schema_root:
+            if node.tag == XS + 'import' and node.get('schemaLocation'):
+                pending.append(os.path.join(
+                    os.path.dirname(filename), node.get('schemaLocation')))
+            elif node.tag == XS + 'element' and filename == main_file:
+                roots.append((
+                    '{%s}%s' % (target_ns, node.get('name')),
+                    _qname(schema_root, node.get('type'))))
+            elif node.tag == XS + 'complexType':
+                type_name = '{%s}%s' % (target_ns, node.get('name'))
+                type_children = children.setdefault(type_name, [])
+                _collect_elements(node, schema_root, target_ns, type_children)
+                for extension in node.iter(XS + 'extension'):
+                    if extension.getparent().tag == XS + 'complexContent':
+                        bases[type_name] = _qname(
+                            schema_root, extension.get('base'))
+                        _collect_elements(
+                            extension, schema_root, target_ns, type_children)
+    return roots, children, bases
+
+
+def _child_elements(type_name, children, bases):
+    result = []
+    while type_name is not None:
+        result = children.get(type_name, []) + result
+        type_name = bases.get(type_name)
+    return result
+
+
+def _paths_to(tag, type_name, children, bases, stack=()):
+    """Return (relative tag path, type) of all elements named tag below type_name."""
+    result = []
+    for child_tag, child_type in _child_elements(type_name, children, bases):
+        if child_tag == tag:
+            result.append(((child_tag,), child_type))
+        if child_type is None or child_type in stack:
+            continue
+        for sub_path, sub_type in _paths_to(
+                tag, child_type, children, bases, stack + (child_type,)):
+            result.append(((child_tag,) + sub_path, sub_type))
+    return result
+
+
+def absolute_paths(tags, xsd_file):
+    """Return all absolute tag paths matching the descendant path `//tags`."""
+    roots, children, bases = load_schema_tree(xsd_file)
+    candidates = set()
+    for root_tag, root_type in roots:
+        starts = _paths_to(tags[0], root_type, children, bases)
+        starts = [((root_tag,) + path, type_name) for path, type_name in starts]
+        if root_tag == tags[0]:
+            starts.append(((root_tag,), root_type))
+        for path, type_name in starts:
+            for tag in tags[1:]:
+                matching = [
+                    child_type for child_tag, child_type
+                    in _child_elements(type_name, children, bases)
+                    if child_tag == tag]
+                if not matching:
+                    break
+                path, type_name = path + (tag,), matching[0]
+            else:
+                candidates.add(path)
+    return candidates
+
+
+def _tags_to_path(tags, namespaces):
+    prefixes = dict((uri, prefix) for prefix, uri in namespaces.items())
+    steps = []
+    for tag in tags:
+        uri, local_name = tag[1:].split('}')
+        steps.append('%s:%s' % (prefixes[uri], local_name))
+    return '/' + '/'.join(steps)
+
+
+def anchor_fields(fields, flavors):
+    """Return ({field: {flavor: new path}}, [unresolved (field, flavor, reason)])."""
+    anchored, unresolved = {}, []
+    for flavor, details in flavors.items():
+        if 'namespaces' not in details:
+            continue
+        xsd_files = sorted(set(
+            os.path.join(FLAVORS_DIR, flavor, 'xsd', level['schema'])
+            for level in details['levels'].values()))
+        for field_name, field_details in fields.items():
+            path = field_details['_path'].get(flavor)
+            if path is None or not path.startswith('//'):
+                continue
+            parsed = xml_flavor._path_to_tags(path, details['namespaces'])
+            if parsed is None:
+                unresolved.append((field_name, flavor, 'unsupported path'))
+                continue
+            candidates = set()
+            for xsd_file in xsd_files:
+                candidates |= absolute_paths(parsed[1], xsd_file)
+            if len(candidates) != 1:
+                unresolved.append((
+                    field_name, flavor,
+                    '%d locations in XSD' % len(candidates)))
+                continue
+            anchored.setdefault(field_name, {})[flavor] = _tags_to_path(
+                candidates.pop(), details['namespaces'])
+    return anchored, unresolved
+
+
+def sample_trees():
+    """Yield (name, root element) of every sample invoice and bundled XML."""
+    from ..facturx import FacturX
+
+    for file_name in sorted(os.listdir(SAMPLES_DIR)):
+        if file_name.endswith('.pdf'):
+            yield file_name, FacturX(os.path.join(SAMPLES_DIR, file_name)).xml
+    for flavor in xml_flavor.FLAVORS:
+        xml_dir = os.path.join(FLAVORS_DIR, flavor, 'xml')
+        for sub_dir in (xml_dir, os.path.join(xml_dir, 'samples')):
+            if not os.path.isdir(sub_dir):
+                continue
+            for file_name in sorted(os.listdir(sub_dir)):
+                if file_name.endswith('.xml'):
+                    path = os.path.join(sub_dir, file_name)
+                    yield os.path.relpath(path, FLAVORS_DIR), \
+                        etree.parse(path).getroot()
+
+
+def check_equivalence(old_fields, new_fields, trees):
+    """Evaluate old and new paths on every tree. Returns a list of mismatches."""
+    mismatches = []
+    for name, tree in trees:
+        flavor = xml_flavor.guess_flavor(tree)
+        namespaces = xml_flavor.FLAVORS[flavor]['namespaces']
+        for field_name, field_details in new_fields.items():
+            new_path = field_details['_path'].get(flavor)
+            old_path = old_fields.get(field_name, {}).get('_path', {}).get(flavor)
+            if new_path is None or old_path is None or new_path == old_path:
+                continue
+            old_nodes = tree.xpath(old_path, namespaces=namespaces)
+            new_nodes = tree.xpath(new_path, namespaces=namespaces)
+            if old_nodes != new_nodes:
+                mismatches.append((name, field_name, old_path, new_path))
+    return mismatches
+
+
+def rewrite_fields_file(anchored, fields_file=FIELDS_FILE):
+    """Replace paths in fields.yml in place, keeping comments and layout."""
+    with open(fields_file) as f:
+        lines = f.readlines()
+    field_name = None
+    for i, line in enumerate(lines):
+        match = re.match(r'^([\w-]+):', line)
+        if match:
+            field_name = match.group(1)
+            continue
+        match = re.match(r'^(\s+)([\w-]+): (//\S+)\s*$', line)
+        if match and match.group(2) in anchored.get(field_name, {}):
+            lines[i] = '%s%s: %s\n' % (
+                match.group(1), match.group(2),
+                anchored[field_name][match.group(2)])
+    with open(fields_file, 'w') as f:
+        f.writelines(lines)
+
+
+def _replace_paths(fields, anchored):
+    new_fields = {}
+    for field_name, field_details in fields.items():
+        paths = dict(field_details['_path'])
+        paths.update(anchored.get(field_name, {}))
+        new_fields[field_name] = dict(field_details, _path=paths)
+    return new_fields
+
+
+def _print_mismatches(mismatches):
+    for name, field_name, old_path, new_path in mismatches:
+        print('MISMATCH %s: %s\n    old: %s\n    new: %s' % (
+            name, field_name, old_path, new_path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='report anchored paths without writing fields.yml')
+    parser.add_argument(
+        '--check', metavar='OLD_FIELDS_YML',
+        help='only compare the paths of an older fields.yml with the current one')
+    args = parser.parse_args(argv)
+    xml_flavor.logger.disabled = True
+
+    if args.check:
+        with open(args.check) as f:
+            old_fields = yaml.safe_load(f)
+        mismatches = check_equivalence(
+            old_fields, xml_flavor.FIELDS, sample_trees())
+        _print_mismatches(mismatches)
+        print('%d mismatches' % len(mismatches))
+        return 1 if mismatches else 0
+
+    anchored, unresolved = anchor_fields(xml_flavor.FIELDS, xml_flavor.FLAVORS)
+    for field_name, flavor, reason in unresolved:
+        print('SKIP %s (%s): %s' % (field_name, flavor, reason))
+    for field_name in sorted(anchored):
+        for flavor, path in sorted(anchored[field_name].items()):
+            print('%s (%s): %s' % (field_name, flavor, path))
+
+    new_fields = _replace_paths(xml_flavor.FIELDS, anchored)
+    mismatches = check_equivalence(xml_flavor.FIELDS, new_fields, sample_trees())
+    if mismatches:
+        _print_mismatches(mismatches)
+        print('Not writing fields.yml: %d mismatches' % len(mismatches))
+        return 1
+    if not args.dry_run and anchored:
+        rewrite_fields_file(anchored)
+        print('Updated %s' % FIELDS_FILE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,12 +9,16 @@ Data kept for each flavor:
 - xml templates to create new XML representations
 """
 
+import copy
+import hashlib
 import os
+import threading
 import yaml
 from lxml import etree
 from io import BytesIO
 from pkg_resources import resource_filename
 
+from .._version import __version__
 from ..logger import logger
 
 unicode = str
@@ -22,10 +26,112 @@ unicode = str
 # Load information on different XML standards and paths from YML.
 def _load_yml(filename):
     with open(os.path.join(os.path.dirname(__file__), filename)) as f:
-        return yaml.load(f)
+        return yaml.safe_load(f)
+
+
+def _compile_field_paths(fields, flavors):
+    """Compile every field path into an etree.XPath per flavor.
+
+    The namespace map of the flavor is bound at compile time, so evaluation
+    doesn't depend on the prefixes used in a given document.
+    """
+    compiled = {}
+    for flavor, details in flavors.items():
+        if 'namespaces' not in details:
+            continue
+        compiled[flavor] = {}
+        for field_name, field_details in fields.items():
+            if flavor in field_details['_path']:
+                compiled[flavor][field_name] = etree.XPath(
+                    field_details['_path'][flavor],
+                    namespaces=details['namespaces'])
+    return compiled
+
+
+def _path_to_tags(path, namespaces):
+    """Split a simple XPath into (anchored, tuple of Clark-notation tags).
+
+    Returns None if the path uses anything else than child steps with
+    prefixed names.
+    """
+    if path.startswith('//'):
+        anchored, path = False, path[2:]
+    elif path.startswith('/'):
+        anchored, path = True, path[1:]
+    else:
+        return None
+    tags = []
+    for step in path.split('/'):
+        prefix, sep, local_name = step.partition(':')
+        if not sep or prefix not in namespaces or \
+                not local_name.replace('-', '').replace('_', '').isalnum():
+            return None
+        tags.append('{%s}%s' % (namespaces[prefix], local_name))
+    return anchored, tuple(tags)
+
+
+def _compile_tag_paths(fields, flavors):
+    """Build per-flavor lookups from element tag paths to field names.
+
+    Used by FacturX.to_dict() to resolve all fields in one traversal.
+    Paths starting with '//' are matched against the end of the current tag
+    path, paths starting with '/' against the whole of it. Fields with paths
+    that can't be expressed this way are listed under 'fallback'.
+
+    If a flavor has absolute paths, its remaining '//' paths are moved to
+    'fallback' too, so the traversal only needs to visit the branches leading
+    to the absolute paths.
+    """
+    compiled = {}
+    for flavor, details in flavors.items():
+        if 'namespaces' not in details:
+            continue
+        lookup = {'absolute': {}, 'descendant': {}, 'fallback': []}
+        for field_name, field_details in fields.items():
+            if flavor not in field_details['_path']:
+                continue
+            parsed = _path_to_tags(
+                field_details['_path'][flavor], details['namespaces'])
+            if parsed is None:
+                lookup['fallback'].append(field_name)
+                continue
+            anchored, tags = parsed
+            kind = 'absolute' if anchored else 'descendant'
+            lookup[kind].setdefault(tags, []).append(field_name)
+        if lookup['absolute'] and lookup['descendant']:
+            for field_names in lookup['descendant'].values():
+                lookup['fallback'].extend(field_names)
+            lookup['descendant'] = {}
+        lookup['suffix_lengths'] = sorted(
+            set(len(tags) for tags in lookup['descendant']))
+        lookup['prefixes'] = set(
+            tags[:i] for tags in lookup['absolute']
+            for i in range(1, len(tags) + 1))
+        compiled[flavor] = lookup
+    return compiled
 
 FIELDS = _load_yml('fields.yml')
 FLAVORS = _load_yml('flavors.yml')
+FIELD_XPATHS = _compile_field_paths(FIELDS, FLAVORS)
+FIELD_TAG_PATHS = _compile_tag_paths(FIELDS, FLAVORS)
+
+# Compiled XSD schemas, keyed by the absolute path of the top-level XSD file.
+# Levels pointing to the same file (e.g. minimum and basicwl) share one entry.
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+_schema_cache_stats = {'hits': 0, 'misses': 0}
+
+# Digests of the rules XML is checked against, keyed by flavor name.
+_rules_fingerprints = {}
+
+# Parsed XMP extension schemas, keyed by flavor name.
+_xmp_cache = {}
+
+# Parsed template trees, keyed by (flavor, level). Copies are handed out.
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+# (flavor, level) of the templates which passed XSD validation.
+_valid_templates = set()
 
 
 class XMLFlavor(object):
@@ -45,30 +151,16 @@ class XMLFlavor(object):
 
         Returns lxml.etree and xml_flavor.XMLFlavor instance.
         """
-        template_filename = os.path.join(
-            os.path.dirname(__file__),
-            flavor, 
-            'xml',
-             FLAVORS[flavor]['levels'][level]['xml'])
-        assert os.path.isfile(template_filename), 'Template for this flavor/level does not exist.'
-        
-        xml_tree = etree.parse(open(template_filename)).getroot()
+        xml_tree = get_template(flavor, level)
         return cls(xml_tree), xml_tree
 
     def get_level(self, facturx_xml_etree):
         if not isinstance(facturx_xml_etree, type(etree.Element('pouet'))):
             raise ValueError('facturx_xml_etree must be an etree.Element() object')
-        namespaces = facturx_xml_etree.nsmap
-        doc_id_xpath = facturx_xml_etree.xpath(self._get_xml_path('version'), namespaces=namespaces)
+        doc_id_xpath = self.get_xpath('version')(facturx_xml_etree)
         if not doc_id_xpath:
             raise ValueError("Version field not found.")
-        doc_id = doc_id_xpath[0].text
-        level = doc_id.split(':')[-1]
-        if level not in FLAVORS[self.name]['levels']:
-            level = doc_id.split(':')[-2]
-        if level not in FLAVORS[self.name]['levels']:
-            raise ValueError(
-                "Invalid Factur-X URN: '%s'" % doc_id)
+        level = level_from_urn(self.name, doc_id_xpath[0].text)
         logger.info('Factur-X level is %s (autodetected)', level)
         return level
 
@@ -76,13 +168,7 @@ class XMLFlavor(object):
     def check_xsd(self, etree_to_validate):
         """Validate the XML file against the XSD"""
 
-        xsd_filename = FLAVORS[self.name]['levels'][self.level]['schema']
-        xsd_file = os.path.join(
-            os.path.dirname(__file__),
-            self.name, 'xsd', xsd_filename)
-
-        xsd_etree_obj = etree.parse(open(xsd_file))
-        official_schema = etree.XMLSchema(xsd_etree_obj)
+        official_schema = get_schema(self.name, self.level)
         try:
             official_schema.assertValid(etree_to_validate)
             logger.info('XML file successfully validated against XSD')
@@ -91,7 +177,7 @@ class XMLFlavor(object):
             logger.error(
                 "The XML file is invalid against the XML Schema Definition")
             logger.error('XSD Error: %s', e)
-            raise Exception(
+            raise XSDValidationError(
                 "The %s XML file is not valid against the official "
                 "XML Schema Definition. "
                 "Here is the error, which may give you an idea on the "
@@ -99,12 +185,20 @@ class XMLFlavor(object):
         return True
 
     def get_xmp_xml(self):
-        xmp_file = os.path.join(
-            os.path.dirname(__file__),
-            self.name, 
-            'xmp',
-             FLAVORS[self.name]['xmp_schema'])
-        return etree.parse(open(xmp_file))
+        """Return a copy of the parsed XMP extension schema of the flavor.
+
+        The file is parsed once per process, callers are free to modify
+        the returned tree.
+        """
+        xmp_tree = _xmp_cache.get(self.name)
+        if xmp_tree is None:
+            xmp_file = os.path.join(
+                os.path.dirname(__file__),
+                self.name,
+                'xmp',
+                FLAVORS[self.name]['xmp_schema'])
+            xmp_tree = _xmp_cache[self.name] = etree.parse(xmp_file)
+        return copy.deepcopy(xmp_tree)
 
     def _get_xml_path(self, field_name):
         """Return XML path based on field_name and flavor"""
@@ -116,12 +210,152 @@ class XMLFlavor(object):
         else:
             raise KeyError('Path not defined for currenct flavor.')
 
+    def get_xpath(self, field_name):
+        """Return the compiled etree.XPath for field_name and flavor"""
+
+        assert field_name in FIELDS.keys(), 'Field not specified. Try working directly on the XML tree.'
+        try:
+            return FIELD_XPATHS[self.name][field_name]
+        except KeyError:
+            raise KeyError('Path not defined for currenct flavor.')
+
+class XSDValidationError(Exception):
+    """Raised when XML is not valid against the XSD of its flavor and level."""
+
+
+class UnknownFlavorError(ValueError):
+    """Raised when XML is neither Factur-X nor ZUGFeRD."""
+
+
+def rules_fingerprint(flavor):
+    """Return a digest of what validation and field extraction of `flavor`
+    depend on: the library version, fields.yml, flavors.yml and the XSD
+    files of the flavor. Computed once per process.
+    """
+    fingerprint = _rules_fingerprints.get(flavor)
+    if fingerprint is not None:
+        return fingerprint
+    here = os.path.dirname(__file__)
+    digest = hashlib.sha256(__version__.encode('utf-8'))
+    paths = [os.path.join(here, 'fields.yml'), os.path.join(here, 'flavors.yml')]
+    xsd_dir = os.path.join(here, flavor, 'xsd')
+    if os.path.isdir(xsd_dir):
+        paths.extend(os.path.join(xsd_dir, name)
+                     for name in sorted(os.listdir(xsd_dir)))
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(os.path.basename(path).encode('utf-8'))
+            digest.update(hashlib.sha256(f.read()).digest())
+    fingerprint = _rules_fingerprints[flavor] = digest.hexdigest()[:16]
+    return fingerprint
+
+
+def _schema_filename(flavor, level):
+    xsd_filename = FLAVORS[flavor]['levels'][level]['schema']
+    return os.path.join(os.path.dirname(__file__), flavor, 'xsd', xsd_filename)
+
+
+def get_schema(flavor, level):
+    """Return the compiled etree.XMLSchema for flavor and level.
+
+    Schemas are parsed and compiled once per process and shared between all
+    levels using the same XSD file.
+    """
+    xsd_file = _schema_filename(flavor, level)
+    schema = _schema_cache.get(xsd_file)
+    if schema is not None:
+        _schema_cache_stats['hits'] += 1
+        return schema
+
+    with _schema_cache_lock:
+        schema = _schema_cache.get(xsd_file)
+        if schema is None:
+            _schema_cache_stats['misses'] += 1
+            logger.debug('Compiling XSD %s', xsd_file)
+            schema = etree.XMLSchema(etree.parse(xsd_file))
+            _schema_cache[xsd_file] = schema
+        else:
+            _schema_cache_stats['hits'] += 1
+    return schema
+
+
+def warm_schema_cache(flavors=None):
+    """Compile the schemas of all levels of the given flavors up front.
+
+    Defaults to every flavor with levels defined in flavors.yml. Returns the
+    number of distinct schemas in the cache afterwards.
+    """
+    if flavors is None:
+        flavors = [name for name in FLAVORS if 'levels' in FLAVORS[name]]
+    for flavor in flavors:
+        for level in FLAVORS[flavor]['levels']:
+            get_schema(flavor, level)
+    return len(_schema_cache)
+
+
+def schema_cache_info():
+    """Return hit/miss counters and current size of the schema cache."""
+    info = dict(_schema_cache_stats)
+    info['size'] = len(_schema_cache)
+    return info
+
+
+def clear_schema_cache():
+    """Drop all compiled schemas and reset the counters."""
+    with _schema_cache_lock:
+        _schema_cache.clear()
+        _schema_cache_stats['hits'] = 0
+        _schema_cache_stats['misses'] = 0
+
+
+def get_template(flavor, level):
+    """Return a new copy of the XML template of flavor and level.
+
+    Each template file is parsed once per process.
+    """
+    with _template_cache_lock:
+        master = _template_cache.get((flavor, level))
+        if master is None:
+            template_filename = os.path.join(
+                os.path.dirname(__file__),
+                flavor,
+                'xml',
+                FLAVORS[flavor]['levels'][level]['xml'])
+            assert os.path.isfile(template_filename), 'Template for this flavor/level does not exist.'
+            master = etree.parse(template_filename).getroot()
+            _template_cache[(flavor, level)] = master
+        return copy.deepcopy(master)
+
+
+def check_template(flavor, level):
+    """Validate the template of flavor and level against its XSD, once.
+
+    Raises like XMLFlavor.check_xsd if the template is invalid.
+    """
+    if (flavor, level) in _valid_templates:
+        return True
+    xml_tree = get_template(flavor, level)
+    XMLFlavor(xml_tree).check_xsd(xml_tree)
+    _valid_templates.add((flavor, level))
+    return True
+
+
 def valid_xmp_filenames():
     result = []
     for flavor in FLAVORS.keys():
         result.append(FLAVORS[flavor]['xmp_filename'])
     return result
 
+def level_from_urn(flavor, doc_id):
+    """Return the level named by the guideline URN of the version field."""
+    level = doc_id.split(':')[-1]
+    if level not in FLAVORS[flavor]['levels']:
+        level = doc_id.split(':')[-2]
+    if level not in FLAVORS[flavor]['levels']:
+        raise ValueError(
+            "Invalid Factur-X URN: '%s'" % doc_id)
+    return level
+
 def guess_flavor(facturx_xml_etree):
     if not isinstance(facturx_xml_etree, type(etree.Element('pouet'))):
         raise ValueError('facturx_xml_etree must be an etree.Element() object')
@@ -130,7 +364,7 @@ def guess_flavor(facturx_xml_etree):
     elif facturx_xml_etree.tag.startswith('{urn:ferd:'):
         flavor = 'zugferd'
     else:
-        raise Exception(
+        raise UnknownFlavorError(
             "Could not detect if the invoice is a Factur-X or ZUGFeRD "
             "invoice.")
     logger.info('Factur-X flavor is %s (autodetected)', flavor)
@@ -0,0 +1,285 @@
+"""
+Generate Factur-X or ZUGFeRD XML from tabular data.
+
+Rows are dicts keyed by field names from fields.yml, read from CSV or JSON
+Lines files or passed directly:
+
+    generator = XMLGenerator('factur-x', 'basic')
+    for result in generator.generate(read_rows('export.csv')):
+        if not result.errors:
+            ...  # result.xml is the serialized invoice
+
+Every row starts from a copy of the cached template. Field setters are
+compiled once per flavor and level into child index paths, so setting a
+value doesn't evaluate any XPath. `generate_parallel` spreads the rows over
+a process pool, each worker building its generator once.
+
+Generate files from the command line:
+
+    $ python -m invoicex.facturx.generator export.csv out/ --level basic
+"""
+
+import argparse
+import copy
+import csv
+import io
+import json
+import multiprocessing
+import os
+import sys
+from collections import namedtuple
+from datetime import date
+
+from lxml import etree
+
+from .flavors import xml_flavor
+from .logger import logger
+from .pdfsource import path_types
+
+__all__ = ['GeneratedXML', 'XMLGenerator', 'generate_parallel', 'read_rows']
+
+ROW_FORMATS = ('csv', 'jsonl')
+
+# One result per input row. xml is None if the row couldn't be applied to the
+# template, errors is empty if the XML is valid or wasn't validated.
+GeneratedXML = namedtuple('GeneratedXML', 'index xml errors')
+
+
+def _row_format(path, row_format):
+    if row_format is not None:
+        if row_format not in ROW_FORMATS:
+            raise ValueError(
+                "row_format must be one of %s (it is %r)." % (
+                    ', '.join(ROW_FORMATS), row_format))
+        return row_format
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    elif extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    raise ValueError("Can't guess the format of '%s', pass row_format." % path)
+
+
+def _iter_text_rows(f, row_format):
+    if row_format == 'csv':
+        for row in csv.DictReader(f):
+            yield row
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_rows(source, row_format=None):
+    """Yield rows as dicts from a CSV or JSON Lines file.
+
+    `source` is a path, whose extension gives the format unless
+    `row_format` is set, or a text file object with `row_format` set.
+    Rows are read lazily, so large exports aren't loaded into memory.
+    """
+    if isinstance(source, path_types):
+        path = os.fspath(source)
+        row_format = _row_format(path, row_format)
+        with io.open(path, newline='', encoding='utf-8-sig') as f:
+            for row in _iter_text_rows(f, row_format):
+                yield row
+    elif hasattr(source, 'read'):
+        if row_format not in ROW_FORMATS:
+            raise ValueError(
+                "row_format must be one of %s for file objects." %
+                ', '.join(ROW_FORMATS))
+        for row in _iter_text_rows(source, row_format):
+            yield row
+    else:
+        raise TypeError(
+            "The rows must be read from a path or a text file "
+            "(it is a %s)." % type(source))
+
+
+def _format_value(field_name, value):
+    if 'date' in field_name:
+        if isinstance(value, date):
+            return value.strftime('%Y%m%d')
+        # Accept both ISO dates and the '102' format used in the XML.
+        return str(value).replace('-', '')
+    return str(value)
+
+
+def _compile_setters(flavor, template):
+    """Map each field to the child index path of its node in `template`.
+
+    Fields without a node in the template map to None.
+    """
+    setters = {}
+    for field_name, xpath in xml_flavor.FIELD_XPATHS[flavor].items():
+        nodes = xpath(template)
+        if len(nodes) != 1:
+            setters[field_name] = None if not nodes else len(nodes)
+            continue
+        indexes = []
+        node = nodes[0]
+        while node.getparent() is not None:
+            parent = node.getparent()
+            indexes.append(parent.index(node))
+            node = parent
+        setters[field_name] = tuple(reversed(indexes))
+    return setters
+
+
+class XMLGenerator(object):
+    """Fill the template of one flavor and level with rows of field values.
+
+    Empty values (None or '') keep the template value. Date fields accept
+    date and datetime objects, or strings as YYYY-MM-DD or YYYYMMDD.
+
+    With `validate`, each XML is checked against the XSD of the level and the
+    required fields, and the failures are listed in the errors of the result.
+    """
+
+    def __init__(self, flavor='factur-x', level='minimum', validate=True,
+                 pretty_print=True):
+        if flavor not in xml_flavor.FIELD_XPATHS or \
+                level not in xml_flavor.FLAVORS[flavor].get('levels', {}):
+            raise ValueError(
+                "Unknown flavor and level: %s %s." % (flavor, level))
+        self.flavor = flavor
+        self.level = level
+        self.validate = validate
+        self.pretty_print = pretty_print
+        self._template = xml_flavor.get_template(flavor, level)
+        self._setters = _compile_setters(flavor, self._template)
+        self._required = [
+            field_name for field_name, details in xml_flavor.FIELDS.items()
+            if details['_required'] and field_name in self._setters]
+        self._schema = xml_flavor.get_schema(flavor, level) if validate else None
+
+    def build(self, row):
+        """Return a new XML tree with the values of `row` set."""
+        xml = copy.deepcopy(self._template)
+        for field_name, value in row.items():
+            if value is None or value == '':
+                continue
+            if field_name not in xml_flavor.FIELDS:
+                raise KeyError("Unknown field '%s'." % field_name)
+            indexes = self._setters.get(field_name)
+            if indexes is None:
+                raise KeyError(
+                    "Field '%s' is not in the %s %s template." % (
+                        field_name, self.flavor, self.level))
+            if isinstance(indexes, int):
+                raise LookupError(
+                    "Multiple nodes found for field '%s'. Refusing to edit." %
+                    field_name)
+            node = xml
+            for i in indexes:
+                node = node[i]
+            if 'date' in field_name:
+                node.attrib['format'] = '102'
+            node.text = _format_value(field_name, value)
+        return xml
+
+    def check(self, xml):
+        """Return the list of validation errors of `xml`, empty if valid."""
+        if not self._schema.validate(xml):
+            return [
+                "The %s XML file is not valid against the official XML "
+                "Schema Definition: %s" % (self.flavor, self._schema.error_log.last_error)]
+        errors = []
+        for field_name in self._required:
+            indexes = self._setters[field_name]
+            if not isinstance(indexes, tuple):
+                continue
+            node = xml
+            for i in indexes:
+                node = node[i]
+            if node.text is None:
+                errors.append(
+                    "Required field %s doesn't contain any value" % field_name)
+        return errors
+
+    def generate_one(self, index, row):
+        """Build, check and serialize one row into a GeneratedXML."""
+        try:
+            xml = self.build(row)
+        except (KeyError, LookupError) as e:
+            return GeneratedXML(index, None, [str(e.args[0])])
+        errors = self.check(xml) if self.validate else []
+        return GeneratedXML(index, etree.tostring(
+            xml, pretty_print=self.pretty_print, xml_declaration=True,
+            encoding='UTF-8'), errors)
+
+    def generate(self, rows):
+        """Yield a GeneratedXML for each row, in order."""
+        for index, row in enumerate(rows):
+            yield self.generate_one(index, row)
+
+
+# Generator of the current worker process, built by _init_worker.
+_worker_generator = None
+
+
+def _init_worker(flavor, level, validate, pretty_print):
+    global _worker_generator
+    xml_flavor.logger.disabled = True
+    _worker_generator = XMLGenerator(flavor, level, validate, pretty_print)
+
+
+def _generate_in_worker(item):
+    return _worker_generator.generate_one(*item)
+
+
+def generate_parallel(rows, flavor='factur-x', level='minimum', validate=True,
+                      pretty_print=True, processes=None, chunksize=64):
+    """Like XMLGenerator.generate, on a pool of `processes` workers.
+
+    Defaults to one worker per core. Rows are consumed and results yielded
+    as they go, in input order.
+    """
+    pool = multiprocessing.Pool(
+        processes, _init_worker, (flavor, level, validate, pretty_print))
+    try:
+        for result in pool.imap(
+                _generate_in_worker, enumerate(rows), chunksize):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m invoicex.facturx.generator',
+        description='Generate one XML invoice per row of a CSV or JSONL file.')
+    parser.add_argument('rows', help='CSV or JSON Lines file')
+    parser.add_argument('output_dir')
+    parser.add_argument('--format', choices=ROW_FORMATS, dest='row_format')
+    parser.add_argument('--flavor', default='factur-x',
+                        choices=sorted(xml_flavor.FIELD_XPATHS))
+    parser.add_argument('--level', default='minimum')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--no-validate', dest='validate', action='store_false')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    failed = 0
+    results = generate_parallel(
+        read_rows(args.rows, args.row_format), args.flavor, args.level,
+        args.validate, processes=args.processes)
+    for result in results:
+        if result.errors:
+            failed += 1
+            logger.error('Row %d: %s', result.index + 1, result.errors[0])
+            continue
+        path = os.path.join(args.output_dir, '%06d.xml' % (result.index + 1))
+        with open(path, 'wb') as f:
+            f.write(result.xml)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
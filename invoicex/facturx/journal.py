@@ -0,0 +1,182 @@
+"""
+Durable record of the inputs processed by a batch run, to resume it.
+
+Each input is recorded with its size, modification time, SHA-256 digest,
+status and result, under a key of the settings of the run. Files read
+along with an input, such as the XML embedded into a PDF, are sidecars:
+their size and modification time are recorded too, and the digest covers
+them. A rerun with the same settings skips inputs which were processed
+successfully and haven't changed: if sizes and modification times match,
+without reading the files, otherwise if the digest matches. Failed inputs
+are retried. Quarantined inputs, which exceeded the time or memory limits
+of the run, are only retried with other limits.
+
+The journal is an SQLite database in WAL mode, committed after each input,
+so an interrupted run loses at most the inputs in progress.
+
+Inspect a journal from the command line:
+
+    $ python -m invoicex.facturx.journal info run.journal
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from ._version import __version__
+
+__all__ = ['BatchJournal', 'file_digest', 'is_done', 'is_quarantined',
+           'settings_key']
+
+_READ_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def settings_key(command, options):
+    """Return a key for the command, options and library version of a run.
+
+    Results are only reused between runs with the same key.
+    """
+    settings = json.dumps(
+        {'command': command, 'options': options, 'version': __version__},
+        sort_keys=True)
+    return hashlib.sha256(settings.encode('utf-8')).hexdigest()[:16]
+
+
+class BatchJournal(object):
+    """SQLite journal of processed inputs, keyed by absolute path and settings."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # With WAL, commits survive the process being killed without an
+            # fsync each.
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS inputs ('
+                ' path TEXT NOT NULL,'
+                ' settings TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' mtime_ns INTEGER NOT NULL,'
+                ' digest TEXT NOT NULL,'
+                ' status TEXT NOT NULL,'
+                ' output TEXT,'
+                ' result TEXT NOT NULL,'
+                ' updated REAL NOT NULL,'
+                ' sidecars TEXT NOT NULL DEFAULT \'[]\','
+                ' PRIMARY KEY (path, settings))')
+            columns = [row[1] for row in
+                       self._conn.execute('PRAGMA table_info(inputs)')]
+            if 'sidecars' not in columns:
+                self._conn.execute(
+                    "ALTER TABLE inputs ADD COLUMN sidecars TEXT NOT NULL"
+                    " DEFAULT '[]'")
+            self._conn.commit()
+        return self._conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    def entries(self, settings):
+        """Return {absolute path: entry dict} of all inputs recorded with
+        `settings`."""
+        rows = self.conn.execute(
+            'SELECT path, size, mtime_ns, digest, status, output, result,'
+            ' sidecars FROM inputs WHERE settings = ?', (settings,))
+        entries = {}
+        for path, size, mtime_ns, digest, status, output, result, sidecars \
+                in rows:
+            entries[path] = {
+                'size': size, 'mtime_ns': mtime_ns, 'digest': digest,
+                'status': status, 'output': output,
+                'result': json.loads(result),
+                'sidecars': [tuple(sidecar) for sidecar in json.loads(sidecars)]}
+        return entries
+
+    def record(self, path, settings, size, mtime_ns, digest, result,
+               sidecars=()):
+        """Record the result dict of an input, committing immediately.
+
+        `sidecars` lists the (path, size, mtime_ns) of the files read along
+        with the input, which `digest` covers too. Results with
+        'quarantined' set get that status, otherwise 'done' or 'failed'.
+        """
+        if result.get('quarantined'):
+            status = 'quarantined'
+        else:
+            status = 'done' if result.get('ok') else 'failed'
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO inputs (path, settings, size, mtime_ns,'
+                ' digest, status, output, result, updated, sidecars)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(path), settings, size, mtime_ns, digest,
+                 status, result.get('output'),
+                 json.dumps(result, sort_keys=True), time.time(),
+                 json.dumps([list(sidecar) for sidecar in sidecars])))
+
+    def info(self):
+        counts = dict(self.conn.execute(
+            'SELECT status, COUNT(*) FROM inputs GROUP BY status').fetchall())
+        return {
+            'path': self.path,
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'quarantined': counts.get('quarantined', 0),
+            }
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def is_done(entry):
+    """Return True if `entry` was processed successfully and its output, if
+    any, still exists."""
+    return entry is not None and entry['status'] == 'done' and \
+        (entry['output'] is None or os.path.exists(entry['output']))
+
+
+def is_quarantined(entry, limits):
+    """Return True if `entry` was quarantined by a run with the same
+    `limits` dict, recorded in its result."""
+    return entry is not None and entry['status'] == 'quarantined' and \
+        entry['result'].get('limits') == limits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Inspect a batch journal.')
+    parser.add_argument('command', choices=['info'])
+    parser.add_argument('journal')
+    args = parser.parse_args(argv)
+
+    info = BatchJournal(args.journal).info()
+    for key in ('path', 'done', 'failed', 'quarantined'):
+        print('%-12s %s' % (key + ':', info[key]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,544 @@
+"""
+Lightweight lookup of the embedded Factur-X/ZUGFeRD XML in a PDF.
+
+Instead of building a full PdfFileReader, only the trailer and the
+cross-reference sections are read, and only the objects on the way from
+/Root to the embedded file (catalog, /Names, /EmbeddedFiles name tree,
+filespec, file stream) are parsed. Pages and content streams are never
+touched. Individual objects are parsed with PyPDF2.
+
+Encrypted PDFs and files with broken cross-reference data raise
+LocatorError, so callers can fall back to PyPDF2's more tolerant reader.
+"""
+
+import binascii
+import bisect
+import hashlib
+import re
+from collections import namedtuple
+from io import BytesIO
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import readObject, IndirectObject, StreamObject
+from PyPDF2.utils import PdfReadError
+
+from .flavors import xml_flavor
+from .logger import logger
+from .pdfsource import open_pdf
+
+__all__ = ['EmbeddedFile', 'EmbeddedFileLocator', 'LocatorError',
+           'embedded_file_from_reader', 'embedded_xml_from_reader',
+           'find_embedded_file', 'find_embedded_xml', 'find_in_name_tree',
+           'iter_name_tree', 'name_tree_lookup', 'read_embedded_file',
+           'read_embedded_xml', 'UnsortedNameTree']
+
+_STARTXREF = re.compile(br'startxref\s+(\d+)')
+_OBJ_HEADER = re.compile(br'\s*(\d+)\s+(\d+)\s+obj')
+_SUBSECTION = re.compile(br'\s*(\d+)\s+(\d+)\s*[\r\n]')
+_TRAILER = re.compile(br'\s*trailer')
+
+# Bytes read at once when looking for a header or keyword.
+_CHUNK = 1024
+# Objects are parsed from an in-memory window of the file first, grown up to
+# _MAX_OBJECT_WINDOW bytes. PyPDF2 reads byte by byte, which is much slower
+# on the file object.
+_OBJECT_WINDOW = 4096
+_MAX_OBJECT_WINDOW = 1024 * 1024
+_XREF_ENTRY_SIZE = 20
+# Guards against loops in malformed name trees.
+_MAX_TREE_DEPTH = 32
+
+
+class LocatorError(Exception):
+    pass
+
+
+def _stream_bytes(stream_obj):
+    # PyPDF2 returns text from its PNG predictor decoding on Python 3.
+    data = stream_obj.getData()
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+    return data
+
+
+class _XrefTable(object):
+    """Classic cross-reference section, read lazily.
+
+    Only subsection headers are parsed up front, entries are read on
+    demand using their fixed width.
+    """
+
+    def __init__(self, subsections):
+        # list of (first object number, count, offset of first entry)
+        self.subsections = subsections
+
+    def lookup(self, stream, num):
+        for first, count, entries_offset in self.subsections:
+            if first <= num < first + count:
+                stream.seek(entries_offset + (num - first) * _XREF_ENTRY_SIZE)
+                entry = stream.read(_XREF_ENTRY_SIZE)
+                offset, generation, kind = entry[:10], entry[11:16], entry[17:18]
+                if kind == b'n':
+                    return (1, int(offset), int(generation))
+                return (0, 0, 0)
+        return None
+
+
+class _XrefStream(object):
+    """Cross-reference stream. Entries are decoded on demand."""
+
+    def __init__(self, xref_obj):
+        self.data = _stream_bytes(xref_obj)
+        self.widths = [int(w) for w in xref_obj['/W']]
+        self.entry_size = sum(self.widths)
+        index = xref_obj.get('/Index', [0, xref_obj['/Size']])
+        self.subsections = []
+        position = 0
+        for i in range(0, len(index), 2):
+            first, count = int(index[i]), int(index[i + 1])
+            self.subsections.append((first, count, position))
+            position += count
+
+    def lookup(self, stream, num):
+        for first, count, position in self.subsections:
+            if first <= num < first + count:
+                start = (position + num - first) * self.entry_size
+                entry = self.data[start:start + self.entry_size]
+                fields = []
+                for width in self.widths:
+                    value = 0
+                    for byte in bytearray(entry[:width]):
+                        value = (value << 8) + byte
+                    fields.append(value)
+                    entry = entry[width:]
+                # A zero-width type field defaults to type 1.
+                if self.widths[0] == 0:
+                    fields[0] = 1
+                return tuple(fields)
+        return None
+
+
+class EmbeddedFileLocator(object):
+    """Resolve PDF objects on demand from the cross-reference data only.
+
+    Implements the part of the PdfFileReader interface (`getObject`,
+    `strict`) which PyPDF2's object parsers rely on.
+    """
+
+    strict = False
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._sections = []
+        self._objects = {}
+        self._object_streams = {}
+        self.trailer = self._read_xref_chain()
+        if '/Encrypt' in self.trailer:
+            raise LocatorError('Encrypted PDF')
+
+    def _read_at(self, offset, size=_CHUNK):
+        self.stream.seek(offset)
+        return self.stream.read(size)
+
+    def _startxref(self):
+        self.stream.seek(0, 2)
+        end = self.stream.tell()
+        tail = self._read_at(max(0, end - _CHUNK), _CHUNK)
+        matches = list(_STARTXREF.finditer(tail))
+        if not matches:
+            raise LocatorError('startxref not found')
+        return int(matches[-1].group(1))
+
+    def _read_xref_chain(self):
+        """Read the chain of xref sections, newest first. Returns the newest trailer."""
+        trailer = None
+        offset = self.startxref = self._startxref()
+        seen = set()
+        while offset is not None:
+            if offset in seen:
+                raise LocatorError('Loop in /Prev chain')
+            seen.add(offset)
+            section_trailer = self._read_xref_section(offset)
+            if trailer is None:
+                trailer = section_trailer
+            # Hybrid files reference an additional xref stream, which takes
+            # precedence over the table it belongs to.
+            if '/XRefStm' in section_trailer:
+                self._read_xref_section(int(section_trailer['/XRefStm']))
+                self._sections[-2:] = self._sections[:-3:-1]
+            prev = section_trailer.get('/Prev')
+            offset = int(prev) if prev is not None else None
+        return trailer
+
+    def _read_xref_section(self, offset):
+        chunk = self._read_at(offset, 4)
+        if chunk == b'xref':
+            return self._read_xref_table(offset + 4)
+        return self._read_xref_stream(offset)
+
+    def _read_xref_table(self, offset):
+        subsections = []
+        position = offset
+        while True:
+            chunk = self._read_at(position, 64)
+            if _TRAILER.match(chunk):
+                position += _TRAILER.match(chunk).end()
+                break
+            match = _SUBSECTION.match(chunk)
+            if not match:
+                raise LocatorError('Invalid xref subsection at %d' % position)
+            first, count = int(match.group(1)), int(match.group(2))
+            entries_offset = position + match.end()
+            # Some writers use a single-byte EOL in entries; skip leading
+            # whitespace left over from the header line.
+            while self._read_at(entries_offset, 1) in (b'\r', b'\n', b' '):
+                entries_offset += 1
+            subsections.append((first, count, entries_offset))
+            position = entries_offset + count * _XREF_ENTRY_SIZE
+        self._sections.append(_XrefTable(subsections))
+        return self._read_object(position)
+
+    def _read_xref_stream(self, offset):
+        xref_obj = self._read_object_at(offset)
+        if not isinstance(xref_obj, StreamObject) or \
+                xref_obj.get('/Type') != '/XRef':
+            raise LocatorError('No xref table or stream at %d' % offset)
+        self._sections.append(_XrefStream(xref_obj))
+        return xref_obj
+
+    def _skip_whitespace(self, stream=None):
+        stream = stream or self.stream
+        while True:
+            char = stream.read(1)
+            if char not in (b' ', b'\r', b'\n', b'\t', b'\x00', b'\x0c'):
+                stream.seek(-len(char), 1)
+                return
+
+    def _read_object(self, position):
+        """Parse the object starting at `position`, after any whitespace."""
+        size = _OBJECT_WINDOW
+        while size <= _MAX_OBJECT_WINDOW:
+            window = BytesIO(self._read_at(position, size))
+            self._skip_whitespace(window)
+            try:
+                return readObject(window, self)
+            except PdfReadError:
+                # Cut off by the end of the window, unless the window
+                # already reaches the end of the file.
+                if len(window.getvalue()) < size:
+                    raise
+                size *= 16
+        self.stream.seek(position)
+        self._skip_whitespace()
+        return readObject(self.stream, self)
+
+    def _read_object_at(self, offset):
+        match = _OBJ_HEADER.match(self._read_at(offset, 64))
+        if not match:
+            raise LocatorError('No object header at %d' % offset)
+        return self._read_object(offset + match.end())
+
+    def _lookup(self, num):
+        for section in self._sections:
+            entry = section.lookup(self.stream, num)
+            if entry is not None:
+                return entry
+        return None
+
+    def _object_stream(self, num):
+        if num not in self._object_streams:
+            objstm = self.getObject(IndirectObject(num, 0, self))
+            data = _stream_bytes(objstm)
+            first = int(objstm['/First'])
+            header = data[:first].split()
+            offsets = dict(
+                (int(header[i]), first + int(header[i + 1]))
+                for i in range(0, len(header) - 1, 2))
+            self._object_streams[num] = (data, offsets)
+        return self._object_streams[num]
+
+    def getObject(self, indirect_reference):
+        num = indirect_reference.idnum
+        if num in self._objects:
+            return self._objects[num]
+        entry = self._lookup(num)
+        if entry is None or entry[0] == 0:
+            logger.debug('Object %d not found, using null', num)
+            obj = None
+        elif entry[0] == 1:
+            position = self.stream.tell()
+            obj = self._read_object_at(entry[1])
+            self.stream.seek(position)
+        else:
+            data, offsets = self._object_stream(entry[1])
+            if num not in offsets:
+                raise LocatorError('Object %d missing from object stream' % num)
+            buffer = BytesIO(data)
+            buffer.seek(offsets[num])
+            obj = readObject(buffer, self)
+        self._objects[num] = obj
+        return obj
+
+    def embedded_files(self):
+        """Return the /EmbeddedFiles name tree root, or None."""
+        root = _resolve(self.trailer['/Root'])
+        names = _resolve(root.get('/Names'))
+        if names is None:
+            return None
+        return _resolve(names.get('/EmbeddedFiles'))
+
+    def find_xml(self, filenames=None):
+        """Return (filename, XML bytes) of the embedded invoice, or (None, None)."""
+        embedded = find_in_name_tree(self.embedded_files(), filenames)
+        if embedded is None:
+            return None, None
+        return embedded.filename, embedded.data
+
+
+def _resolve(obj):
+    if isinstance(obj, IndirectObject):
+        return obj.getObject()
+    return obj
+
+
+def _name_key(key):
+    # Keys the PDF writer couldn't decode are kept as bytes by PyPDF2.
+    if isinstance(key, bytes):
+        return key.decode('latin-1')
+    return key
+
+
+class UnsortedNameTree(ValueError):
+    """Raised when a name tree can't be binary searched: its keys are out
+    of order, or /Kids lack /Limits."""
+
+
+def name_tree_lookup(node, key):
+    """Look up key in a name tree. Returns the unresolved value, or None.
+
+    Leaf /Names arrays and /Kids (by their /Limits) are binary searched,
+    so only the nodes on the path to key are loaded. Raises
+    UnsortedNameTree if the nodes on the path show the tree can't be
+    searched this way.
+    """
+    node = _resolve(node)
+    for _ in range(_MAX_TREE_DEPTH):
+        if node is None:
+            return None
+        if '/Names' in node:
+            names = _resolve(node['/Names'])
+            keys = [_name_key(names[i]) for i in range(0, len(names) - 1, 2)]
+            # Only the keys are checked, the values are left unloaded.
+            if any(keys[i] > keys[i + 1] for i in range(len(keys) - 1)):
+                raise UnsortedNameTree('Name tree keys are not sorted')
+            index = bisect.bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                return names[2 * index + 1]
+            return None
+        kids = _resolve(node.get('/Kids')) or []
+        low, high, node = 0, len(kids), None
+        while low < high:
+            middle = (low + high) // 2
+            kid = _resolve(kids[middle])
+            limits = _resolve(kid.get('/Limits'))
+            if limits is None or len(limits) != 2:
+                raise UnsortedNameTree('Name tree kid without /Limits')
+            first, last = [_name_key(k) for k in limits]
+            if first > last:
+                raise UnsortedNameTree('Name tree /Limits are inverted')
+            if key < first:
+                high = middle
+            elif key > last:
+                low = middle + 1
+            else:
+                node = kid
+                break
+    raise LocatorError('Name tree deeper than %d levels' % _MAX_TREE_DEPTH)
+
+
+def iter_name_tree(node):
+    """Yield (key, unresolved value) of all entries of a name tree, in order."""
+    pending, seen = [(_resolve(node), 0)], set()
+    while pending:
+        node, depth = pending.pop()
+        if node is None or id(node) in seen:
+            continue
+        if depth > _MAX_TREE_DEPTH:
+            raise LocatorError('Name tree deeper than %d levels' % _MAX_TREE_DEPTH)
+        seen.add(id(node))
+        if '/Names' in node:
+            names = _resolve(node['/Names'])
+            for i in range(0, len(names) - 1, 2):
+                yield _name_key(names[i]), names[i + 1]
+        kids = _resolve(node.get('/Kids')) or []
+        pending.extend((_resolve(kid), depth + 1) for kid in reversed(kids))
+
+
+class EmbeddedFile(namedtuple('EmbeddedFile', 'filename data checksum')):
+    """An embedded file: name, decoded bytes and the MD5 stored in its
+    /Params /CheckSum (16 bytes), if any."""
+
+    __slots__ = ()
+
+    @property
+    def checksum_matches(self):
+        """True if the stored /CheckSum matches the data, None if there is none."""
+        if self.checksum is None:
+            return None
+        return hashlib.md5(self.data).digest() == self.checksum
+
+
+def _stored_checksum(file_stream):
+    params = _resolve(file_stream.get('/Params'))
+    checksum = _resolve(params.get('/CheckSum')) if params else None
+    if checksum is None:
+        return None
+    if not isinstance(checksum, bytes):
+        # Text strings, as PyPDF2 decodes checksums which happen to be
+        # valid PDFDocEncoding.
+        try:
+            checksum = checksum.original_bytes
+        except Exception:
+            checksum = checksum.encode('latin-1', 'replace')
+    # Older versions of this library wrote a hex digest.
+    if len(checksum) == 32:
+        try:
+            return binascii.unhexlify(checksum)
+        except (binascii.Error, TypeError):
+            pass
+    return bytes(checksum)
+
+
+def _embedded_file(filespec, filenames):
+    filespec = _resolve(filespec)
+    if filespec is None:
+        return None
+    filename = _resolve(filespec.get('/F'))
+    if filename not in filenames:
+        return None
+    ef = _resolve(filespec['/EF'])
+    file_stream = _resolve(ef['/F'])
+    return EmbeddedFile(
+        filename, _stream_bytes(file_stream), _stored_checksum(file_stream))
+
+
+def _keyed_by_filename(tree):
+    """Return True if the first entry of the tree is keyed by its file name.
+
+    Only that entry's filespec is loaded.
+    """
+    for key, filespec in iter_name_tree(tree):
+        filespec = _resolve(filespec)
+        if filespec is None:
+            return False
+        names = [_name_key(_resolve(filespec.get(name)) or '')
+                 for name in ('/F', '/UF')]
+        return key in [name.rstrip('\x00') for name in names]
+    return True
+
+
+def find_in_name_tree(tree, filenames=None):
+    """Return the first EmbeddedFile named in filenames, or None.
+
+    Files are looked up by their name tree key, so the filespecs of other
+    attachments aren't loaded. Trees which can't be binary searched (see
+    UnsortedNameTree), or whose keys aren't file names (e.g. the numbered
+    keys some writers use), are scanned in full, matching each /F.
+    """
+    if filenames is None:
+        filenames = xml_flavor.valid_xmp_filenames()
+    if tree is None:
+        return None
+    try:
+        for filename in filenames:
+            result = _embedded_file(name_tree_lookup(tree, filename), filenames)
+            if result is not None:
+                return result
+        if _keyed_by_filename(tree):
+            return None
+        logger.debug('Name tree keys are not file names, scanning it')
+    except UnsortedNameTree as e:
+        logger.debug('%s, scanning the whole name tree', e)
+    for key, filespec in iter_name_tree(tree):
+        result = _embedded_file(filespec, filenames)
+        if result is not None:
+            return result
+    return None
+
+
+def _found(embedded):
+    if embedded is not None:
+        logger.info(
+            'A valid XML file %s has been found in the PDF file', embedded.filename)
+    return embedded
+
+
+def find_embedded_file(stream, filenames=None):
+    """Return the embedded Factur-X/ZUGFeRD XML as an EmbeddedFile, or None.
+
+    Raises LocatorError if the PDF can't be read this way.
+    """
+    try:
+        locator = EmbeddedFileLocator(stream)
+        embedded = find_in_name_tree(locator.embedded_files(), filenames)
+    except (PdfReadError, KeyError, ValueError, AssertionError,
+            AttributeError, TypeError, IndexError) as e:
+        raise LocatorError('%s: %s' % (type(e).__name__, e))
+    return _found(embedded)
+
+
+def find_embedded_xml(stream, filenames=None):
+    """Return the bytes of the embedded Factur-X/ZUGFeRD XML, or None.
+
+    Raises LocatorError if the PDF can't be read this way.
+    """
+    return _data(find_embedded_file(stream, filenames))
+
+
+def embedded_file_from_reader(reader, filenames=None):
+    """Return the embedded invoice XML of a PdfFileReader as an EmbeddedFile, or None."""
+    names = _resolve(reader.trailer['/Root'].get('/Names'))
+    if names is None:
+        return None
+    return _found(find_in_name_tree(
+        _resolve(names.get('/EmbeddedFiles')), filenames))
+
+
+def embedded_xml_from_reader(reader, filenames=None):
+    """Return the bytes of the embedded invoice XML of a PdfFileReader, or None."""
+    return _data(embedded_file_from_reader(reader, filenames))
+
+
+def _find_with_pypdf2(stream, filenames=None):
+    return embedded_xml_from_reader(PdfFileReader(stream), filenames)
+
+
+def read_embedded_file(pdf_invoice, filenames=None):
+    """Return the embedded XML of a PDF path, buffer or file as an
+    EmbeddedFile, or None.
+
+    Uses the locator, falling back to a full PdfFileReader for PDFs it
+    can't handle.
+    """
+    stream, owned = open_pdf(pdf_invoice)
+    try:
+        try:
+            embedded = find_embedded_file(stream, filenames)
+        except LocatorError as e:
+            logger.debug('Locator failed (%s), using PdfFileReader', e)
+            embedded = embedded_file_from_reader(PdfFileReader(stream), filenames)
+    finally:
+        if owned:
+            stream.close()
+    if embedded is None:
+        logger.info('No existing XML file found.')
+    return embedded
+
+
+def read_embedded_xml(pdf_invoice, filenames=None):
+    """Return the bytes of the embedded XML of a PDF path, buffer or file, or None."""
+    return _data(read_embedded_file(pdf_invoice, filenames))
+
+
+def _data(embedded):
+    return embedded.data if embedded is not None else None
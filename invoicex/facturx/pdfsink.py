@@ -0,0 +1,100 @@
+"""
+Helpers to write PDF output to paths or to any writable binary stream.
+
+Paths are written atomically: the output goes to a temporary file next to
+the target, which is flushed to disk and renamed over the target. On POSIX,
+readers of the old file, including memory maps of it, keep seeing the old
+content. Windows refuses to replace a file which is open or mapped, so
+callers release their own mappings of the target first.
+"""
+
+import hashlib
+import os
+import uuid
+from contextlib import contextmanager
+
+from .pdfsource import path_types
+
+__all__ = ['OutputStream', 'open_output']
+
+
+class OutputStream(object):
+    """Write-only wrapper counting the bytes written and optionally hashing them.
+
+    PDF writers need `tell()` to record object offsets, which pipes,
+    sockets and stdout don't provide.
+    """
+
+    def __init__(self, raw, sha256=False):
+        self.raw = raw
+        self.position = 0
+        self.hash = hashlib.sha256() if sha256 else None
+
+    def write(self, data):
+        self.raw.write(data)
+        self.position += len(data)
+        if self.hash is not None:
+            self.hash.update(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if hasattr(self.raw, 'flush'):
+            self.raw.flush()
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash is not None else None
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # Not supported on this platform (e.g. Windows).
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def _atomic_file(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    temp_path = os.path.join(
+        directory, '.%s.%s.tmp' % (name, uuid.uuid4().hex[:8]))
+    # Created like open() would, so the umask applies to new files.
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if os.path.exists(path):
+                os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _fsync_directory(directory)
+
+
+@contextmanager
+def open_output(target, sha256=False):
+    """Yield an OutputStream writing to a path (atomically) or a binary stream."""
+    if isinstance(target, path_types):
+        with _atomic_file(os.fspath(target)) as f:
+            yield OutputStream(f, sha256)
+    elif hasattr(target, 'write'):
+        output = OutputStream(target, sha256)
+        yield output
+        output.flush()
+    else:
+        raise TypeError(
+            "The output must be a path or a writable binary file "
+            "(it is a %s)." % type(target))
@@ -0,0 +1,142 @@
+"""
+Helpers to read PDF input without copying it into process memory.
+
+Paths are memory-mapped read-only, in-memory buffers (bytes, bytearray,
+memoryview, mmap) are wrapped in a seekable file object reading straight
+from the buffer.
+"""
+
+import io
+import mmap
+import os
+from pathlib import PurePath
+
+path_types = (str, PurePath)
+buffer_types = (bytes, bytearray, memoryview, mmap.mmap)
+
+__all__ = ['BufferReader', 'is_mapped_from', 'open_pdf']
+
+
+class BufferReader(io.BufferedIOBase):
+    """Read-only, seekable file object over a buffer.
+
+    Only the bytes returned by `read()` are copied. If `owner` is given, it
+    is closed together with the reader (used for memory maps). `path` is
+    the file the buffer maps, if any.
+    """
+
+    def __init__(self, buffer, owner=None, path=None):
+        super(BufferReader, self).__init__()
+        self.path = path
+        self._view = memoryview(buffer)
+        if self._view.format != 'B' or self._view.ndim != 1:
+            self._view = self._view.cast('B')
+        self._owner = owner
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        length = len(self._view)
+        if size is None or size < 0:
+            end = length
+        else:
+            end = min(self._pos + size, length)
+        data = self._view[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    read1 = read
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError('Invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('Negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def getbuffer(self):
+        """Return a memoryview of the whole underlying buffer."""
+        return self._view
+
+    def copy_to_memory(self):
+        """Copy the buffer into process memory and release its owner.
+
+        Memory-mapped files can't be replaced on Windows, so this is needed
+        before writing over the mapped file.
+        """
+        if self._owner is None:
+            return
+        data = self._view.tobytes()
+        self._view.release()
+        self._owner.close()
+        self._view = memoryview(data)
+        self._owner = None
+        self.path = None
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            if self._owner is not None:
+                self._owner.close()
+        super(BufferReader, self).close()
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return BufferReader(b'')
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return BufferReader(mapped, owner=mapped, path=path)
+
+
+def open_pdf(pdf_invoice):
+    """Return a seekable binary file object for a path, buffer or file object.
+
+    Returns (file object, True if the caller is responsible for closing it).
+    """
+    if isinstance(pdf_invoice, path_types):
+        path = os.fspath(pdf_invoice)
+        if not os.path.isfile(path):
+            raise IOError("PDF file '%s' does not exist." % path)
+        return _map_file(path), True
+    elif isinstance(pdf_invoice, buffer_types):
+        return BufferReader(pdf_invoice), True
+    elif isinstance(pdf_invoice, io.IOBase) or (
+            hasattr(pdf_invoice, 'read') and hasattr(pdf_invoice, 'seek')):
+        return pdf_invoice, False
+    raise TypeError(
+        "The PDF invoice must be a path, a bytes-like object or a file "
+        "(it is a %s)." % type(pdf_invoice))
+
+
+def is_mapped_from(pdf_file, target):
+    """Return True if `pdf_file` is a memory map of the file at path `target`."""
+    path = getattr(pdf_file, 'path', None)
+    if path is None or not isinstance(target, path_types):
+        return False
+    try:
+        return os.path.samefile(path, os.fspath(target))
+    except OSError:
+        return False
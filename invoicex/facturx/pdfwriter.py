@@ -40,14 +40,26 @@ from tempfile import NamedTemporaryFile
 from datetime import datetime
 from PyPDF2 import PdfFileWriter, PdfFileReader
 from PyPDF2.generic import DictionaryObject, DecodedStreamObject,\
-    NameObject, createStringObject, ArrayObject, IndirectObject
+    NameObject, createStringObject, ArrayObject, IndirectObject, NumberObject,\
+    StreamObject, ByteStringObject
+from PyPDF2.pdf import PageObject
 from pkg_resources import resource_filename
 import os.path
 import mimetypes
 import hashlib
-
+import re
+import shutil
+import uuid
+from collections import OrderedDict
+
+from .flavors import xml_flavor
+from .locator import EmbeddedFileLocator, LocatorError, _resolve, \
+    iter_name_tree
 from .logger import logger
 
+# Non-stream objects per object stream in compressed output.
+_OBJECTS_PER_STREAM = 100
+
 # Python 2 and 3 compat
 try:
     file_types = (file, io.IOBase)
@@ -56,14 +68,22 @@ except NameError:
 unicode = str
 
 class FacturXPDFWriter(PdfFileWriter):
-    def __init__(self, facturx, pdf_metadata=None):
-        """Take a FacturX instance and write the XML to the attached PDF file"""
+    def __init__(self, facturx, pdf_metadata=None, reader=None, compress=False):
+        """Take a FacturX instance and write the XML to the attached PDF file
+
+        Pass `reader` to reuse an already parsed PdfFileReader of facturx.pdf.
+        With `compress`, the XML is serialized compactly and Flate-encoded,
+        and non-stream objects are packed into object streams indexed by a
+        cross-reference stream.
+        """
 
         super(FacturXPDFWriter, self).__init__()
-        # TODO: Can handle str/paths and ByteIO?
         self.factx = facturx
+        self.compress = compress
 
-        original_pdf = PdfFileReader(facturx.pdf)
+        if reader is None:
+            reader = PdfFileReader(facturx.pdf)
+        self.reader = original_pdf = reader
         # Extract /OutputIntents obj from original invoice
         output_intents = _get_original_output_intents(original_pdf)
         self.appendPagesFromReader(original_pdf)
@@ -75,18 +95,9 @@ class FacturXPDFWriter(PdfFileWriter):
             # else : generate some ?
 
         if pdf_metadata is None:
-            base_info = {
-                'seller': self.factx['seller'],
-                'number': self.factx['invoice_number'],
-                'date': self.factx['date'],
-                'doc_type': self.factx['type'],
-                }
-            pdf_metadata = _base_info2pdf_metadata(base_info)
+            pdf_metadata = _default_pdf_metadata(self.factx)
         else:
-            # clean-up pdf_metadata dict
-            for key, value in pdf_metadata.iteritems():
-                if not isinstance(value, (str, unicode)):
-                    pdf_metadata[key] = ''
+            pdf_metadata = _clean_pdf_metadata(pdf_metadata)
 
         self._update_metadata_add_attachment(pdf_metadata, output_intents)
 
@@ -94,42 +105,9 @@ class FacturXPDFWriter(PdfFileWriter):
     def _update_metadata_add_attachment(self, pdf_metadata, output_intents):
         '''This method is inspired from the code of the addAttachment()
         method of the PyPDF2 lib'''
-        
-        # The entry for the file
-        facturx_xml_str = self.factx.xml_str
-        md5sum = hashlib.md5().hexdigest()
-        md5sum_obj = createStringObject(md5sum)
-        params_dict = DictionaryObject({
-            NameObject('/CheckSum'): md5sum_obj,
-            NameObject('/ModDate'): createStringObject(_get_pdf_timestamp()),
-            NameObject('/Size'): NameObject(str(len(facturx_xml_str))),
-            })
-        file_entry = DecodedStreamObject()
-        file_entry.setData(facturx_xml_str)  # here we integrate the file itself
-        file_entry.update({
-            NameObject("/Type"): NameObject("/EmbeddedFile"),
-            NameObject("/Params"): params_dict,
-            # 2F is '/' in hexadecimal
-            NameObject("/Subtype"): NameObject("/text#2Fxml"),
-            })
-        file_entry_obj = self._addObject(file_entry)
-        # The Filespec entry
-        ef_dict = DictionaryObject({
-            NameObject("/F"): file_entry_obj,
-            NameObject('/UF'): file_entry_obj,
-            })
 
-        xmp_filename = self.factx.flavor.details['xmp_filename']
-        fname_obj = createStringObject(xmp_filename)
-        filespec_dict = DictionaryObject({
-            NameObject("/AFRelationship"): NameObject("/Data"),
-            NameObject("/Desc"): createStringObject("Factur-X Invoice"),
-            NameObject("/Type"): NameObject("/Filespec"),
-            NameObject("/F"): fname_obj,
-            NameObject("/EF"): ef_dict,
-            NameObject("/UF"): fname_obj,
-            })
-        filespec_obj = self._addObject(filespec_dict)
+        fname_obj, filespec_obj = _add_facturx_filespec(
+            self, self.factx, self.compress)
         name_arrayobj_cdict = {fname_obj: filespec_obj}
         
         # TODO: add back additional attachments?
@@ -165,16 +143,7 @@ class FacturXPDFWriter(PdfFileWriter):
             res_output_intents.append(output_intent_obj)
         
         # Update the root
-        xmp_level_str = self.factx.flavor.details['levels'][self.factx.flavor.level]['xmp_str']
-        xmp_template = self.factx.flavor.get_xmp_xml()
-        metadata_xml_str = _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, xmp_template, pdf_metadata)
-        metadata_file_entry = DecodedStreamObject()
-        metadata_file_entry.setData(metadata_xml_str)
-        metadata_file_entry.update({
-            NameObject('/Subtype'): NameObject('/XML'),
-            NameObject('/Type'): NameObject('/Metadata'),
-            })
-        metadata_obj = self._addObject(metadata_file_entry)
+        metadata_obj = _add_xmp_metadata(self, self.factx, pdf_metadata)
         af_value_obj = self._addObject(ArrayObject(af_list))
         self._root_object.update({
             NameObject("/AF"): af_value_obj,
@@ -191,6 +160,360 @@ class FacturXPDFWriter(PdfFileWriter):
         metadata_txt_dict = _prepare_pdf_metadata_txt(pdf_metadata)
         self.addMetadata(metadata_txt_dict)
 
+    def write(self, stream):
+        if not self.compress:
+            return super(FacturXPDFWriter, self).write(stream)
+
+        if not self._root:
+            self._root = self._addObject(self._root_object)
+        # Copy all objects reachable from the catalog, as PdfFileWriter.write
+        # does, mapping page references back to the copied pages.
+        external_reference_map = {}
+        for index, obj in enumerate(self._objects):
+            if isinstance(obj, PageObject) and obj.indirectRef is not None:
+                ref = obj.indirectRef
+                external_reference_map.setdefault(ref.pdf, {}).setdefault(
+                    ref.generation, {})[ref.idnum] = IndirectObject(index + 1, 0, self)
+        self.stack = []
+        self._sweepIndirectReferences(external_reference_map, self._root)
+        del self.stack
+
+        trailer = DictionaryObject({
+            NameObject('/Root'): self._root,
+            NameObject('/Info'): self._info,
+            })
+        if hasattr(self, '_ID'):
+            trailer[NameObject('/ID')] = self._ID
+        _write_with_object_streams(stream, self._objects, trailer)
+
+
+class FacturXIncrementalWriter(object):
+    """Add the XML to the attached PDF file as an incremental update.
+
+    The original bytes are copied unchanged (keeping existing signatures
+    intact) and only the new objects, the updated catalog and /Info and a
+    new cross-reference section are appended. The original PDF is read
+    through the locator, so pages are never parsed: a write costs a plain
+    copy of the original plus the work on the XML, which for large PDFs is
+    much less than a full rewrite.
+
+    PDFs the locator can't read, such as encrypted ones, raise ValueError.
+
+    Other embedded files and /AF entries of the original are kept, an
+    existing Factur-X or ZUGFeRD XML is replaced. With `compress`, the XML
+    is serialized compactly and Flate-encoded.
+    """
+
+    def __init__(self, facturx, pdf_metadata=None, compress=False):
+        self.factx = facturx
+        self.compress = compress
+        if pdf_metadata is None:
+            pdf_metadata = _default_pdf_metadata(facturx)
+        else:
+            pdf_metadata = _clean_pdf_metadata(pdf_metadata)
+        self.pdf_metadata = pdf_metadata
+
+        try:
+            self.original = EmbeddedFileLocator(facturx.pdf)
+        except LocatorError as e:
+            raise ValueError(
+                "Can't update this PDF incrementally (%s)." % e)
+        self._next_number = int(self.original.trailer['/Size'])
+        # object number -> (generation, object), written in this order
+        self._objects = OrderedDict()
+
+    def _addObject(self, obj, number=None, generation=0):
+        if number is None:
+            number = self._next_number
+            self._next_number += 1
+        self._objects[number] = (generation, obj)
+        return IndirectObject(number, generation, self)
+
+    def _update_catalog(self):
+        root_ref = self.original.trailer.raw_get('/Root')
+        root = DictionaryObject(root_ref.getObject())
+        valid_filenames = xml_flavor.valid_xmp_filenames()
+
+        fname_obj, filespec_obj = _add_facturx_filespec(
+            self, self.factx, self.compress)
+        entries = dict(
+            (key, value) for key, value
+            in iter_name_tree(_resolve(_resolve(root.get('/Names') or {}).get('/EmbeddedFiles')))
+            if key not in valid_filenames)
+        entries[fname_obj] = filespec_obj
+        names = ArrayObject()
+        for key in sorted(entries):
+            names += [createStringObject(key), entries[key]]
+        names_dict = DictionaryObject(_resolve(root.get('/Names')) or {})
+        names_dict[NameObject('/EmbeddedFiles')] = DictionaryObject({
+            NameObject('/Names'): names,
+            })
+
+        af_list = ArrayObject(
+            filespec for filespec in _resolve(root.get('/AF')) or []
+            if _resolve(_resolve(filespec).get('/F')) not in valid_filenames)
+        af_list.append(filespec_obj)
+
+        root.update({
+            NameObject('/AF'): self._addObject(af_list),
+            NameObject('/Metadata'): _add_xmp_metadata(
+                self, self.factx, self.pdf_metadata),
+            NameObject('/Names'): names_dict,
+            NameObject('/PageMode'): NameObject('/UseAttachments'),
+            })
+        return self._addObject(
+            root, root_ref.idnum, root_ref.generation)
+
+    def _update_info(self):
+        info_ref = self.original.trailer.raw_get('/Info') \
+            if '/Info' in self.original.trailer else None
+        info = DictionaryObject(_resolve(info_ref) or {})
+        for key, value in _prepare_pdf_metadata_txt(self.pdf_metadata).items():
+            info[NameObject(key)] = createStringObject(value)
+        if isinstance(info_ref, IndirectObject):
+            return self._addObject(info, info_ref.idnum, info_ref.generation)
+        return self._addObject(info)
+
+    def write(self, stream):
+        root_obj = self._update_catalog()
+        info_obj = self._update_info()
+
+        source = self.factx.pdf
+        source.seek(0)
+        shutil.copyfileobj(source, stream)
+        source.seek(-1, 2)
+        if source.read(1) not in (b'\n', b'\r'):
+            stream.write(b'\n')
+
+        offsets = {}
+        for number, (generation, obj) in self._objects.items():
+            offsets[number] = stream.tell()
+            _write_object(stream, number, obj, generation)
+
+        trailer = DictionaryObject({
+            NameObject('/Root'): root_obj,
+            NameObject('/Info'): info_obj,
+            NameObject('/Prev'): NumberObject(self.original.startxref),
+            })
+        if '/ID' in self.original.trailer:
+            trailer[NameObject('/ID')] = self.original.trailer['/ID']
+        if self.original.trailer.get('/Type') == '/XRef':
+            xref_offset = self._write_xref_stream(stream, offsets, trailer)
+        else:
+            xref_offset = self._write_xref_table(stream, offsets, trailer)
+        stream.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+
+    def _write_xref_table(self, stream, offsets, trailer):
+        xref_offset = stream.tell()
+        # Readers such as PyPDF2 expect the newest section to start at 0.
+        stream.write(b'xref\n0 1\n0000000000 65535 f\r\n')
+        for first, numbers in _subsections(offsets):
+            stream.write(b'%d %d\n' % (first, len(numbers)))
+            for number in numbers:
+                stream.write(b'%010d %05d n\r\n' % (
+                    offsets[number], self._objects[number][0]))
+        trailer[NameObject('/Size')] = NumberObject(self._next_number)
+        stream.write(b'trailer\n')
+        trailer.writeToStream(stream, None)
+        stream.write(b'\n')
+        return xref_offset
+
+    def _write_xref_stream(self, stream, offsets, trailer):
+        # Originals using xref streams get an xref stream, which also
+        # lists itself.
+        xref_number = self._next_number
+        xref_offset = offsets[xref_number] = stream.tell()
+        offset_width = max(4, (xref_offset.bit_length() + 7) // 8)
+        index, data = ArrayObject(), b''
+        for first, numbers in _subsections(offsets):
+            index += [NumberObject(first), NumberObject(len(numbers))]
+            for number in numbers:
+                generation = 0 if number == xref_number else \
+                    self._objects[number][0]
+                data += b'\x01' + offsets[number].to_bytes(offset_width, 'big') + \
+                    generation.to_bytes(2, 'big')
+        xref = DecodedStreamObject()
+        xref.setData(data)
+        xref.update(trailer)
+        xref.update({
+            NameObject('/Type'): NameObject('/XRef'),
+            NameObject('/Size'): NumberObject(xref_number + 1),
+            NameObject('/Index'): index,
+            NameObject('/W'): ArrayObject([
+                NumberObject(1), NumberObject(offset_width), NumberObject(2)]),
+            })
+        _write_object(stream, xref_number, xref)
+        return xref_offset
+
+
+def _flate_encode(stream_obj):
+    """Return a Flate-encoded copy of a DecodedStreamObject, keeping its entries."""
+    encoded = stream_obj.flateEncode()
+    for key, value in stream_obj.items():
+        if key not in ('/Filter', '/Length'):
+            encoded[key] = value
+    return encoded
+
+
+def _write_with_object_streams(stream, objects, trailer):
+    """Write a complete PDF of objects numbered 1..n with generation 0.
+
+    Stream objects are written as usual, all other objects are packed into
+    Flate-encoded object streams. The file ends with a compressed
+    cross-reference stream (PDF 1.5).
+    """
+    stream.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+    size = len(objects) + 1
+    # object number -> (type, field 2, field 3) of the xref stream entry
+    entries = {0: (0, 0, 65535)}
+    packed = []
+    for number, obj in enumerate(objects, 1):
+        if isinstance(obj, StreamObject):
+            entries[number] = (1, stream.tell(), 0)
+            _write_object(stream, number, obj)
+        else:
+            packed.append((number, obj))
+
+    for start in range(0, len(packed), _OBJECTS_PER_STREAM):
+        chunk = packed[start:start + _OBJECTS_PER_STREAM]
+        offsets, body = [], BytesIO()
+        for index, (number, obj) in enumerate(chunk):
+            offsets.append(b'%d %d' % (number, body.tell()))
+            obj.writeToStream(body, None)
+            body.write(b'\n')
+            entries[number] = (2, size, index)
+        header = b' '.join(offsets) + b'\n'
+        object_stream = DecodedStreamObject()
+        object_stream.setData(header + body.getvalue())
+        object_stream.update({
+            NameObject('/Type'): NameObject('/ObjStm'),
+            NameObject('/N'): NumberObject(len(chunk)),
+            NameObject('/First'): NumberObject(len(header)),
+            })
+        entries[size] = (1, stream.tell(), 0)
+        _write_object(stream, size, _flate_encode(object_stream))
+        size += 1
+
+    xref_number, size = size, size + 1
+    xref_offset = stream.tell()
+    entries[xref_number] = (1, xref_offset, 0)
+    width = max(1, (max(entry[1] for entry in entries.values()).bit_length() + 7) // 8)
+    data = b''.join(
+        bytearray([entries[number][0]])
+        + entries[number][1].to_bytes(width, 'big')
+        + entries[number][2].to_bytes(2, 'big')
+        for number in range(size))
+    xref = DecodedStreamObject()
+    xref.setData(data)
+    xref.update(trailer)
+    xref.update({
+        NameObject('/Type'): NameObject('/XRef'),
+        NameObject('/Size'): NumberObject(size),
+        NameObject('/W'): ArrayObject([
+            NumberObject(1), NumberObject(width), NumberObject(2)]),
+        })
+    _write_object(stream, xref_number, _flate_encode(xref))
+    stream.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+
+
+def _write_object(stream, number, obj, generation=0):
+    stream.write(b'%d %d obj\n' % (number, generation))
+    obj.writeToStream(stream, None)
+    stream.write(b'\nendobj\n')
+
+
+def _subsections(numbers):
+    """Group sorted object numbers into runs of consecutive numbers."""
+    runs = []
+    for number in sorted(numbers):
+        if runs and number == runs[-1][0] + len(runs[-1][1]):
+            runs[-1][1].append(number)
+        else:
+            runs.append((number, [number]))
+    return runs
+
+
+def _default_pdf_metadata(factx):
+    base_info = {
+        'seller': factx['seller'],
+        'number': factx['invoice_number'],
+        'date': factx['date'],
+        'doc_type': factx['type'],
+        }
+    return _base_info2pdf_metadata(base_info)
+
+
+def _clean_pdf_metadata(pdf_metadata):
+    for key, value in pdf_metadata.items():
+        if not isinstance(value, (str, unicode)):
+            pdf_metadata[key] = ''
+    return pdf_metadata
+
+
+def _add_facturx_filespec(writer, factx, compress=False):
+    """Add the XML file stream and its filespec. Returns (name, filespec).
+
+    With `compress`, the XML is serialized without indentation and
+    Flate-encoded.
+    """
+    # The entry for the file
+    if compress:
+        facturx_xml_str = etree.tostring(factx.xml)
+    else:
+        facturx_xml_str = factx.xml_str
+    # /CheckSum is the MD5 of the embedded bytes, as a 16-byte string.
+    md5sum_obj = ByteStringObject(hashlib.md5(facturx_xml_str).digest())
+    params_dict = DictionaryObject({
+        NameObject('/CheckSum'): md5sum_obj,
+        NameObject('/ModDate'): createStringObject(_get_pdf_timestamp()),
+        NameObject('/Size'): NameObject(str(len(facturx_xml_str))),
+        })
+    file_entry = DecodedStreamObject()
+    file_entry.setData(facturx_xml_str)  # here we integrate the file itself
+    file_entry.update({
+        NameObject("/Type"): NameObject("/EmbeddedFile"),
+        NameObject("/Params"): params_dict,
+        # 2F is '/' in hexadecimal
+        NameObject("/Subtype"): NameObject("/text#2Fxml"),
+        })
+    if compress:
+        file_entry = _flate_encode(file_entry)
+    file_entry_obj = writer._addObject(file_entry)
+    # The Filespec entry
+    ef_dict = DictionaryObject({
+        NameObject("/F"): file_entry_obj,
+        NameObject('/UF'): file_entry_obj,
+        })
+
+    xmp_filename = factx.flavor.details['xmp_filename']
+    fname_obj = createStringObject(xmp_filename)
+    filespec_dict = DictionaryObject({
+        NameObject("/AFRelationship"): NameObject("/Data"),
+        NameObject("/Desc"): createStringObject("Factur-X Invoice"),
+        NameObject("/Type"): NameObject("/Filespec"),
+        NameObject("/F"): fname_obj,
+        NameObject("/EF"): ef_dict,
+        NameObject("/UF"): fname_obj,
+        })
+    filespec_obj = writer._addObject(filespec_dict)
+    return fname_obj, filespec_obj
+
+
+def _add_xmp_metadata(writer, factx, pdf_metadata):
+    """Add the XMP /Metadata stream. Returns a reference to it.
+
+    Never compressed: PDF/A doesn't allow a /Filter on metadata streams.
+    """
+    xmp_level_str = factx.flavor.details['levels'][factx.flavor.level]['xmp_str']
+    metadata_xml_str = XMPTemplate.for_flavor(factx.flavor).render(
+        xmp_level_str, pdf_metadata)
+    metadata_file_entry = DecodedStreamObject()
+    metadata_file_entry.setData(metadata_xml_str)
+    metadata_file_entry.update({
+        NameObject('/Subtype'): NameObject('/XML'),
+        NameObject('/Type'): NameObject('/Metadata'),
+        })
+    return writer._addObject(metadata_file_entry)
 
 
 def _get_metadata_timestamp():
@@ -219,6 +542,89 @@ def _base_info2pdf_metadata(base_info):
     return pdf_metadata
 
 
+# Characters not allowed in XML 1.0, which lxml refuses to serialize.
+_XML_INVALID_CHARS = re.compile(u'[^\u0009\u000a\u000d\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+
+def _escape_xml(value, attribute=False):
+    """Escape a value the way lxml serializes text and attribute values."""
+    if value is None:
+        value = ''
+    if _XML_INVALID_CHARS.search(value):
+        raise ValueError('All strings must be XML compatible: Unicode or ASCII, '
+                         'no NULL bytes or control characters')
+    value = value.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').replace('\r', '&#13;')
+    if attribute:
+        value = value.replace('"', '&quot;').replace('\n', '&#10;').replace(
+            '\t', '&#9;')
+    return value.encode('utf-8')
+
+
+class XMPTemplate(object):
+    """The XMP metadata packet of a flavor, serialized once.
+
+    The packet is built by _prepare_pdf_metadata_xml with placeholder
+    values and split around them, so rendering only escapes and joins the
+    per-document values: title, author, subject, timestamps and
+    conformance level. The result is byte-identical to calling
+    _prepare_pdf_metadata_xml directly.
+    """
+
+    # field -> serialized in an attribute
+    FIELDS = OrderedDict([
+        ('title', False), ('author', False), ('subject', False),
+        ('timestamp', False), ('level', True)])
+
+    _cache = {}
+
+    def __init__(self, flavor):
+        placeholders = dict(
+            (field, 'xmp-placeholder-%s-%s' % (field, uuid.uuid4().hex))
+            for field in self.FIELDS)
+        packet = _prepare_pdf_metadata_xml(
+            placeholders['level'], flavor.details['xmp_filename'],
+            flavor.get_xmp_xml(), placeholders, placeholders['timestamp'])
+        fields_by_placeholder = dict(
+            (placeholder.encode('ascii'), field)
+            for field, placeholder in placeholders.items())
+        pattern = re.compile(b'|'.join(re.escape(p) for p in fields_by_placeholder))
+        # Alternating static bytes and field names, starting with bytes.
+        self.segments = []
+        position = 0
+        for match in pattern.finditer(packet):
+            self.segments.append(packet[position:match.start()])
+            self.segments.append(fields_by_placeholder[match.group(0)])
+            position = match.end()
+        self.segments.append(packet[position:])
+
+    @classmethod
+    def for_flavor(cls, flavor):
+        key = (flavor.name, flavor.details['xmp_filename'])
+        template = cls._cache.get(key)
+        if template is None:
+            template = cls._cache[key] = cls(flavor)
+        return template
+
+    def render(self, xmp_level_str, pdf_metadata, timestamp=None):
+        if timestamp is None:
+            timestamp = _get_metadata_timestamp()
+        values = {
+            'title': pdf_metadata.get('title', ''),
+            'author': pdf_metadata.get('author', ''),
+            'subject': pdf_metadata.get('subject', ''),
+            'timestamp': timestamp,
+            'level': xmp_level_str,
+            }
+        escaped = dict(
+            (field, _escape_xml(values[field], attribute))
+            for field, attribute in self.FIELDS.items())
+        parts = list(self.segments)
+        for i in range(1, len(parts), 2):
+            parts[i] = escaped[parts[i]]
+        return b''.join(parts)
+
+
 def _prepare_pdf_metadata_txt(pdf_metadata):
     pdf_date = _get_pdf_timestamp()
     info_dict = {
@@ -234,7 +640,7 @@ def _prepare_pdf_metadata_txt(pdf_metadata):
     return info_dict
 
 
-def _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, facturx_ext_schema_root, pdf_metadata):
+def _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, facturx_ext_schema_root, pdf_metadata, timestamp=None):
     nsmap_x = {'x': 'adobe:ns:meta/'}
     nsmap_rdf = {'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'}
     nsmap_dc = {'dc': 'http://purl.org/dc/elements/1.1/'}
@@ -293,7 +699,8 @@ def _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, facturx_ext_schema_ro
     creator = etree.SubElement(
         desc_xmp, ns_xmp + 'CreatorTool')
     creator.text = 'factur-x python lib v%s by Alexis de Lattre' % __version__
-    timestamp = _get_metadata_timestamp()
+    if timestamp is None:
+        timestamp = _get_metadata_timestamp()
     etree.SubElement(desc_xmp, ns_xmp + 'CreateDate').text = timestamp
     etree.SubElement(desc_xmp, ns_xmp + 'ModifyDate').text = timestamp
 
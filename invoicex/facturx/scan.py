@@ -0,0 +1,165 @@
+"""
+Classify PDFs by the flavor and level of their embedded invoice XML,
+without parsing or validating the XML.
+
+The XMP metadata of the catalog is read first: Factur-X and ZUGFeRD PDFs
+declare their conformance level and XML file name there. Without it, the
+embedded XML is located and only read up to the guideline ID of its
+document context, which is enough to tell flavor and level.
+
+    >>> scan_pdf('invoice.pdf')
+    ScanResult(flavor='factur-x', level='basic', filename='factur-x.xml', source='xmp')
+"""
+
+from collections import namedtuple
+from io import BytesIO
+
+from lxml import etree
+from PyPDF2 import PdfFileReader
+from PyPDF2.utils import PdfReadError
+
+from .flavors import xml_flavor
+from .locator import (
+    EmbeddedFileLocator, LocatorError, _resolve, _stream_bytes,
+    find_in_name_tree)
+from .logger import logger
+from .pdfsource import open_pdf
+
+__all__ = ['ScanResult', 'scan_pdf', 'scan_xml', 'scan_xmp']
+
+# source is 'xmp' or 'xml', depending on where flavor and level were read.
+# All fields are None for PDFs without invoice XML.
+ScanResult = namedtuple('ScanResult', 'flavor level filename source')
+
+NOT_FOUND = ScanResult(None, None, None, None)
+
+# Namespaces of the PDF/A extension schemas in the XMP metadata.
+XMP_NAMESPACES = {
+    'urn:factur-x:pdfa:CrossIndustryDocument:invoice:1p0#': 'factur-x',
+    # ZUGFeRD 2 uses the Factur-X XML syntax.
+    'urn:zugferd:pdfa:CrossIndustryDocument:invoice:2p0#': 'factur-x',
+    'urn:ferd:pdfa:CrossIndustryDocument:invoice:1p0#': 'zugferd',
+}
+_XMP_PROPERTIES = ('ConformanceLevel', 'DocumentFileName')
+_RDF_DESCRIPTION = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description'
+_XMP_PARSER = etree.XMLParser(
+    resolve_entities=False, no_network=True, recover=True)
+
+
+def _version_tags():
+    """Return {flavor: tag path of the version field}."""
+    tags = {}
+    for flavor, details in xml_flavor.FLAVORS.items():
+        path = xml_flavor.FIELDS['version']['_path'].get(flavor)
+        if path is not None and 'namespaces' in details:
+            parsed = xml_flavor._path_to_tags(path, details['namespaces'])
+            if parsed is not None and parsed[0]:
+                tags[flavor] = parsed[1]
+    return tags
+
+VERSION_TAGS = _version_tags()
+
+
+def _xmp_properties(xmp_bytes):
+    """Return (namespace, {property: value}) of the first extension schema
+    namespace with properties in the XMP packet."""
+    root = etree.fromstring(xmp_bytes, _XMP_PARSER)
+    if root is None:
+        return None, {}
+    descriptions = list(root.iter(_RDF_DESCRIPTION))
+    for namespace in XMP_NAMESPACES:
+        found = {}
+        for description in descriptions:
+            for name in _XMP_PROPERTIES:
+                tag = '{%s}%s' % (namespace, name)
+                # Properties are either attributes of rdf:Description or
+                # child elements of it.
+                value = description.get(tag)
+                if value is None:
+                    child = description.find(tag)
+                    if child is not None:
+                        value = (child.text or '').strip()
+                if value is not None:
+                    found.setdefault(name, value)
+        if found:
+            return namespace, found
+    return None, {}
+
+
+def scan_xmp(xmp_bytes):
+    """Return the ScanResult declared in an XMP packet, or None if it
+    declares no level, or one unknown to its flavor."""
+    try:
+        namespace, found = _xmp_properties(xmp_bytes)
+    except etree.XMLSyntaxError:
+        return None
+    if 'ConformanceLevel' not in found:
+        return None
+    flavor = XMP_NAMESPACES[namespace]
+    level = found['ConformanceLevel'].lower().replace(' ', '')
+    if level not in xml_flavor.FLAVORS[flavor].get('levels', {}):
+        logger.debug('Unknown %s level %r in the XMP metadata', flavor, level)
+        return None
+    return ScanResult(flavor, level, found.get('DocumentFileName'), 'xmp')
+
+
+def scan_xml(xml_bytes, filename=None):
+    """Return the ScanResult of invoice XML, reading it only up to its
+    version field. Raises ValueError if flavor or level can't be told,
+    xml_flavor.UnknownFlavorError if it isn't invoice XML."""
+    flavor = None
+    tags = []
+    context = etree.iterparse(
+        BytesIO(xml_bytes), events=('start', 'end'), resolve_entities=False,
+        no_network=True)
+    for event, element in context:
+        if event == 'start':
+            if flavor is None:
+                flavor = xml_flavor.guess_flavor(element)
+                version_tags = VERSION_TAGS[flavor]
+            tags.append(element.tag)
+            continue
+        if tuple(tags) == version_tags:
+            level = xml_flavor.level_from_urn(flavor, element.text or '')
+            return ScanResult(flavor, level, filename, 'xml')
+        tags.pop()
+    raise ValueError('Version field not found.')
+
+
+def _scan_catalog(catalog):
+    metadata = _resolve(catalog.get('/Metadata'))
+    if metadata is not None:
+        result = scan_xmp(_stream_bytes(metadata))
+        if result is not None:
+            return result
+
+    names = _resolve(catalog.get('/Names'))
+    if names is None:
+        return NOT_FOUND
+    embedded = find_in_name_tree(_resolve(names.get('/EmbeddedFiles')))
+    if embedded is None:
+        return NOT_FOUND
+    return scan_xml(embedded.data, embedded.filename)
+
+
+def scan_pdf(pdf_invoice):
+    """Return the ScanResult of a PDF path, buffer or file.
+
+    Only the catalog, its XMP metadata and, if the metadata doesn't tell,
+    the embedded XML are read.
+    """
+    stream, owned = open_pdf(pdf_invoice)
+    try:
+        try:
+            catalog = _resolve(EmbeddedFileLocator(stream).trailer['/Root'])
+            return _scan_catalog(catalog)
+        except xml_flavor.UnknownFlavorError:
+            # About the XML, PdfFileReader would find the same.
+            raise
+        except (LocatorError, PdfReadError, KeyError, ValueError,
+                AssertionError, AttributeError, TypeError, IndexError) as e:
+            logger.debug('Locator failed (%s), using PdfFileReader', e)
+            return _scan_catalog(PdfFileReader(stream).trailer['/Root'])
+    finally:
+        if owned:
+            stream.close()
@@ -0,0 +1,77 @@
+"""
+One opened PDF invoice, shared between embedded-XML discovery, field editing
+and writing.
+
+Without a session, opening and saving a file builds a PdfFileReader up to
+three times: when looking for embedded XML, when loading the FacturX
+instance and when writing. A DocumentSession parses the PDF once and hands
+the same reader to FacturX and FacturXPDFWriter:
+
+    with DocumentSession('invoice.pdf') as session:
+        factx = session.facturx()
+        factx['invoice_number'] = 'INV-42'
+        factx.write_pdf('out.pdf')
+"""
+
+from PyPDF2 import PdfFileReader
+
+from .facturx import FacturX, _parse_xml
+from .locator import embedded_xml_from_reader
+from .pdfsource import open_pdf
+
+__all__ = ['DocumentSession']
+
+_UNSET = object()
+
+
+class DocumentSession(object):
+    """Owns the PDF input and a single PdfFileReader built on first use.
+
+    Attributes:
+    - stream: the PDF input as a seekable file object (see pdfsource.open_pdf).
+    - reader: the shared PdfFileReader.
+    """
+
+    def __init__(self, pdf_invoice):
+        self.stream, self._owns_stream = open_pdf(pdf_invoice)
+        self._reader = None
+        self._xml_bytes = _UNSET
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = PdfFileReader(self.stream)
+        return self._reader
+
+    def embedded_xml(self):
+        """Return the bytes of the embedded invoice XML, or None."""
+        if self._xml_bytes is _UNSET:
+            self._xml_bytes = embedded_xml_from_reader(self.reader)
+        return self._xml_bytes
+
+    def embedded_xml_tree(self):
+        """Return the embedded invoice XML parsed, or None.
+
+        Parsed like FacturX does, without resolving entities. To only know
+        whether there is XML, check embedded_xml() instead, which doesn't
+        parse it.
+        """
+        xml_bytes = self.embedded_xml()
+        if xml_bytes is None:
+            return None
+        return _parse_xml(xml_bytes)
+
+    def facturx(self, flavor='factur-x', level='minimum', **kwargs):
+        """Return a FacturX instance sharing this session's reader."""
+        return FacturX(self.reader, flavor, level, **kwargs)
+
+    def close(self):
+        if self._owns_stream:
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
@@ -1,7 +1,88 @@
+import hashlib
 import os
+import shutil
+import tempfile
+import time
 import unittest
+from unittest import mock
 from facturx.facturx import *
+from facturx.flavors import xml_flavor
+from facturx import batch, generator, locator, pdfwriter, scan, workers
+from facturx.session import DocumentSession
+from datetime import datetime
+from io import BytesIO, StringIO
 from lxml import etree
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import (
+    ArrayObject, DecodedStreamObject, DictionaryObject, NameObject,
+    createStringObject)
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+
+
+def _xmp_packet(level,
+                namespace='urn:ferd:pdfa:CrossIndustryDocument:invoice:1p0#'):
+    """Return an XMP packet declaring `level` in `namespace`."""
+    return (
+        '<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description xmlns:fx="%s" fx:ConformanceLevel="%s"'
+        ' fx:DocumentFileName="factur-x.xml"/>'
+        '</rdf:RDF></x:xmpmeta><?xpacket end="w"?>' % (namespace, level)
+    ).encode('ascii')
+
+
+def _pdf_with_attachments(xml_bytes, count=300, leaf_size=10, limits=True,
+                          extra=(), metadata=None):
+    """Return a PDF whose name tree is split into /Kids, with the
+    invoice XML, unless None, and the (filename, data) in `extra` among
+    count other attachments. `metadata` is the XMP packet of the catalog."""
+    writer = PdfFileWriter()
+    writer.appendPagesFromReader(PdfFileReader(
+        os.path.join(SAMPLES_DIR, 'no_embedded_data.pdf')))
+    entries = []
+    for i in range(count):
+        entries.append(('attachment-%04d.txt' % i, b'attachment %d' % i))
+    if xml_bytes is not None:
+        entries.append(('factur-x.xml', xml_bytes))
+    entries.extend(extra)
+    entries.sort()
+
+    leaves = ArrayObject()
+    for start in range(0, len(entries), leaf_size):
+        names = ArrayObject()
+        for filename, data in entries[start:start + leaf_size]:
+            file_stream = DecodedStreamObject()
+            file_stream.setData(data)
+            filespec = DictionaryObject({
+                NameObject('/Type'): NameObject('/Filespec'),
+                NameObject('/F'): createStringObject(filename),
+                NameObject('/EF'): DictionaryObject({
+                    NameObject('/F'): writer._addObject(file_stream)}),
+            })
+            names.append(createStringObject(filename))
+            names.append(writer._addObject(filespec))
+        leaf = DictionaryObject({NameObject('/Names'): names})
+        if limits:
+            leaf[NameObject('/Limits')] = ArrayObject([names[0], names[-2]])
+        leaves.append(writer._addObject(leaf))
+    writer._root_object.update({
+        NameObject('/Names'): DictionaryObject({
+            NameObject('/EmbeddedFiles'): DictionaryObject({
+                NameObject('/Kids'): leaves})}),
+    })
+    if metadata is not None:
+        metadata_stream = DecodedStreamObject()
+        metadata_stream.setData(metadata)
+        metadata_stream.update({
+            NameObject('/Type'): NameObject('/Metadata'),
+            NameObject('/Subtype'): NameObject('/XML')})
+        writer._root_object[NameObject('/Metadata')] = \
+            writer._addObject(metadata_stream)
+    output = BytesIO()
+    writer.write(output)
+    return output
 
 
 class TestReading(unittest.TestCase):
@@ -15,6 +96,25 @@ class TestReading(unittest.TestCase):
             file_path = os.path.join(self.test_files_dir, file)
             FacturX(file_path)
 
+    def test_input_types(self):
+        import pathlib
+
+        file_path = self.find_file('Facture_FR_BASIC.pdf')
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        with FacturX(file_path) as factx:
+            expected = factx.to_dict()
+        pdf_file = open(file_path, 'rb')
+        self.addCleanup(pdf_file.close)
+        for pdf_invoice in (pathlib.Path(file_path), data, bytearray(data),
+                            memoryview(data), pdf_file):
+            with FacturX(pdf_invoice) as factx:
+                self.assertEqual(factx.to_dict(), expected)
+        with self.assertRaises(TypeError):
+            FacturX(42)
+        with self.assertRaises(IOError):
+            FacturX('non-existant.pdf')
+
     # returning file path for a specific file in 'sample_invoices'
     def find_file(self, file_name):
         self.discover_files()
@@ -70,6 +170,859 @@ class TestReading(unittest.TestCase):
         self.assertTrue(expected_file_str == test_file_str, "Files don't match")
         os.remove(test_file_path)
 
+    def test_to_dict(self):
+        self.discover_files()
+        for file in self.test_files:
+            factx = FacturX(os.path.join(self.test_files_dir, file))
+            expected = {}
+            for field in xml_flavor.FIELDS:
+                r = factx.flavor.get_xpath(field)(factx.xml)
+                expected[field] = r[0].text if len(r) else None
+            self.assertEqual(factx.to_dict(), expected, file)
+
+        factx = FacturX(self.find_file('zugferd_example_invoice_en.pdf'))
+        self.assertEqual(factx.to_dict(missing='')['notes'], '')
+
+
+class TestValidationModes(unittest.TestCase):
+    def setUp(self):
+        self.file_path = os.path.join(
+            os.path.dirname(__file__), 'sample_invoices', 'Facture_FR_BASIC.pdf')
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            FacturX(self.file_path, validation='lazy')
+
+    def test_deferred(self):
+        factx = FacturX(self.file_path, validation='deferred')
+        self.assertIsNone(factx._valid)
+        valid = factx.is_valid()
+        self.assertEqual(factx._valid, valid)
+        self.assertEqual(valid, FacturX(self.file_path).is_valid())
+
+        factx['invoice_number'] = 'INV-2'
+        self.assertIsNone(factx._valid)
+        self.assertEqual(factx.is_valid(), valid)
+
+    def test_none(self):
+        xml_flavor.clear_schema_cache()
+        factx = FacturX(self.file_path, validation='none')
+        self.assertEqual(factx['invoice_number'], 'FA-2017-0010')
+        self.assertEqual(xml_flavor.schema_cache_info()['size'], 0)
+
+
+class TestValidationCache(unittest.TestCase):
+    def setUp(self):
+        from facturx.cache import FacturXCache
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = FacturXCache(self.cache_dir)
+        self.file_path = os.path.join(
+            os.path.dirname(__file__), 'sample_invoices', 'Facture_FR_BASIC.pdf')
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_repeat_open(self):
+        first = FacturX(self.file_path, cache=self.cache)
+        self.assertEqual(self.cache.info()['entries'], 1)
+
+        xml_flavor.clear_schema_cache()
+        second = FacturX(self.file_path, cache=self.cache)
+        self.assertEqual(second.is_valid(), first.is_valid())
+        self.assertEqual(second.errors, first.errors)
+        self.assertEqual(second.to_dict(), first.to_dict())
+        self.assertEqual(xml_flavor.schema_cache_info()['misses'], 0)
+
+        second['invoice_number'] = 'INV-2'
+        self.assertEqual(second.to_dict()['invoice_number'], 'INV-2')
+
+    def test_eviction(self):
+        self.cache.max_size = 1
+        FacturX(self.file_path, cache=self.cache)
+        self.assertEqual(self.cache.info()['entries'], 0)
+
+    def test_invalid_hit(self):
+        with open(self.file_path, 'rb') as f:
+            xml_bytes = locator.read_embedded_xml(f).replace(
+                b'</rsm:ExchangedDocument>',
+                b'<ram:Bogus/></rsm:ExchangedDocument>')
+        with self.assertRaises(xml_flavor.XSDValidationError) as uncached:
+            FacturX.from_xml(xml_bytes)
+        for i in range(2):
+            with self.assertRaises(xml_flavor.XSDValidationError) as cached:
+                FacturX.from_xml(xml_bytes, cache=self.cache)
+            self.assertEqual(str(cached.exception), str(uncached.exception))
+        self.assertEqual(self.cache.info()['entries'], 1)
+
+    def test_rules_change(self):
+        FacturX(self.file_path, cache=self.cache)
+        fingerprints = dict((flavor, 'changed') for flavor in xml_flavor.FLAVORS)
+        with mock.patch.dict(xml_flavor._rules_fingerprints, fingerprints):
+            FacturX(self.file_path, cache=self.cache)
+        self.assertEqual(self.cache.info()['entries'], 2)
+
+
+class TestSchemaCache(unittest.TestCase):
+    def setUp(self):
+        xml_flavor.clear_schema_cache()
+
+    def test_levels_share_schema(self):
+        minimum = xml_flavor.get_schema('factur-x', 'minimum')
+        basicwl = xml_flavor.get_schema('factur-x', 'basicwl')
+        self.assertIs(minimum, basicwl)
+        info = xml_flavor.schema_cache_info()
+        self.assertEqual(info['misses'], 1)
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['size'], 1)
+
+    def test_warm_cache(self):
+        # factur-x has two distinct XSDs, zugferd one
+        self.assertEqual(xml_flavor.warm_schema_cache(), 3)
+        xml_flavor.get_schema('zugferd', 'comfort')
+        self.assertEqual(xml_flavor.schema_cache_info()['misses'], 3)
+
+
+class TestLocator(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+
+    def test_same_as_pypdf2(self):
+        for file_name in os.listdir(self.test_files_dir):
+            with open(os.path.join(self.test_files_dir, file_name), 'rb') as f:
+                self.assertEqual(locator.find_embedded_xml(f),
+                                 locator._find_with_pypdf2(f), file_name)
+
+    def test_written_pdf(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            factx = FacturX(os.path.join(self.test_files_dir, 'embedded_data.pdf'))
+            path = os.path.join(temp_dir, 'written.pdf')
+            factx.write_pdf(path)
+            with open(path, 'rb') as f:
+                xml_bytes = locator.find_embedded_xml(f)
+            self.assertEqual(etree.tostring(etree.fromstring(xml_bytes)),
+                             etree.tostring(factx.xml))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+    def test_name_tree_kids(self):
+        xml_bytes = b'<invoice/>'
+        pdf = _pdf_with_attachments(xml_bytes)
+        pdf_locator = locator.EmbeddedFileLocator(pdf)
+        self.assertEqual(pdf_locator.find_xml(), ('factur-x.xml', xml_bytes))
+        # Only the path to the invoice is loaded, not the other filespecs.
+        self.assertLess(len(pdf_locator._objects), 20)
+        self.assertEqual(locator._find_with_pypdf2(pdf), xml_bytes)
+
+    def test_name_tree_without_invoice(self):
+        pdf_locator = locator.EmbeddedFileLocator(_pdf_with_attachments(None))
+        self.assertEqual(pdf_locator.find_xml(), (None, None))
+        # Only the first filespec is loaded, to tell the keys are file names.
+        filespecs = [obj for obj in pdf_locator._objects.values()
+                     if isinstance(obj, dict) and obj.get('/Type') == '/Filespec']
+        self.assertEqual(len(filespecs), 1)
+
+    def test_name_tree_without_limits(self):
+        xml_bytes = b'<invoice/>'
+        pdf = _pdf_with_attachments(xml_bytes, count=25, limits=False)
+        tree = locator.EmbeddedFileLocator(pdf).embedded_files()
+        self.assertRaises(locator.UnsortedNameTree,
+                          locator.name_tree_lookup, tree, 'factur-x.xml')
+        self.assertEqual(locator.find_embedded_xml(pdf), xml_bytes)
+        self.assertEqual(locator._find_with_pypdf2(pdf), xml_bytes)
+
+    def test_name_tree_iteration(self):
+        pdf = _pdf_with_attachments(b'<invoice/>', count=25, leaf_size=4)
+        tree = locator.EmbeddedFileLocator(pdf).embedded_files()
+        keys = [key for key, value in locator.iter_name_tree(tree)]
+        self.assertEqual(len(keys), 26)
+        self.assertEqual(keys, sorted(keys))
+        self.assertIsNone(locator.name_tree_lookup(tree, 'missing.xml'))
+
+
+class TestDocumentSession(unittest.TestCase):
+    def setUp(self):
+        self.sample = os.path.join(
+            os.path.dirname(__file__), 'sample_invoices', 'embedded_data.pdf')
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_single_reader(self):
+        with DocumentSession(self.sample) as session:
+            self.assertIsNotNone(session.embedded_xml_tree())
+            factx = session.facturx()
+            self.assertIs(factx.reader, session.reader)
+            for i in range(2):
+                path = os.path.join(self.temp_dir, 'out%d.pdf' % i)
+                factx.write_pdf(path)
+                self.assertIs(factx.reader, session.reader)
+                with FacturX(path) as written:
+                    self.assertEqual(written.to_dict(), factx.to_dict())
+                self.assertEqual(
+                    PdfFileReader(path).getNumPages(),
+                    session.reader.getNumPages())
+
+    def test_reader_built_on_first_write(self):
+        path = os.path.join(self.temp_dir, 'in_place.pdf')
+        shutil.copy(self.sample, path)
+        with FacturX(path) as factx:
+            self.assertIsNone(factx.reader)
+            # Overwrites the memory-mapped input.
+            factx.write_pdf(path)
+            self.assertIsNotNone(factx.reader)
+        with FacturX(path) as written:
+            self.assertEqual(written['invoice_number'], factx['invoice_number'])
+
+    def test_xml_tree_entities_not_resolved(self):
+        xml = (b'<?xml version="1.0"?><!DOCTYPE r [<!ENTITY e "expanded">]>'
+               b'<r>&e;</r>')
+        with DocumentSession(self.sample) as session, \
+                mock.patch.object(session, 'embedded_xml', return_value=xml):
+            tree = session.embedded_xml_tree()
+        self.assertNotIn(b'expanded', etree.tostring(tree))
+
+
+class TestIncrementalWrite(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.temp_dir, 'incremental.pdf')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, source):
+        with FacturX(source) as factx:
+            factx['invoice_number'] = 'INV-INCREMENTAL'
+            factx.write_pdf(self.output, incremental=True)
+            original = factx.pdf.getbuffer().tobytes()
+        with open(self.output, 'rb') as f:
+            written = f.read()
+        self.assertTrue(written.startswith(original))
+        with FacturX(self.output) as factx:
+            self.assertEqual(factx['invoice_number'], 'INV-INCREMENTAL')
+        return written
+
+    def test_xref_stream(self):
+        self._write(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'))
+        self.assertEqual(PdfFileReader(self.output).getNumPages(), 1)
+
+    def test_xref_table(self):
+        full = os.path.join(self.temp_dir, 'full.pdf')
+        with FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf')) as factx:
+            factx.write_pdf(full)
+        self._write(full)
+        # A second update on top of the first one.
+        self._write(self.output)
+
+    def test_keeps_attachments(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf')) as factx:
+            xml_bytes = factx.xml_str
+        self._write(_pdf_with_attachments(xml_bytes, count=5, leaf_size=2))
+        with open(self.output, 'rb') as f:
+            tree = locator.EmbeddedFileLocator(f).embedded_files()
+            keys = [key for key, value in locator.iter_name_tree(tree)]
+        self.assertEqual(len(keys), 6)
+        self.assertIn('factur-x.xml', keys)
+
+    def test_encrypted(self):
+        writer = PdfFileWriter()
+        writer.addBlankPage(100, 100)
+        writer.encrypt('secret')
+        encrypted = BytesIO()
+        writer.write(encrypted)
+        factx = mock.Mock(pdf=encrypted)
+        with self.assertRaisesRegex(ValueError, 'Encrypted PDF'):
+            pdfwriter.FacturXIncrementalWriter(factx, pdf_metadata={})
+
+
+class TestWriteOutput(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.factx = FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'))
+
+    def tearDown(self):
+        self.factx.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_streams(self):
+        class Pipe(object):
+            """Write-only, like stdout or a socket."""
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(data)
+
+        for incremental in (False, True):
+            pipe = Pipe()
+            digest = self.factx.write_pdf(pipe, incremental, sha256=True)
+            data = b''.join(pipe.chunks)
+            self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+            with FacturX(data) as written:
+                self.assertEqual(written.to_dict(), self.factx.to_dict())
+
+    def test_compress(self):
+        for incremental in (False, True):
+            plain, compressed = BytesIO(), BytesIO()
+            self.factx.write_pdf(plain, incremental)
+            self.factx.write_pdf(compressed, incremental, compress=True)
+            self.assertLess(len(compressed.getvalue()), len(plain.getvalue()))
+            with FacturX(compressed.getvalue()) as written:
+                self.assertEqual(written.to_dict(), self.factx.to_dict())
+            compressed.seek(0)
+            self.assertEqual(
+                locator.find_embedded_xml(compressed),
+                etree.tostring(self.factx.xml))
+        data = compressed.getvalue()
+        self.assertIn(b'/FlateDecode', data)
+
+        output = BytesIO()
+        self.factx.write_pdf(output, compress=True)
+        reader = PdfFileReader(output)
+        self.assertEqual(reader.trailer['/Root']['/Metadata'].get('/Filter'), None)
+        self.assertIn(b'/ObjStm', output.getvalue())
+        self.assertNotIn(b'\ntrailer', output.getvalue())
+        self.assertEqual(reader.getNumPages(), 1)
+
+    def test_atomic_replace(self):
+        path = os.path.join(self.temp_dir, 'out.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'old content')
+        os.chmod(path, 0o640)
+        digest = self.factx.write_pdf(path, sha256=True)
+        self.assertEqual(os.listdir(self.temp_dir), ['out.pdf'])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        with open(path, 'rb') as f:
+            self.assertEqual(digest, hashlib.sha256(f.read()).hexdigest())
+
+    def test_replace_own_input(self):
+        path = os.path.join(self.temp_dir, 'in.pdf')
+        shutil.copy(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'), path)
+        session = DocumentSession(path)
+        self.addCleanup(session.close)
+        factx = session.facturx()
+        factx['invoice_number'] = 'INV-2'
+        replace = os.replace
+
+        def windows_replace(source, target):
+            # Windows refuses to replace a mapped file.
+            if session.stream.path is not None:
+                raise PermissionError(target)
+            replace(source, target)
+
+        with mock.patch('os.replace', windows_replace):
+            factx.write_pdf(path)
+            factx['invoice_number'] = 'INV-3'
+            factx.write_pdf(path)
+        with FacturX(path) as written:
+            self.assertEqual(written['invoice_number'], 'INV-3')
+
+    def test_failed_write_keeps_target(self):
+        path = os.path.join(self.temp_dir, 'out.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'old content')
+        # The incremental writer builds its objects once the output is open.
+        with mock.patch.object(pdfwriter.XMPTemplate, 'render', side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                self.factx.write_pdf(path, incremental=True)
+        self.assertEqual(os.listdir(self.temp_dir), ['out.pdf'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'old content')
+
+
+class TestChecksum(unittest.TestCase):
+    def test_written_checksum(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf')) as factx:
+            self.assertIsNone(factx.checksum_verified)
+            number = factx['invoice_number'].encode()
+            for incremental in (False, True):
+                output = BytesIO()
+                factx.write_pdf(output, incremental)
+                data = output.getvalue()
+                with FacturX(data) as written:
+                    self.assertTrue(written.checksum_verified)
+
+                # Same length, different content.
+                tampered = data.replace(number, number[:-1] + b'X')
+                self.assertNotEqual(tampered, data)
+                with FacturX(tampered, validation='none') as written:
+                    self.assertFalse(written.checksum_verified)
+
+    def test_binary_checksum(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'zugferd_example_invoice_en.pdf')) as factx:
+            self.assertTrue(factx.checksum_verified)
+            factx.read_xml(factx.xml_str)
+            self.assertIsNone(factx.checksum_verified)
+
+    def test_hex_checksum(self):
+        # Written by earlier versions.
+        file_stream = DecodedStreamObject()
+        file_stream[NameObject('/Params')] = DictionaryObject({
+            NameObject('/CheckSum'): createStringObject(
+                hashlib.md5(b'<invoice/>').hexdigest())})
+        checksum = locator._stored_checksum(file_stream)
+        self.assertEqual(checksum, hashlib.md5(b'<invoice/>').digest())
+        self.assertTrue(locator.EmbeddedFile(
+            'factur-x.xml', b'<invoice/>', checksum).checksum_matches)
+        self.assertFalse(locator.EmbeddedFile(
+            'factur-x.xml', b'<invoice />', checksum).checksum_matches)
+
+
+class TestXMPTemplate(unittest.TestCase):
+    def test_same_as_builder(self):
+        pdf_metadata = {
+            'title': 'A & B <C> "D"\r\n\t\u00e9 \U0001d11e',
+            'author': '',
+            'subject': 'Invoice > 100',
+            }
+        timestamp = '2018-01-01T12:00:00+00:00'
+        for file_name in ('embedded_data.pdf', 'zugferd_example_invoice_en.pdf'):
+            with FacturX(os.path.join(SAMPLES_DIR, file_name), validation='none') as factx:
+                flavor = factx.flavor
+            for level in ('EN 16931', 'A "quoted"\n& level'):
+                self.assertEqual(
+                    pdfwriter.XMPTemplate.for_flavor(flavor).render(level, pdf_metadata, timestamp),
+                    pdfwriter._prepare_pdf_metadata_xml(
+                        level, flavor.details['xmp_filename'],
+                        flavor.get_xmp_xml(), pdf_metadata, timestamp))
+
+        with self.assertRaises(ValueError):
+            pdfwriter.XMPTemplate.for_flavor(flavor).render(level, {'title': '\x00'})
+
+    def test_xmp_copies(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf')) as factx:
+            first = factx.flavor.get_xmp_xml()
+            first.getroot().clear()
+            self.assertNotEqual(len(factx.flavor.get_xmp_xml().getroot()), 0)
+
+
+class TestTemplateCache(unittest.TestCase):
+    def test_copies(self):
+        first = xml_flavor.get_template('factur-x', 'minimum')
+        second = xml_flavor.get_template('factur-x', 'minimum')
+        self.assertIsNot(first, second)
+        self.assertEqual(etree.tostring(first), etree.tostring(second))
+        first.clear()
+        self.assertEqual(
+            etree.tostring(xml_flavor.get_template('factur-x', 'minimum')),
+            etree.tostring(second))
+
+    def test_parsed_and_validated_once(self):
+        file_path = os.path.join(SAMPLES_DIR, 'no_embedded_data.pdf')
+        FacturX(file_path).close()
+        with mock.patch.object(etree, 'parse', side_effect=AssertionError), \
+                mock.patch.object(xml_flavor.XMLFlavor, 'check_xsd',
+                                  side_effect=AssertionError):
+            for i in range(3):
+                with FacturX(file_path) as factx:
+                    factx['invoice_number'] = 'INV-%d' % i
+        with FacturX(file_path) as factx:
+            self.assertNotEqual(factx['invoice_number'], 'INV-2')
+
+
+class TestFieldXPaths(unittest.TestCase):
+    def test_compiled_paths(self):
+        self.assertEqual(set(xml_flavor.FIELD_XPATHS), {'factur-x', 'zugferd'})
+        for flavor in xml_flavor.FIELD_XPATHS.values():
+            for xpath in flavor.values():
+                self.assertIsInstance(xpath, etree.XPath)
+
+    def test_independent_of_document_prefixes(self):
+        xml = etree.fromstring(
+            '<a:CrossIndustryInvoice '
+            'xmlns:a="urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100" '
+            'xmlns:b="urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100">'
+            '<a:ExchangedDocument><b:ID>INV-1</b:ID></a:ExchangedDocument>'
+            '</a:CrossIndustryInvoice>')
+        xpath = xml_flavor.FIELD_XPATHS['factur-x']['invoice_number']
+        self.assertEqual(xpath(xml)[0].text, 'INV-1')
+
+
+class TestAnchoredPaths(unittest.TestCase):
+    def test_anchor_roundtrip(self):
+        from facturx.flavors import anchor_paths
+
+        # Strip the root step again to get back descendant-axis paths.
+        relaxed = {}
+        for field, details in xml_flavor.FIELDS.items():
+            paths = {}
+            for flavor, path in details['_path'].items():
+                if path.startswith('//'):
+                    paths[flavor] = path
+                else:
+                    paths[flavor] = '//' + path.split('/', 2)[2]
+            relaxed[field] = dict(details, _path=paths)
+
+        anchored, unresolved = anchor_paths.anchor_fields(relaxed, xml_flavor.FLAVORS)
+        for field, paths in anchored.items():
+            for flavor, path in paths.items():
+                self.assertEqual(path, xml_flavor.FIELDS[field]['_path'][flavor])
+        self.assertEqual(
+            anchor_paths.check_equivalence(
+                relaxed, xml_flavor.FIELDS, anchor_paths.sample_trees()), [])
+
+
+class TestXMLOnly(unittest.TestCase):
+    def setUp(self):
+        self.pdf_path = os.path.join(SAMPLES_DIR, 'embedded_data.pdf')
+        with open(self.pdf_path, 'rb') as f:
+            self.xml_bytes = locator.read_embedded_xml(f)
+
+    def test_from_xml_inputs(self):
+        with FacturX(self.pdf_path) as factx:
+            expected = factx.to_dict()
+            valid = factx.is_valid()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            xml_path = os.path.join(temp_dir, 'factur-x.xml')
+            with open(xml_path, 'wb') as f:
+                f.write(self.xml_bytes)
+            for xml in (self.xml_bytes, xml_path, BytesIO(self.xml_bytes)):
+                # Patched where facturx.py looks them up.
+                with mock.patch('facturx.facturx.read_embedded_file',
+                                side_effect=AssertionError), \
+                        mock.patch('facturx.facturx.PdfFileReader',
+                                   side_effect=AssertionError), \
+                        mock.patch('facturx.facturx.open_pdf',
+                                   side_effect=AssertionError):
+                    factx = FacturX.from_xml(xml)
+                self.assertIsNone(factx.pdf)
+                self.assertEqual(factx.is_valid(), valid)
+                self.assertEqual(factx.to_dict(), expected)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_write_pdf_without_pdf(self):
+        factx = FacturX.from_xml(self.xml_bytes)
+        self.assertRaises(ValueError, factx.write_pdf, BytesIO())
+
+    def test_read_xml(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'no_embedded_data.pdf')) as factx:
+            factx['invoice_number'] = 'TEMPLATE'
+            factx.read_xml(BytesIO(self.xml_bytes))
+            self.assertEqual(factx.to_dict(),
+                             FacturX.from_xml(self.xml_bytes).to_dict())
+            self.assertNotEqual(factx['invoice_number'], 'TEMPLATE')
+
+    def test_read_xml_rejected(self):
+        invalid = self.xml_bytes.replace(
+            b'</rsm:ExchangedDocument>', b'<ram:Bogus/></rsm:ExchangedDocument>')
+        factx = FacturX.from_xml(self.xml_bytes)
+        factx['invoice_number'] = 'INV-2'
+        xml = factx.xml
+        for rejected in (invalid, b'<not-xml'):
+            with self.assertRaises(Exception):
+                factx.read_xml(rejected)
+            self.assertIs(factx.xml, xml)
+            self.assertEqual(factx['invoice_number'], 'INV-2')
+
+    def test_invalid_xml(self):
+        self.assertRaises(TypeError, FacturX.from_xml, 42)
+        self.assertRaises(etree.XMLSyntaxError, FacturX.from_xml, b'<a>')
+
+
+class TestGenerator(unittest.TestCase):
+    rows = [
+        {'invoice_number': 'INV-%d' % i, 'date': '2024-01-%02d' % (i + 1),
+         'amount_total': '%d.00' % (100 + i), 'amount_tax': '',
+         'seller': 'Seller %d' % i, 'buyer': 'Buyer'}
+        for i in range(5)]
+
+    def test_generate(self):
+        results = list(generator.XMLGenerator('factur-x', 'basic').generate(self.rows))
+        self.assertEqual([r.index for r in results], list(range(5)))
+        for row, result in zip(self.rows, results):
+            self.assertEqual(result.errors, [])
+            factx = FacturX.from_xml(result.xml)
+            self.assertEqual(factx.flavor.level, 'basic')
+            self.assertEqual(factx['invoice_number'], row['invoice_number'])
+            self.assertEqual(factx['date'], datetime.strptime(row['date'], '%Y-%m-%d'))
+            self.assertEqual(factx['amount_total'], row['amount_total'])
+            self.assertEqual(factx['seller'], row['seller'])
+
+    def test_errors(self):
+        gen = generator.XMLGenerator('factur-x', 'minimum')
+        self.assertIn('not in the factur-x minimum template',
+                      gen.generate_one(0, {'notes': 'x'}).errors[0])
+        self.assertIn('Unknown field', gen.generate_one(0, {'foo': 'x'}).errors[0])
+        result = gen.generate_one(0, {'invoice_number': 'INV-1'})
+        self.assertIsNotNone(result.xml)
+        self.assertIn("Required field seller doesn't contain any value", result.errors)
+
+    def test_read_rows(self):
+        csv_rows = list(generator.read_rows(StringIO(
+            'invoice_number,amount_total\nINV-1,10.00\nINV-2,20.00\n'), 'csv'))
+        jsonl_rows = list(generator.read_rows(StringIO(
+            '{"invoice_number": "INV-1", "amount_total": "10.00"}\n\n'
+            '{"invoice_number": "INV-2", "amount_total": "20.00"}\n'), 'jsonl'))
+        self.assertEqual(csv_rows, jsonl_rows)
+        self.assertEqual(csv_rows[1], {'invoice_number': 'INV-2', 'amount_total': '20.00'})
+        self.assertRaises(ValueError, list, generator.read_rows('rows.txt'))
+
+    def test_parallel(self):
+        expected = list(generator.XMLGenerator('zugferd', 'comfort').generate(self.rows))
+        self.assertEqual(
+            list(generator.generate_parallel(
+                self.rows, 'zugferd', 'comfort', processes=2, chunksize=2)),
+            expected)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.pdf_path = os.path.join(SAMPLES_DIR, 'no_embedded_data.pdf')
+        self.xml_path = os.path.join(self.temp_dir, 'factur-x.xml')
+        with open(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'), 'rb') as f:
+            self.xml_bytes = locator.read_embedded_xml(f)
+        with open(self.xml_path, 'wb') as f:
+            f.write(self.xml_bytes)
+        self.fields = {
+            'invoice_number': 'INV-1', 'date': '2024-01-02',
+            'seller': 'Seller', 'buyer': 'Buyer', 'amount_total': '12.00'}
+        self.jobs = [
+            {'pdf': self.pdf_path, 'xml': self.xml_path,
+             'output': os.path.join(self.temp_dir, 'from_xml.pdf')},
+            {'pdf': self.pdf_path, 'fields': self.fields, 'level': 'basic',
+             'output': os.path.join(self.temp_dir, 'from_fields.pdf')},
+            {'pdf': self.pdf_path, 'fields': {'amount_total': 'abc'},
+             'output': os.path.join(self.temp_dir, 'invalid.pdf')},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_results(self, results):
+        self.assertEqual([r.index for r in results], [0, 1, 2])
+        self.assertEqual(results[0].errors, [])
+        with FacturX(results[0].output) as factx:
+            self.assertEqual(factx.xml_str, FacturX.from_xml(self.xml_bytes).xml_str)
+        self.assertEqual(results[1].errors, [])
+        with FacturX(results[1].output) as factx:
+            self.assertEqual(factx.flavor.level, 'basic')
+            self.assertEqual(factx['invoice_number'], 'INV-1')
+            self.assertEqual(factx['seller'], 'Seller')
+        self.assertIsNone(results[2].output)
+        self.assertIn('not valid against', results[2].errors[0])
+        self.assertFalse(os.path.exists(self.jobs[2]['output']))
+
+    def test_embed(self):
+        embedder = batch.BatchEmbedder(warm=False)
+        self.check_results([embedder.run(i, job) for i, job in enumerate(self.jobs)])
+
+    def test_embed_over_invalid_xml(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf')) as factx:
+            factx['amount_total'] = 'abc'
+            self.assertFalse(factx.is_valid())
+            factx.write_pdf(os.path.join(self.temp_dir, 'invalid_xml.pdf'))
+        job = dict(self.jobs[0], pdf=os.path.join(self.temp_dir, 'invalid_xml.pdf'))
+        embedder = batch.BatchEmbedder(warm=False)
+        with mock.patch.object(xml_flavor.XMLFlavor, 'check_xsd',
+                               autospec=True) as check_xsd:
+            self.assertEqual(embedder.run(0, job).errors, [])
+        # Only the new XML is checked.
+        self.assertEqual(check_xsd.call_count, 1)
+        self.assertIn('either', embedder.run(0, {'pdf': self.pdf_path}).errors[0])
+
+    def test_parallel(self):
+        self.check_results(list(batch.embed_parallel(self.jobs, processes=2)))
+
+
+class TestUpdate(unittest.TestCase):
+    def setUp(self):
+        self.factx = FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'),
+                             validation='deferred')
+        self.before = self.factx.xml_str
+
+    def tearDown(self):
+        self.factx.close()
+
+    def test_update(self):
+        with mock.patch.object(self.factx.flavor, 'check_xsd',
+                               wraps=self.factx.flavor.check_xsd) as check_xsd:
+            self.factx.update({'invoice_number': 'INV-42', 'seller': 'ACME',
+                               'date': datetime(2024, 1, 2)})
+            self.factx.is_valid()
+        self.assertEqual(check_xsd.call_count, 1)
+        self.assertEqual(self.factx['invoice_number'], 'INV-42')
+        self.assertEqual(self.factx['seller'], 'ACME')
+        self.assertEqual(self.factx['date'], datetime(2024, 1, 2))
+
+    def test_rollback(self):
+        valid = self.factx.is_valid()
+        self.assertRaises(ValueError, self.factx.update, {
+            'invoice_number': 'INV-42', 'amount_total': 'abc'})
+        self.assertEqual(self.factx.xml_str, self.before)
+        self.assertEqual(self.factx.is_valid(), valid)
+
+    def test_eager_validates_once(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf')) as factx:
+            with mock.patch.object(factx.flavor, 'check_xsd',
+                                   wraps=factx.flavor.check_xsd) as check_xsd:
+                factx.update({'invoice_number': 'INV-42'})
+                valid = factx.is_valid()
+            self.assertEqual(check_xsd.call_count, 1)
+            self.assertEqual(valid, self.factx.is_valid())
+
+    def test_eager_revalidates_direct_edits(self):
+        with FacturX(os.path.join(SAMPLES_DIR, 'embedded_data.pdf')) as factx:
+            factx.update({'invoice_number': 'INV-42'})
+            valid = factx.is_valid()
+            node = factx.flavor.get_xpath('amount_total')(factx.xml)[0]
+            amount, node.text = node.text, 'abc'
+            self.assertFalse(factx.is_valid())
+            node.text = amount
+            with mock.patch.object(factx.flavor, 'check_xsd',
+                                   wraps=factx.flavor.check_xsd) as check_xsd:
+                self.assertEqual(factx.is_valid(), valid)
+                self.assertEqual(factx.is_valid(), valid)
+            # Each call validates, as in eager mode without update().
+            self.assertEqual(check_xsd.call_count, 2)
+
+    def test_empty_required(self):
+        for value in ('', None):
+            self.assertRaises(ValueError, self.factx.update, {
+                'seller': 'ACME', 'invoice_number': value})
+            self.assertEqual(self.factx.xml_str, self.before)
+        self.factx.update({'notes': ''}, ignore_missing=True)
+
+    def test_lookup_before_change(self):
+        self.assertRaises(KeyError, self.factx.update, {
+            'invoice_number': 'INV-42', 'name': 'Invoice'})
+        self.assertEqual(self.factx.xml_str, self.before)
+        self.factx.update({'invoice_number': 'INV-42', 'name': 'Invoice'},
+                          ignore_missing=True)
+        self.assertEqual(self.factx['invoice_number'], 'INV-42')
+
+
+class TestScan(unittest.TestCase):
+    def test_xmp(self):
+        result = scan.scan_pdf(os.path.join(SAMPLES_DIR, 'Facture_FR_BASICWL.pdf'))
+        self.assertEqual(result, scan.ScanResult(
+            'factur-x', 'basicwl', 'factur-x.xml', 'xmp'))
+        self.assertEqual(scan.scan_pdf(os.path.join(SAMPLES_DIR, 'no_embedded_data.pdf')),
+                         scan.NOT_FOUND)
+
+    def test_xmp_from_catalog(self):
+        file_path = os.path.join(SAMPLES_DIR, 'zugferd_example_invoice_en.pdf')
+        expected = scan.ScanResult('zugferd', 'basic', 'ZUGFeRD-invoice.xml', 'xmp')
+        self.assertEqual(scan.scan_pdf(file_path), expected)
+
+    def test_unknown_xmp_level(self):
+        self.assertEqual(scan.scan_xmp(_xmp_packet('COMFORT')), scan.ScanResult(
+            'zugferd', 'comfort', 'factur-x.xml', 'xmp'))
+        self.assertIsNone(scan.scan_xmp(_xmp_packet('EXTENDED')))
+        self.assertIsNone(scan.scan_xmp(_xmp_packet(
+            'EXTENDED', 'urn:factur-x:pdfa:CrossIndustryDocument:invoice:1p0#')))
+        # The embedded XML tells instead.
+        with open(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'), 'rb') as f:
+            xml_bytes = locator.read_embedded_xml(f)
+        output = _pdf_with_attachments(xml_bytes, count=3,
+                                       metadata=_xmp_packet('EXTENDED'))
+        self.assertEqual(scan.scan_pdf(output.getvalue()), scan.ScanResult(
+            'factur-x', 'basic', 'factur-x.xml', 'xml'))
+
+    def test_attached_xmp_ignored(self):
+        # An attachment's packet, last in the file, isn't the document's.
+        with open(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'), 'rb') as f:
+            xml_bytes = locator.read_embedded_xml(f)
+        output = _pdf_with_attachments(xml_bytes, count=3, extra=[
+            ('zz-metadata.xmp', _xmp_packet('COMFORT'))])
+        self.assertEqual(scan.scan_pdf(output.getvalue()), scan.ScanResult(
+            'factur-x', 'basic', 'factur-x.xml', 'xml'))
+
+    def test_xml_fallback(self):
+        with open(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'), 'rb') as f:
+            xml_bytes = locator.read_embedded_xml(f)
+        output = _pdf_with_attachments(xml_bytes, count=3)
+        self.assertEqual(scan.scan_pdf(output.getvalue()), scan.ScanResult(
+            'factur-x', 'basic', 'factur-x.xml', 'xml'))
+
+    def test_agrees_with_facturx(self):
+        for file_name in sorted(os.listdir(SAMPLES_DIR)):
+            file_path = os.path.join(SAMPLES_DIR, file_name)
+            with open(file_path, 'rb') as f:
+                embedded = locator.read_embedded_file(f)
+            if embedded is None:
+                continue
+            factx = FacturX.from_xml(embedded.data, validation='deferred')
+            expected = (factx.flavor.name, factx.flavor.level, embedded.filename)
+            self.assertEqual(scan.scan_pdf(file_path)[:3], expected)
+            self.assertEqual(scan.scan_xml(embedded.data, embedded.filename)[:3],
+                             expected)
+
+    def test_unknown_flavor(self):
+        output = _pdf_with_attachments(b'<invoice/>', count=0)
+        with mock.patch.object(scan, 'PdfFileReader') as reader:
+            with self.assertRaises(xml_flavor.UnknownFlavorError):
+                scan.scan_pdf(output.getvalue())
+        self.assertFalse(reader.called)
+
+    def test_scan_xml_reads_only_the_header(self):
+        with open(os.path.join(SAMPLES_DIR, 'embedded_data.pdf'), 'rb') as f:
+            xml_bytes = locator.read_embedded_xml(f)
+        # Truncated after the document context: the rest isn't read.
+        end = xml_bytes.index(b'</rsm:ExchangedDocumentContext>')
+        self.assertEqual(scan.scan_xml(xml_bytes[:end])[:2], ('factur-x', 'basic'))
+
+
+def _guarded_task(task):
+    if task == 'hang':
+        time.sleep(60)
+    elif task == 'crash':
+        os._exit(3)
+    elif task == 'memory':
+        bytearray(1024 ** 3)
+    elif task == 'raise':
+        raise ValueError('bad input')
+    return task, os.getpid()
+
+
+def _failed_task(task, reason):
+    return task, reason
+
+
+class TestSupervisedPool(unittest.TestCase):
+    def run_pool(self, tasks, **kwargs):
+        pool = workers.SupervisedPool(2, **kwargs)
+        return dict(pool.imap_unordered(_guarded_task, tasks, _failed_task))
+
+    def test_plain(self):
+        results = self.run_pool(range(10))
+        self.assertEqual(sorted(results), list(range(10)))
+        self.assertLessEqual(len(set(results.values())), 2)
+
+    def test_failures(self):
+        tasks = ['hang', 'crash', 'raise'] + list(range(20))
+        start = time.monotonic()
+        # Process.kill() doesn't exist before Python 3.7.
+        with mock.patch('multiprocessing.Process.kill', create=True,
+                        side_effect=AttributeError):
+            results = self.run_pool(tasks, timeout=1)
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertEqual(set(results), set(tasks))
+        self.assertEqual(results['hang'], 'timed out after 1s')
+        self.assertEqual(results['crash'], 'worker exited with code 3')
+        self.assertEqual(results['raise'], 'ValueError: bad input')
+        for task in range(20):
+            self.assertIsInstance(results[task], int)
+
+    @unittest.skipUnless(workers.limits_memory(), 'no memory limits')
+    def test_memory_limit(self):
+        results = self.run_pool(['memory', 1, 2],
+                                memory_limit=512 * 1024 ** 2)
+        self.assertEqual(results['memory'], 'memory limit exceeded')
+        self.assertIsInstance(results[1], int)
+
+    def test_max_tasks(self):
+        results = self.run_pool(range(12), max_tasks=3)
+        self.assertEqual(sorted(results), list(range(12)))
+        self.assertGreaterEqual(len(set(results.values())), 4)
+
 
 def main():
     unittest.main()
@@ -0,0 +1,240 @@
+"""
+Process pool which survives pathological inputs.
+
+Unlike multiprocessing.Pool, each task runs under a wall-clock timeout and,
+where the platform supports it, an address-space limit. A worker which
+overruns its task, runs out of memory or dies is killed and replaced, the
+task is reported as failed with the reason and the other workers go on.
+Workers can also be recycled after a number of tasks, to bound leaks.
+
+    >>> pool = SupervisedPool(4, timeout=60, memory_limit=1024 ** 3)
+    >>> for result in pool.imap_unordered(parse, paths, failed):
+    ...     print(result)
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+__all__ = ['SupervisedPool', 'limits_memory']
+
+# Tasks sent ahead to each worker, so it doesn't wait for the next one.
+_PREFETCH = 2
+# Seconds given to idle workers to exit before they are terminated.
+_SHUTDOWN_GRACE = 5
+
+_END = object()
+
+# Status of the messages sent back by workers. A worker exits after _FATAL.
+_DONE, _FAILED, _FATAL = range(3)
+
+
+def limits_memory():
+    """Return True if memory limits are supported on this platform."""
+    return resource is not None
+
+
+def _kill(process):
+    """Kill `process` and wait for it. Process.kill() needs Python 3.7."""
+    if process.exitcode is None:
+        if hasattr(signal, 'SIGKILL'):
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+            except OSError:
+                # Exited meanwhile.
+                pass
+        else:
+            process.terminate()
+    process.join()
+
+
+def _worker_loop(conn, func, initializer, initargs, memory_limit, max_tasks):
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if initializer is not None:
+        initializer(*initargs)
+    done = 0
+    while max_tasks is None or done < max_tasks:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            conn.send((_DONE, func(task)))
+        except MemoryError:
+            # The heap may be left fragmented, start afresh.
+            conn.send((_FATAL, 'memory limit exceeded'))
+            return
+        except Exception as e:
+            conn.send((_FAILED, '%s: %s' % (type(e).__name__, e)))
+        done += 1
+
+
+class _Worker(object):
+    def __init__(self, pool, func):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_loop,
+            args=(child_conn, func, pool.initializer, pool.initargs,
+                  pool.memory_limit, pool.max_tasks))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.tasks = deque()
+        self.sent = 0
+        self.deadline = None
+
+    def kill(self):
+        _kill(self.process)
+        self.conn.close()
+
+
+class SupervisedPool(object):
+    """Pool of `processes` workers (default: one per core), each built with
+    `initializer(*initargs)`.
+
+    `timeout` is in seconds per task, `memory_limit` in bytes of address
+    space per worker, and `max_tasks` the number of tasks after which a
+    worker is replaced. All default to unlimited.
+    """
+
+    def __init__(self, processes=None, initializer=None, initargs=(),
+                 timeout=None, memory_limit=None, max_tasks=None):
+        if memory_limit and not limits_memory():
+            raise ValueError('Memory limits are not supported on this platform.')
+        self.processes = processes or multiprocessing.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks
+
+    def _reset_deadline(self, worker):
+        if worker.tasks and self.timeout is not None:
+            worker.deadline = time.monotonic() + self.timeout
+        else:
+            worker.deadline = None
+
+    def imap_unordered(self, func, iterable, failed):
+        """Yield func(task) for each task, in completion order.
+
+        For a task which raised, timed out, exhausted the memory limit or
+        crashed its worker, failed(task, reason) is yielded instead.
+        """
+        tasks = iter(iterable)
+        retried = deque()
+        exhausted = False
+        workers = []
+
+        def next_task():
+            if retried:
+                return retried.popleft()
+            return next(tasks, _END)
+
+        def fill(worker):
+            """Send tasks to `worker` up to the prefetch count. Returns False
+            once there are no more tasks."""
+            while len(worker.tasks) < _PREFETCH and \
+                    worker.sent != self.max_tasks:
+                task = next_task()
+                if task is _END:
+                    return False
+                try:
+                    worker.conn.send(task)
+                except OSError:
+                    # The worker died. With tasks, wait() reports it next.
+                    retried.appendleft(task)
+                    if not worker.tasks:
+                        workers.remove(worker)
+                        worker.kill()
+                    return True
+                worker.tasks.append(task)
+                worker.sent += 1
+                if len(worker.tasks) == 1:
+                    self._reset_deadline(worker)
+            return True
+
+        def retire(worker, reason):
+            workers.remove(worker)
+            worker.kill()
+            task = worker.tasks.popleft()
+            # Tasks sent behind the offending one never started.
+            retried.extend(worker.tasks)
+            return failed(task, reason)
+
+        try:
+            while True:
+                for worker in list(workers):
+                    if not worker.tasks and worker.sent == self.max_tasks:
+                        workers.remove(worker)
+                        worker.process.join()
+                        worker.conn.close()
+                for worker in list(workers):
+                    if not fill(worker):
+                        exhausted = True
+                while len(workers) < self.processes and \
+                        (retried or not exhausted):
+                    workers.append(_Worker(self, func))
+                    if not fill(workers[-1]):
+                        exhausted = True
+
+                busy = [worker for worker in workers if worker.tasks]
+                if not busy:
+                    if exhausted and not retried:
+                        return
+                    continue
+                deadlines = [worker.deadline for worker in busy
+                             if worker.deadline is not None]
+                timeout = None
+                if deadlines:
+                    timeout = max(0, min(deadlines) - time.monotonic())
+                ready = wait([worker.conn for worker in busy], timeout)
+
+                for worker in busy:
+                    if worker.conn not in ready:
+                        continue
+                    try:
+                        status, value = worker.conn.recv()
+                    except (EOFError, OSError):
+                        worker.process.join()
+                        yield retire(worker, 'worker exited with code %s'
+                                     % worker.process.exitcode)
+                        continue
+                    if status == _FATAL:
+                        yield retire(worker, value)
+                        continue
+                    task = worker.tasks.popleft()
+                    self._reset_deadline(worker)
+                    yield value if status == _DONE else failed(task, value)
+
+                now = time.monotonic()
+                for worker in busy:
+                    if worker in workers and worker.deadline is not None \
+                            and worker.deadline <= now:
+                        yield retire(worker, 'timed out after %gs'
+                                     % self.timeout)
+        finally:
+            self._shutdown(workers)
+
+    def _shutdown(self, workers):
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        deadline = time.monotonic() + _SHUTDOWN_GRACE
+        for worker in workers:
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                _kill(worker.process)
+            worker.conn.close()
@@ -5,11 +5,8 @@ import subprocess
 import os
 from distutils import spawn
 import shutil
-from lxml import etree
 
-from .facturx.facturx import FacturX
-from .facturx.flavors import xml_flavor
-import json
+from .facturx.session import DocumentSession
 from datetime import datetime as dt
 
 from PyQt5.QtWidgets import (QMainWindow, QAction, QFileDialog, QLineEdit,
@@ -18,8 +15,6 @@ from PyQt5.QtWidgets import (QMainWindow, QAction, QFileDialog, QLineEdit,
                              QDialog, QComboBox)
 from PyQt5.QtGui import QPixmap, QIcon
 from PyQt5.QtCore import Qt, QEvent
-from PyPDF2 import PdfFileReader
-from PyPDF2.generic import IndirectObject
 
 from .populate import PopulateFieldClass
 
@@ -36,6 +31,7 @@ class InvoiceX(QMainWindow):
 
         self.fileLoaded = False
         self.dialog = None
+        self.session = None
         self.initUI()
 
     def initUI(self):
@@ -257,11 +253,7 @@ class InvoiceX(QMainWindow):
 
     def update_dock_fields(self):
         """Load Fields from the attached XML"""
-        self.factx.write_json('.load/output.json')
-        with open('.load/output.json') as jsonFile:
-            self.fieldsDict = json.load(jsonFile)
-        os.remove('.load/output.json')
-        # print(self.fieldsDict)
+        self.fieldsDict = self.factx.to_dict(missing="Field Not Specified")
 
         i = 0
 
@@ -283,12 +275,6 @@ class InvoiceX(QMainWindow):
 
         for key in sorted(self.fieldsDict):
             i += 1
-            try:
-                self.factx[key]
-            except IndexError:
-                self.fieldsDict[key] = "Field Not Specified"
-            except TypeError:
-                pass
             fieldKey = QLabel(self.metadata_field[key] + ": ")
             if self.fieldsDict[key] is None:
                 fieldValue = QLabel("NA")
@@ -319,16 +305,25 @@ class InvoiceX(QMainWindow):
         If no attached XML is found, then show dialog to select Standard
         """
         if self.fileName[0]:
+            # The session parses the PDF once for lookup, editing and saving.
+            previous_session = self.session
+            self.session = DocumentSession(self.fileName[0])
+            factx = None
             if self.check_xml_for_pdf() is None:
                 self.standard = None
                 self.level = None
                 self._choose_standard_level()
                 if self.standard is not None:
-                    self.factx = FacturX(self.fileName[0],
-                                         self.standard,
-                                         self.level)
+                    factx = self.session.facturx(self.standard, self.level)
+            else:
+                factx = self.session.facturx()
+            if factx is None:
+                self.session.close()
+                self.session = previous_session
             else:
-                self.factx = FacturX(self.fileName[0])
+                self.factx = factx
+                if previous_session is not None:
+                    previous_session.close()
             if hasattr(self, 'factx'):
                 self.set_pdf_preview()
                 self.update_dock_fields()
@@ -424,19 +419,8 @@ class InvoiceX(QMainWindow):
 
     def check_xml_for_pdf(self):
         """Look for XML in PDF"""
-        pdf = PdfFileReader(self.fileName[0])
-        pdf_root = pdf.trailer['/Root']
-        if '/Names' not in pdf_root or '/EmbeddedFiles' not in \
-                pdf_root['/Names']:
-            return None
-
-        for file in pdf_root['/Names']['/EmbeddedFiles']['/Names']:
-            if isinstance(file, IndirectObject):
-                obj = file.getObject()
-                if obj['/F'] in xml_flavor.valid_xmp_filenames():
-                    xml_root = etree.fromstring(obj['/EF']['/F'].getData())
-                    xml_content = xml_root
-        return xml_content
+        # FacturX parses it, don't parse it here too.
+        return self.session.embedded_xml()
 
     def save_file_dialog(self):
         """Open dialog to select location"""
@@ -448,6 +432,10 @@ class InvoiceX(QMainWindow):
                     QMessageBox.critical(self, 'Type Error',
                                          "Some field value(s) are invalid",
                                          QMessageBox.Ok)
+                except OSError as e:
+                    QMessageBox.critical(self, 'Save Error',
+                                         "Could not save the PDF: %s" % e,
+                                         QMessageBox.Ok)
         else:
             QMessageBox.critical(self, 'File Not Found',
                                  "Load a PDF first",
@@ -480,6 +468,10 @@ class InvoiceX(QMainWindow):
                 QMessageBox.critical(self, 'Type Error',
                                      "Some field value(s) are not valid",
                                      QMessageBox.Ok)
+            except OSError as e:
+                QMessageBox.critical(self, 'Save Error',
+                                     "Could not save the PDF: %s" % e,
+                                     QMessageBox.Ok)
         else:
             QMessageBox.critical(self, 'File Not Found',
                                  "Load a PDF first",
@@ -597,11 +589,13 @@ class EditFieldsClass(QWidget, object):
     def update_fields_and_dock(self):
         """Update fields and update dock"""
         try:
+            values = {}
             for key, value in zip(self.fieldsKeyList, self.fieldsValueList):
                 if key[:4] != "date":
-                    self.factx[key] = value.text()
+                    values[key] = value.text()
                 else:
-                    self.factx[key] = dt.strptime(value.text(), '%Y/%m/%d')
+                    values[key] = dt.strptime(value.text(), '%Y/%m/%d')
+            self.factx.update(values)
             self.invx.update_dock_fields()
             self.close()
         except ValueError:
@@ -158,16 +158,17 @@ class populate_using_invoice2data(object):
                                  QMessageBox.Ok)
 
         if not templateerror:
+            # Fields the template didn't find are left as they are: "NA"
+            # isn't a valid amount and would roll back the whole update.
+            values = {}
             for key, value in self.fieldValueDict.items():
-                    try:
-                        if key[:4] != "date":
-                            if value is None:
-                                self.factx[key] = "NA"
-                            else:
-                                self.factx[key] = str(value)
-                        else:
-                            pass
-                    except IndexError:
-                        pass
+                if key[:4] != "date" and value is not None:
+                    values[key] = str(value)
+            try:
+                self.factx.update(values, ignore_missing=True)
+            except ValueError:
+                QMessageBox.critical(self.popfield, 'Invalid Field Value',
+                                     "Invalid Field Value(s)",
+                                     QMessageBox.Ok)
 
             self.gui.update_dock_fields()
@@ -0,0 +1,251 @@
+from .. import cli
+from ..facturx.journal import BatchJournal
+from ..facturx.locator import read_embedded_xml
+from unittest import mock
+from lxml import etree
+import unittest
+import os
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'facturx',
+                           'tests', 'sample_invoices')
+
+
+def _hang_on_b(path, options, state):
+    if path.endswith('b.pdf'):
+        time.sleep(60)
+    return cli.validate(path, options, state)
+
+
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, 'in')
+        os.makedirs(os.path.join(self.input_dir, 'sub'))
+        for name, target in (('embedded_data.pdf', 'a.pdf'),
+                             ('Facture_FR_MINIMUM.pdf', 'sub/b.pdf'),
+                             ('no_embedded_data.pdf', 'c.pdf')):
+            shutil.copy(os.path.join(SAMPLES_DIR, name),
+                        os.path.join(self.input_dir, target))
+        self.output = os.path.join(self.temp_dir, 'out.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read_output(self):
+        with open(self.output) as f:
+            return dict((r['file'], r) for r in map(json.loads, f))
+
+    def path(self, name):
+        return os.path.join(self.input_dir, name)
+
+    def test_iter_paths(self):
+        self.assertEqual(
+            list(cli.iter_paths([self.input_dir, self.path('a.pdf'),
+                                 os.path.join(self.input_dir, '**', 'b.pdf')])),
+            [self.path('a.pdf'), self.path('c.pdf'), self.path('sub/b.pdf')])
+
+    def test_validate(self):
+        self.assertEqual(cli.main(['validate', self.input_dir, '-j', '2',
+                                   '-o', self.output]), 1)
+        results = self.read_output()
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[self.path('sub/b.pdf')]['level'], 'minimum')
+        self.assertIn('valid', results[self.path('a.pdf')])
+        self.assertFalse(results[self.path('c.pdf')]['ok'])
+
+    def test_extract(self):
+        cli.main(['extract', self.path('a.pdf'), '-j', '1', '-o', self.output])
+        result = self.read_output()[self.path('a.pdf')]
+        self.assertTrue(result['ok'])
+        self.assertEqual(result['flavor'], 'factur-x')
+        self.assertIn('invoice_number', result['fields'])
+
+    def test_scan(self):
+        self.assertEqual(cli.main(['scan', self.input_dir, '-j', '1',
+                                   '-o', self.output]), 0)
+        results = self.read_output()
+        self.assertEqual(results[self.path('sub/b.pdf')]['level'], 'minimum')
+        self.assertEqual(results[self.path('a.pdf')]['source'], 'xmp')
+        self.assertIsNone(results[self.path('c.pdf')]['flavor'])
+
+    def test_journal(self):
+        journal_path = os.path.join(self.temp_dir, 'run.journal')
+        args = ['validate', self.input_dir, '-j', '1', '-o', self.output,
+                '--journal', journal_path]
+        cli.main(args)
+        first = self.read_output()
+        info = BatchJournal(journal_path).info()
+        self.assertEqual((info['done'], info['failed']), (2, 1))
+
+        # Done and unchanged: neither parsed nor hashed.
+        with mock.patch.dict(cli.COMMANDS, validate=mock.Mock(side_effect=AssertionError)), \
+                mock.patch.object(cli, 'file_digest', side_effect=AssertionError):
+            cli.main(['validate', self.path('a.pdf'), self.path('sub/b.pdf'),
+                      '-o', self.output, '--journal', journal_path])
+        results = self.read_output()
+        self.assertEqual(len(results), 2)
+        for path in (self.path('a.pdf'), self.path('sub/b.pdf')):
+            self.assertTrue(results[path].pop('skipped'))
+            self.assertEqual(results[path], first[path])
+
+        # Failed files are retried.
+        cli.main(args[:-2] + ['-j', '2'] + args[-2:])
+        results = self.read_output()
+        self.assertEqual(len(results), 3)
+        self.assertFalse(results[self.path('c.pdf')]['ok'])
+        self.assertNotIn('skipped', results[self.path('c.pdf')])
+
+        # Touched files are hashed, but not parsed again.
+        os.utime(self.path('a.pdf'), (0, 0))
+        with mock.patch.dict(cli.COMMANDS, validate=mock.Mock(side_effect=AssertionError)):
+            cli.main(args)
+        self.assertTrue(self.read_output()[self.path('a.pdf')]['skipped'])
+
+        # Other settings or content: processed again.
+        cli.main(['extract'] + args[1:])
+        self.assertNotIn('skipped', self.read_output()[self.path('a.pdf')])
+        shutil.copy(os.path.join(SAMPLES_DIR, 'Facture_UE_BASIC.pdf'),
+                    self.path('a.pdf'))
+        cli.main(args)
+        result = self.read_output()[self.path('a.pdf')]
+        self.assertNotIn('skipped', result)
+        self.assertEqual(result['level'], 'basic')
+
+    def test_embed(self):
+        with open(self.path('a.pdf'), 'rb') as f:
+            xml_bytes = read_embedded_xml(f)
+        with open(self.path('c.xml'), 'wb') as f:
+            f.write(xml_bytes)
+        output_dir = os.path.join(self.temp_dir, 'out')
+        cli.main(['embed', self.path('c.pdf'), '--output-dir', output_dir,
+                  '-o', self.output])
+        result = self.read_output()[self.path('c.pdf')]
+        self.assertTrue(result['ok'])
+        with open(result['output'], 'rb') as f:
+            self.assertEqual(
+                etree.tostring(etree.fromstring(read_embedded_xml(f))),
+                etree.tostring(etree.fromstring(xml_bytes)))
+
+    def test_embed_journal(self):
+        journal_path = os.path.join(self.temp_dir, 'run.journal')
+        output_dir = os.path.join(self.temp_dir, 'out')
+        args = ['embed', self.path('c.pdf'), '--output-dir', output_dir,
+                '-o', self.output, '--journal', journal_path]
+        for name, source in (('basic', 'a.pdf'), ('minimum', 'sub/b.pdf')):
+            with open(self.path(source), 'rb') as f:
+                xml_bytes = read_embedded_xml(f)
+            with open(self.path('c.xml'), 'wb') as f:
+                f.write(xml_bytes)
+            # Same modification time: the sidecar's size or digest tells.
+            os.utime(self.path('c.xml'), ns=(0, 0))
+            cli.main(args)
+            result = self.read_output()[self.path('c.pdf')]
+            self.assertNotIn('skipped', result)
+            with open(result['output'], 'rb') as f:
+                self.assertEqual(
+                    etree.tostring(etree.fromstring(read_embedded_xml(f))),
+                    etree.tostring(etree.fromstring(xml_bytes)))
+
+            cli.main(args)
+            self.assertTrue(self.read_output()[self.path('c.pdf')]['skipped'])
+
+    def test_shard_of(self):
+        self.assertEqual(cli.shard_of('in/a.pdf', 7),
+                         cli.shard_of('in/./a.pdf', 7))
+        shards = [cli.shard_of('%d.pdf' % i, 4) for i in range(200)]
+        self.assertEqual(set(shards), set(range(4)))
+        stats = {}
+        selected = list(cli.select_shard(['%d.pdf' % i for i in range(200)],
+                                         1, 4, stats=stats))
+        self.assertEqual(stats, {'total': 200, 'inputs': shards.count(1)})
+        self.assertEqual(len(selected), shards.count(1))
+
+    def test_shards_merge(self):
+        for name in ('d.pdf', 'e.pdf', 'sub/f.pdf'):
+            shutil.copy(self.path('a.pdf'), self.path(name))
+        reports = [os.path.join(self.temp_dir, 'report-%d.jsonl' % k)
+                   for k in (1, 2, 3)]
+        for by in ('path', 'content'):
+            shards = [subprocess.Popen(
+                [sys.executable, '-m', 'invoicex.cli', 'validate',
+                 self.input_dir, '--shard', '%d/3' % k, '--shard-by', by,
+                 '-j', '1', '-o', reports[k - 1]], cwd=REPO_DIR)
+                for k in (1, 2, 3)]
+            for shard in shards:
+                shard.wait()
+            self.assertEqual(cli.main(['merge'] + reports + ['-o', self.output]), 0)
+            with open(self.output) as f:
+                lines = [json.loads(line) for line in f]
+            summary = lines.pop()['summary']
+            self.assertTrue(summary['complete'])
+            self.assertEqual((summary['total'], summary['inputs'],
+                              summary['failed']), (6, 6, 1))
+            self.assertEqual([r['file'] for r in lines],
+                             sorted(cli.iter_paths([self.input_dir])))
+
+        with mock.patch('sys.stderr'):
+            self.assertEqual(cli.main(['merge'] + reports[:2] + ['-o', self.output]), 1)
+            self.assertEqual(cli.main(['merge'] + reports + reports[:1] +
+                                      ['-o', self.output]), 1)
+        with open(self.output) as f:
+            self.assertFalse(json.loads(f.readlines()[-1])['summary']['complete'])
+
+    def test_shard_argument(self):
+        with mock.patch('sys.stderr'):
+            for value in ('0/3', '4/3', '3', 'a/b'):
+                with self.assertRaises(SystemExit):
+                    cli.main(['validate', self.input_dir, '--shard', value])
+
+    def test_quarantine(self):
+        quarantine = os.path.join(self.temp_dir, 'quarantine.jsonl')
+        for processes in ('1', '2'):
+            with mock.patch.dict(cli.COMMANDS, validate=_hang_on_b):
+                cli.main(['validate', self.input_dir, '-j', processes,
+                          '--timeout', '1', '--max-tasks-per-child', '1',
+                          '--quarantine', quarantine, '-o', self.output])
+            results = self.read_output()
+            self.assertEqual(len(results), 3)
+            self.assertTrue(results[self.path('sub/b.pdf')]['quarantined'])
+            self.assertIn('valid', results[self.path('a.pdf')])
+            self.assertNotIn('quarantined', results[self.path('c.pdf')])
+        with open(quarantine) as f:
+            self.assertEqual([json.loads(line) for line in f], 2 * [
+                {'file': self.path('sub/b.pdf'), 'command': 'validate',
+                 'reason': 'timed out after 1s'}])
+
+
+    def test_quarantine_journal(self):
+        journal_path = os.path.join(self.temp_dir, 'run.journal')
+        quarantine = os.path.join(self.temp_dir, 'quarantine.jsonl')
+        args = ['validate', self.input_dir, '-j', '2', '--timeout', '1',
+                '--quarantine', quarantine, '--journal', journal_path,
+                '-o', self.output]
+        with mock.patch.dict(cli.COMMANDS, validate=_hang_on_b):
+            cli.main(args)
+            self.assertEqual(BatchJournal(journal_path).info()['quarantined'], 1)
+
+            # Same limits: not retried, nor listed again.
+            cli.main(args)
+            result = self.read_output()[self.path('sub/b.pdf')]
+            self.assertTrue(result['quarantined'])
+            self.assertTrue(result['skipped'])
+            self.assertNotIn('limits', result)
+            with open(quarantine) as f:
+                self.assertEqual(len(f.readlines()), 1)
+
+            # Other limits: retried.
+            cli.main(args + ['--timeout', '2'])
+        result = self.read_output()[self.path('sub/b.pdf')]
+        self.assertNotIn('skipped', result)
+        self.assertEqual(result['error'], 'timed out after 2s')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,6 +34,7 @@ setup(
     entry_points={
         'console_scripts': [
             'invoicex-gui = invoicex.invoicex:main',
+            'invoicex = invoicex.cli:main',
         ]
     }
 )
\ No newline at end of file